@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+# -*-Python-*-
+"""Measure the cost of hiveconf operations on synthetic hives"""
+import os
+import sys
+import getopt
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import platform
+import tracemalloc
+
+benchdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(benchdir))
+sys.path.insert(0, benchdir)
+import hiveconf
+import genhive
+
+RESULT_VERSION = 1
+
+class Context:
+    """State shared by the benchmarks: the generated hive, an open
+    root folder and the number of operations to run"""
+    def __init__(self, hive, ops, writes, repeat, seed):
+        self.hive = hive
+        self.ops = ops
+        self.writes = writes
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        self.root = hiveconf.open_hive(hive["root"])
+        self.passes = 0
+
+    def sample(self, n, paramtype=None):
+        params = [path for (path, t) in self.hive["params"]
+                  if paramtype is None or t == paramtype]
+        if not params:
+            return []
+        return [self.random.choice(params) for i in range(n)]
+
+
+# Each benchmark takes a Context and returns a list of operations, as
+# functions without arguments. Any preparation is done before
+# returning, and is not measured.
+
+def bench_open_hive(ctx):
+    url = ctx.hive["root"]
+    return [lambda: hiveconf.open_hive(url)] * ctx.repeat
+
+
+def bench_lookup(ctx):
+    lookup = ctx.root.lookup
+    return [lambda path=path: lookup(path) for path in ctx.sample(ctx.ops)]
+
+
+def _make_bench_get(paramtype):
+    def bench_get(ctx):
+        getter = getattr(ctx.root, "get_" + paramtype)
+        return [lambda path=path: getter(path)
+                for path in ctx.sample(ctx.ops, paramtype)]
+    return bench_get
+
+
+def bench_set(ctx):
+    # Change existing parameters; each set rewrites a file
+    ctx.passes += 1
+    set_integer = ctx.root.set_integer
+    return [lambda path=path, i=i: set_integer(path, ctx.passes * ctx.writes + i)
+            for (i, path) in enumerate(ctx.sample(ctx.writes, "integer"))]
+
+
+def bench_set_new(ctx):
+    ctx.passes += 1
+    set_string = ctx.root.set_string
+    return [lambda path=path: set_string(path, "new")
+            for path in _new_paths(ctx)]
+
+
+def bench_delete(ctx):
+    ctx.passes += 1
+    paths = _new_paths(ctx)
+    with ctx.root.transaction():
+        for path in paths:
+            ctx.root.set_string(path, "deleted")
+    delete = ctx.root.delete
+    return [lambda path=path: delete(path) for path in paths]
+
+
+def _new_paths(ctx):
+    """Get paths for ctx.writes parameters which do not exist, next to
+    existing ones"""
+    return ["%s/new%d_%d" % (os.path.dirname(path), ctx.passes, i)
+            for (i, path) in enumerate(ctx.sample(ctx.writes))]
+
+
+BENCHMARKS = [("open_hive", bench_open_hive),
+              ("lookup", bench_lookup)]
+BENCHMARKS += [("get_" + t, _make_bench_get(t)) for t in genhive.TYPES]
+BENCHMARKS += [("set", bench_set),
+               ("set_new", bench_set_new),
+               ("delete", bench_delete)]
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of a sorted, non-empty list"""
+    index = max(0, int(len(sorted_values) * percent / 100.0 + 0.5) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def run_benchmark(ctx, func, memory=1):
+    """Run a benchmark and return a dict with its results. Latencies
+    are in microseconds. Peak memory is measured in a separate pass,
+    since tracemalloc slows everything down."""
+    ops = func(ctx)
+    if not ops:
+        return None
+    latencies = []
+    timer = time.perf_counter
+    start = timer()
+    for op in ops:
+        t0 = timer()
+        op()
+        latencies.append(timer() - t0)
+    elapsed = timer() - start
+
+    latencies.sort()
+    result = {"ops": len(ops),
+              "ops_per_sec": len(ops) / elapsed if elapsed else 0.0,
+              "mean_us": sum(latencies) / len(latencies) * 1e6}
+    for percent in (50, 90, 99):
+        result["p%d_us" % percent] = _percentile(latencies, percent) * 1e6
+    result["max_us"] = latencies[-1] * 1e6
+
+    if memory:
+        ops = func(ctx)
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            for op in ops:
+                op()
+            result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _get_commit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "HEAD"], cwd=benchdir,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def run_benchmarks(config, names=None, memory=1, verbose=0):
+    """Generate a hive according to config and run the benchmarks
+    named in names, or all. Returns a dict suitable for saving as
+    JSON."""
+    directory = tempfile.mkdtemp(prefix="hivebench")
+    try:
+        hive = genhive.generate_hive(directory, **config["hive"])
+        ctx = Context(hive, config["ops"], config["writes"], config["repeat"],
+                      config["seed"])
+        results = {}
+        for (name, func) in BENCHMARKS:
+            if names and name not in names:
+                continue
+            if verbose:
+                print("Running", name, file=sys.stderr)
+            result = run_benchmark(ctx, func, memory)
+            if result:
+                results[name] = result
+    finally:
+        shutil.rmtree(directory)
+
+    return {"version": RESULT_VERSION,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _get_commit(),
+            "python": platform.python_version(),
+            "config": config,
+            "results": results}
+
+
+def print_results(data, outfile=sys.stdout):
+    print("%-18s %8s %12s %10s %10s %10s %10s %12s" %
+          ("benchmark", "ops", "ops/sec", "p50 us", "p90 us", "p99 us",
+           "max us", "peak mem"), file=outfile)
+    for (name, r) in data["results"].items():
+        peak = r.get("peak_memory_bytes")
+        print("%-18s %8d %12.1f %10.1f %10.1f %10.1f %10.1f %12s" %
+              (name, r["ops"], r["ops_per_sec"], r["p50_us"], r["p90_us"],
+               r["p99_us"], r["max_us"], "-" if peak is None else peak),
+              file=outfile)
+
+
+def compare_results(old, new, outfile=sys.stdout):
+    """Print the change in ops/sec and peak memory between two results"""
+    if old["config"] != new["config"]:
+        print("Warning: the results were made with different configurations",
+              file=sys.stderr)
+    print("%-18s %12s %12s %8s %12s %12s" %
+          ("benchmark", "old ops/sec", "new ops/sec", "change", "old mem",
+           "new mem"), file=outfile)
+    for (name, r) in new["results"].items():
+        o = old["results"].get(name)
+        if not o:
+            continue
+        change = (r["ops_per_sec"] / o["ops_per_sec"] - 1) * 100 if o["ops_per_sec"] else 0.0
+        print("%-18s %12.1f %12.1f %+7.1f%% %12s %12s" %
+              (name, o["ops_per_sec"], r["ops_per_sec"], change,
+               o.get("peak_memory_bytes", "-"), r.get("peak_memory_bytes", "-")),
+              file=outfile)
+
+
+def usage():
+    print("""
+bench.py [options] [benchmark ...]
+bench.py -c old.json new.json
+
+Generate a synthetic hive and measure hiveconf operations on it. For
+each operation, print ops/sec, latency percentiles and peak memory.
+
+  -s,--sections <n>       Number of sections. Default is 100
+  -p,--params <n>         Parameters per section. Default is 10
+  -d,--depth <n>          Number of path components per section. Default is 1
+  -m,--mounts <n>         Number of files mounted with %mount. Default is 0
+  -g,--glob <n>           Number of files mounted with a single glob
+                          %mount. Default is 0
+  -n,--ops <n>            Number of read operations. Default is 10000
+  -w,--writes <n>         Number of set and delete operations. Default is 100
+  -r,--repeat <n>         Number of times to open the hive. Default is 20
+  -o,--output <file>      Save the results as JSON
+  -c,--compare            Compare two saved results
+  -M,--no-memory          Do not measure peak memory
+  -l,--list               List benchmarks
+  -V,--verbose            Print each benchmark when it is started
+  -?,--help               Show this help message
+
+  Example:
+
+  bench.py -s 1000 -m 10 -o before.json
+  bench.py -s 1000 -m 10 -o after.json
+  bench.py -c before.json after.json
+""", file=sys.stderr)
+
+
+def main():
+    hiveconfig = {}
+    config = {"ops": 10000, "writes": 100, "repeat": 20, "seed": 0}
+    output = None
+    compare = 0
+    memory = 1
+    verbose = 0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:p:d:m:g:n:w:r:o:cMlV?",
+                                   ["sections=", "params=", "depth=", "mounts=",
+                                    "glob=", "ops=", "writes=", "repeat=",
+                                    "output=", "compare", "no-memory", "list",
+                                    "verbose", "help"])
+        for o, a in opts:
+            if o in ("-s", "--sections"):
+                hiveconfig["sections"] = int(a)
+            if o in ("-p", "--params"):
+                hiveconfig["params"] = int(a)
+            if o in ("-d", "--depth"):
+                hiveconfig["depth"] = max(1, int(a))
+            if o in ("-m", "--mounts"):
+                hiveconfig["mounts"] = int(a)
+            if o in ("-g", "--glob"):
+                hiveconfig["fanout"] = int(a)
+            if o in ("-n", "--ops"):
+                config["ops"] = int(a)
+            if o in ("-w", "--writes"):
+                config["writes"] = int(a)
+            if o in ("-r", "--repeat"):
+                config["repeat"] = int(a)
+            if o in ("-o", "--output"):
+                output = a
+            if o in ("-c", "--compare"):
+                compare = 1
+            if o in ("-M", "--no-memory"):
+                memory = 0
+            if o in ("-l", "--list"):
+                for (name, func) in BENCHMARKS:
+                    print(name)
+                sys.exit(0)
+            if o in ("-V", "--verbose"):
+                verbose = 1
+            if o in ("-?", "--help"):
+                usage()
+                sys.exit(0)
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(2)
+
+    if compare:
+        if len(args) != 2:
+            usage()
+            sys.exit(2)
+        results = []
+        for filename in args:
+            try:
+                with open(filename, encoding="UTF-8") as f:
+                    results.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print("%s: %s" % (filename, e), file=sys.stderr)
+                sys.exit(1)
+        compare_results(*results)
+        sys.exit(0)
+
+    known = [name for (name, func) in BENCHMARKS]
+    for name in args:
+        if name not in known:
+            print("%s: No such benchmark" % name, file=sys.stderr)
+            sys.exit(2)
+
+    # Store the complete hive configuration, so that runs can be compared
+    config["hive"] = dict(sections=100, params=10, depth=1, mounts=0, fanout=0)
+    config["hive"].update(hiveconfig)
+    data = run_benchmarks(config, args, memory, verbose)
+    print_results(data)
+    if output:
+        with open(output, "w", encoding="UTF-8") as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# -*-Python-*-
+"""Generate synthetic hives for benchmarking"""
+import os
+import sys
+import getopt
+
+# Parameter types, in the order they are given to the parameters of a
+# section, and a value for parameter number i of each type
+TYPES = ["string", "integer", "bool", "float", "integer_list"]
+
+def _make_value(paramtype, i):
+    if paramtype == "string":
+        return "value%d" % i
+    elif paramtype == "integer":
+        return str(i)
+    elif paramtype == "bool":
+        return ("false", "true")[i % 2]
+    elif paramtype == "float":
+        return "%d.5" % i
+    else:
+        return "%d %d %d" % (i, i + 1, i + 2)
+
+
+def section_path(i, depth):
+    """Get the path of section number i, with depth components"""
+    comps = ["s%d" % i] + ["d%d" % level for level in range(1, depth)]
+    return "/" + "/".join(comps)
+
+
+def generate_hive(directory, sections=100, params=10, depth=1, mounts=0,
+                  fanout=0):
+    """Write a hive to directory, and return a dict with its root file
+    ("root"), all its files ("files") and a list of (path, type) for
+    all its parameters ("params").
+
+    The sections are distributed round-robin over the root file, the
+    mounts files mounted by it and the fanout files mounted by a single
+    glob %mount."""
+    rootfile = os.path.join(directory, "root.hconf")
+    files = [rootfile]
+    for i in range(mounts):
+        files.append(os.path.join(directory, "mounts", "m%d.hconf" % i))
+    for i in range(fanout):
+        files.append(os.path.join(directory, "glob", "g%d.hconf" % i))
+    contents = [[] for f in files]
+
+    # Mounts come first, so that they are mounted on the root folder
+    header = contents[0]
+    header.append("# Generated by genhive.py\n")
+    for i in range(mounts):
+        header.append("%%mount mounts/m%d.hconf\n" % i)
+    if fanout:
+        header.append("%mount glob/*.hconf\n")
+
+    paramlist = []
+    for i in range(sections):
+        lines = contents[i % len(files)]
+        path = section_path(i, depth)
+        lines.append("\n[%s]\n" % path)
+        for j in range(params):
+            paramtype = TYPES[j % len(TYPES)]
+            lines.append("p%d = %s\n" % (j, _make_value(paramtype, i + j)))
+            paramlist.append(("%s/p%d" % (path, j), paramtype))
+
+    for (filename, lines) in zip(files, contents):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w", encoding="UTF-8") as f:
+            f.writelines(lines)
+
+    return {"root": rootfile, "files": files, "params": paramlist}
+
+
+def usage():
+    print("""
+genhive.py [options] directory
+
+Generate a synthetic hive in directory. The root hive is root.hconf.
+
+  -s,--sections <n>       Number of sections. Default is 100
+  -p,--params <n>         Parameters per section. Default is 10
+  -d,--depth <n>          Number of path components per section. Default is 1
+  -m,--mounts <n>         Number of files mounted with %mount. Default is 0
+  -g,--glob <n>           Number of files mounted with a single glob
+                          %mount. Default is 0
+  -?,--help               Show this help message
+""", file=sys.stderr)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:p:d:m:g:?",
+                                   ["sections=", "params=", "depth=", "mounts=",
+                                    "glob=", "help"])
+        options = {}
+        for o, a in opts:
+            if o in ("-s", "--sections"):
+                options["sections"] = int(a)
+            if o in ("-p", "--params"):
+                options["params"] = int(a)
+            if o in ("-d", "--depth"):
+                options["depth"] = max(1, int(a))
+            if o in ("-m", "--mounts"):
+                options["mounts"] = int(a)
+            if o in ("-g", "--glob"):
+                options["fanout"] = int(a)
+            if o in ("-?", "--help"):
+                usage()
+                sys.exit(0)
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(2)
+
+    if len(args) != 1:
+        usage()
+        sys.exit(2)
+
+    hive = generate_hive(args[0], **options)
+    print("%s: %d files, %d parameters" % (hive["root"], len(hive["files"]),
+                                          len(hive["params"])))
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,41 @@ import getopt
 import re
 import urllib.parse
 import binascii
+import pickle
+import tempfile
+import concurrent.futures
+import contextlib
+import threading
+import stat
+import time
+import atexit
+import weakref
+import struct
+import bisect
+import mmap
+import shlex
+import io
+import fnmatch
+import asyncio
+import functools
+import json
+import socket
+import socketserver
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on this platform
+    fcntl = None
+try:
+    import sqlite3
+except ImportError:
+    # No sqlite backend
+    sqlite3 = None
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # No shared memory snapshots
+    shared_memory = None
 
 class _DebugWriter:
     def __init__(self, debug):
@@ -60,6 +95,7 @@ class BadBinaryFormat(Error): pass
 class BadListFormat(Error): pass
 class ReadOnlySource(Error): pass
 class FolderNotEmpty(Error): pass
+class LockTimeout(Error): pass
     
 class SyntaxError(Error):
     def __init__(self, url, linenum):
@@ -95,6 +131,15 @@ def _path2comps(path):
     
     return path.split("/")
 
+def _normpath(path):
+    """Convert a path to a key in the root folder index. Same as
+    "/".join(_path2comps(path)), but faster. Not valid for "/"."""
+    if path.startswith("/"):
+        path = path[1:]
+    if path.endswith("/"):
+        path = path[:-1]
+    return path
+
 def _comps2path(comps):
     result = ""
     for component in comps:
@@ -122,13 +167,52 @@ def _fixup_sectionname(sn):
     return sn
 
 def _check_write_access(url):
-    if _get_url_scheme(url) == "file":
+    if _get_url_scheme(url) == "memory":
+        hive = _memory_hives.get(_get_memory_name(url))
+        return hive is not None and hive.writable
+    if _get_url_scheme(url) in ("file", "sqlite"):
         path = _get_url_path(url)
+        if os.path.isdir(path):
+            # Mounted with the filesystem backend, which is read only
+            return 0
         return os.access(path, os.W_OK)
+    elif _get_url_scheme(url) in _updaters:
+        try:
+            _updaters[_get_url_scheme(url)](url)
+        except ReadOnlySource:
+            return 0
+        return 1
     else:
         # Cannot write to other URLs, currently
         return 0
 
+# Per thread state. recorder is set while a transaction is active,
+# and collects writes instead of performing them.
+_scope = threading.local()
+
+def _current_recorder():
+    return getattr(_scope, "recorder", None)
+
+def _record_undo(action):
+    """Register action to be called if the current transaction fails"""
+    recorder = _current_recorder()
+    if recorder is not None:
+        recorder.add_undo(action)
+
+def _open_updater(url):
+    """Get an updater for url. While a transaction is active, or
+    during a write to a tree in write-behind mode, the changes are
+    recorded rather than written."""
+    recorder = _current_recorder()
+    if recorder is None:
+        recorder = getattr(_scope, "queue", None)
+    if recorder is not None:
+        return _RecordingUpdater(recorder, url)
+    return _make_updater(url)
+
+def _make_updater(url):
+    return _updaters.get(_get_url_scheme(url), _HiveFileUpdater)(url)
+
 _glob_magic_check = re.compile('[*?[]')
 def _has_glob_wildchars(s):
     return _glob_magic_check.search(s) is not None
@@ -146,6 +230,8 @@ class Parameter(NamespaceObject):
     def __init__(self, value, source, sectionname, paramname, write_target):
         # This parameters value, in the external string representation
         self._value = value
+        # Memoized results of the get methods, see _decode()
+        self._decoded = {}
         # URL that this parameter was read from
         if not source:
             raise Error("Empty source file!")
@@ -166,7 +252,7 @@ class Parameter(NamespaceObject):
             print("write_new(%s): no write_target" % self.paramname, file=debugw)
             return 0
         
-        hfu = _HiveFileUpdater(self.write_target)
+        hfu = _open_updater(self.write_target)
         hfu.add_parameter(self.sectionname, self.paramname, self._value)
         return 1
 
@@ -181,7 +267,7 @@ class Parameter(NamespaceObject):
             # was read from, we should add, not change
             return self.write_new()
         else:
-            hfu = _HiveFileUpdater(self.write_target)
+            hfu = _open_updater(self.write_target)
             hfu.change_parameter(self.sectionname, self.paramname,
                                  self._value, delete_param=delete)
 
@@ -196,106 +282,133 @@ class Parameter(NamespaceObject):
 
     def get_bool(self):
         """Get boolean value"""
-        try:
-            return self._string2bool(self._value)
-        except ValueError:
-            raise BadBoolFormat()
+        return self._decode("bool", self._string2bool, BadBoolFormat)
     
     def get_integer(self):
         """Get integer value"""
-        try:
-            return int(self._value)
-        except ValueError:
-            raise BadIntegerFormat()
+        return self._decode("integer", int, BadIntegerFormat)
 
     def get_float(self):
         """Get float value"""
-        try:
-            return float(self._value)
-        except ValueError:
-            raise BadFloatFormat()
+        return self._decode("float", float, BadFloatFormat)
 
     def get_binary(self):
         """Get binary value"""
-        try:
-            return self._hexascii2bytes(self._value)
-        except ValueError:
-            raise BadBinaryFormat()
+        return self._decode("binary", self._hexascii2bytes, BadBinaryFormat)
 
     #
     # Compound data types, get operations
     #
+    # The cached lists are copied, so that callers can modify the result
     def get_string_list(self):
-        return self._value.split()
+        return list(self._decode("string_list", str.split, ValueError))
 
     def get_bool_list(self):
-        return list(map(self._string2bool, self._value.split()))
+        return list(self._decode("bool_list",
+                                 lambda s: list(map(self._string2bool, s.split())),
+                                 ValueError))
 
     def get_integer_list(self):
-        return list(map(int, self._value.split()))
+        return list(self._decode("integer_list",
+                                 lambda s: list(map(int, s.split())),
+                                 ValueError))
 
     def get_float_list(self):
-        return list(map(float, self._value.split()))
+        return list(self._decode("float_list",
+                                 lambda s: list(map(float, s.split())),
+                                 ValueError))
 
     def get_binary_list(self):
-        return list(map(self._hexascii2bytes, self._value.split()))
+        return list(self._decode("binary_list",
+                                 lambda s: list(map(self._hexascii2bytes, s.split())),
+                                 ValueError))
 
     #
     # Primitive data types, set operations
     #
     def set_string(self, new_value):
         """Set string value"""
-        self._value = new_value
+        self._assign(new_value)
 
     def set_bool(self, new_value):
         """Set bool value"""
-        self._value = self._bool2string(new_value)
+        self._assign(self._bool2string(new_value))
 
     def set_integer(self, new_value):
         """Set integer value"""
-        self._value = str(new_value)
+        self._assign(str(new_value))
 
     def set_float(self, new_value):
         """Set float value"""
-        self._value = str(new_value)
+        self._assign(str(new_value))
 
     def set_binary(self, new_value):
         """Set binary value"""
-        self._value = self._bytes2hexascii(new_value)
+        self._assign(self._bytes2hexascii(new_value))
 
     #
     # Compound data types, set operations
     #
     def set_string_list(self, new_value):
         """Set string list value"""
-        self._value = " ".join(new_value)
+        self._assign(" ".join(new_value))
     
     def set_bool_list(self, new_value):
         """Set bool list value"""
-        self._value = " ".join(map(self._bool2string, new_value))
+        self._assign(" ".join(map(self._bool2string, new_value)))
 
     def set_integer_list(self, new_value):
         """Set integer list value"""
-        self._value = " ".join(map(str, new_value))
+        self._assign(" ".join(map(str, new_value)))
 
     def set_float_list(self, new_value):
         """Set float list value"""
-        self._value = " ".join(map(str, new_value))
+        self._assign(" ".join(map(str, new_value)))
 
     def set_binary_list(self, new_value):
         """Set binary list value"""
-        self._value = " ".join(map(self._bytes2hexascii, new_value))
+        self._assign(" ".join(map(self._bytes2hexascii, new_value)))
 
     #
     # Internal methods
     #
+    def _assign(self, value):
+        """Set the string value and forget decoded values"""
+        self._value = value
+        self._decoded = {}
+
+    def _decode(self, kind, decoder, error):
+        """Decode the value with decoder. The result, or the fact that
+        decoding failed, is remembered per kind until the next set. A
+        ValueError from decoder is raised as error, or unchanged if
+        error is ValueError."""
+        try:
+            (ok, result) = self._decoded[kind]
+        except KeyError:
+            try:
+                (ok, result) = (1, decoder(self._value))
+            except ValueError as e:
+                if error is ValueError:
+                    (ok, result) = (0, (type(e), e.args))
+                else:
+                    (ok, result) = (0, (error, ()))
+            self._decoded[kind] = (ok, result)
+
+        if not ok:
+            (exc_class, args) = result
+            raise exc_class(*args)
+        return result
+
     def _bool2string(self, value):
         """Convert a Python bool value to 'true' or 'false'"""
         return value and "true" or "false"
         
     def _bytes2hexascii(self, b):
         """Convert bytes to hexascii"""
-        result = binascii.hexlify(b)
+        try:
+            result = binascii.hexlify(b)
+        except TypeError as e:
+            raise BadBinaryFormat(str(e))
         return result.decode('ascii')
 
     def _hexascii2bytes(self, s):
@@ -319,11 +432,103 @@ class Parameter(NamespaceObject):
             raise ValueError()
             
 
+class _RWLock:
+    """Reader/writer lock. Any number of threads may hold the read
+    lock at the same time, or one thread the write lock. Both are
+    reentrant, and the thread holding the write lock may also take the
+    read lock. Waiting writers block new readers, so that writers are
+    not starved."""
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        # Per thread nesting level of read()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def read(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, "depth", 0):
+            raise RuntimeError("cannot upgrade a read lock")
+
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+
 class Folder(NamespaceObject):
     """A folder. Does not contain the name of the folder itself."""
     def __init__(self, source, write_target, sectionname):
         self._folders = {}
         self._parameters = {}
+        # Lazy mounts not yet parsed into this folder, sorted in
+        # declaration order.
+        self._mounts = []
+        # The root folder of the tree this folder is part of, and the
+        # index key prefix of this folder
+        self._root = self
+        self._prefix = ""
+        # Root folder only: dict from _normpath() of every object in the
+        # tree to the object, or None if not enabled. Number of pending
+        # lazy mounts in the tree; the index is not complete until they
+        # have been parsed.
+        self._index = None
+        self._pending = 0
+        # Root folder only: _WriteBehind queue, if enabled
+        self._queue = None
+        # Root folder only, in thread-safe mode: _RWLock held by
+        # readers and writers of the tree, and lock held while objects
+        # are loaded into it, which readers may do as well
+        self._lock = None
+        self._load_lock = None
+        # Root folder only, in thread-safe mode: _WriteOrder for files
+        # written after the tree has been changed, see _writing()
+        self._write_order = None
+        # List of (store, path) for databases mounted on this folder,
+        # see _SqliteStore. Objects are loaded from them on first use.
+        # _stores_loaded is true when all have been loaded.
+        self._stores = []
+        self._stores_loaded = 0
         # List of URLs that has contributed to this Folder.
         self.sources = []
         # URL to write to when adding new folder objects.
@@ -348,17 +553,56 @@ class Folder(NamespaceObject):
             self.write_target = write_target
 
     def _write_new_section(self):
-        hfu = _HiveFileUpdater(self.write_target)
+        hfu = _open_updater(self.write_target)
         hfu.add_section(self.sectionname)
 
     def _write_delete_section(self):
-        hfu = _HiveFileUpdater(self.write_target)
+        hfu = _open_updater(self.write_target)
         return hfu.delete_section(self.sectionname)
 
+    def _enable_index(self):
+        """Maintain a path index in this root folder"""
+        self._index = {}
+        for (name, obj) in self._items():
+            self._index_object(obj, self._prefix + name)
+
+    def _index_object(self, obj, key):
+        if obj is self._root:
+            return
+        if self._root._index is not None:
+            self._root._index[key] = obj
+        if isinstance(obj, Folder):
+            obj._root = self._root
+            obj._prefix = key + "/"
+            # Only non-empty when re-adding a deleted subtree
+            for (name, child) in obj._items():
+                obj._index_object(child, obj._prefix + name)
+
+    def _unindex_object(self, objname):
+        index = self._root._index
+        if index is not None:
+            obj = index.pop(self._prefix + objname, None)
+            if isinstance(obj, Folder):
+                for (name, child) in obj._items():
+                    obj._unindex_object(name)
+
+    def _remove_object(self, objname):
+        """Remove object from memory only. Used for rollback."""
+        if objname in self._folders:
+            del self._folders[objname]
+        else:
+            del self._parameters[objname]
+        self._unindex_object(objname)
+
+    def _items(self):
+        return list(self._folders.items()) + list(self._parameters.items())
+
     def _addobject(self, obj, objname):
         if self._exists(objname):
             raise ObjectExistsError
+        self._insert_object(obj, objname)
 
+    def _insert_object(self, obj, objname):
         if isinstance(obj, Parameter):
             print("Adding parameter", objname, file=debugw)
             self._parameters[objname] = obj
@@ -368,11 +612,216 @@ class Folder(NamespaceObject):
         else:
             raise InvalidObjectError
 
+        self._index_object(obj, self._prefix + objname)
+
+    def _add_mount(self, mount):
+        index = len(self._mounts)
+        while index > 0 and mount.seq < self._mounts[index - 1].seq:
+            index -= 1
+        self._mounts.insert(index, mount)
+        self._root._pending += 1
+
+    def _resolve_mounts(self):
+        """Parse the lazy mounts of this folder that are due, in
+        declaration order. When called while a hive is being parsed,
+        only mounts declared before the current position are due. This
+        gives the same precedence as parsing all mounts eagerly."""
+        with self._loading():
+            while self._mounts and self._mounts[0].is_due():
+                mount = self._mounts.pop(0)
+                self._root._pending -= 1
+                mount.resolve(self)
+
+    def _loading(self):
+        """Lock for loading objects into the tree"""
+        lock = self._root._load_lock
+        if lock is None:
+            return contextlib.nullcontext()
+        return lock
+
+    def _add_store(self, store, path):
+        self._stores.append((store, path))
+        self._stores_loaded = 0
+
+    def _mount_store(self, store, path):
+        """Add store, mounted on this folder at path. Folders below
+        this one which already exist get it too, so that the objects it
+        has in them are found."""
+        self._add_store(store, path)
+        for (name, subfolder) in list(self._folders.items()):
+            if subfolder is not self and name != "/":
+                subfolder._mount_store(store, store.join(path, name))
+
+    def _new_target(self):
+        """Get (write_target, sectionname) for new objects in this
+        folder. A writable database mounted here takes precedence."""
+        for (store, path) in self._stores:
+            if store.writable:
+                return (store.url, path)
+        return (self.write_target, self.sectionname)
+
+    def _load_object(self, objname):
+        """Load objname from the stores of this folder. Returns None if
+        it does not exist."""
+        with self._loading():
+            if self._stores_loaded:
+                return None
+            # Another thread may have loaded it
+            obj = self._folders.get(objname) or self._parameters.get(objname)
+            if obj is not None:
+                return obj
+            for (store, path) in self._stores:
+                if not store.point_lookups:
+                    # Cannot look up single objects
+                    self._load_children()
+                    return self._folders.get(objname) or self._parameters.get(objname)
+                obj = store.load_object(self, path, objname)
+                if obj is not None:
+                    self._insert_object(obj, objname)
+                    return obj
+            return None
+
+    def _load_children(self):
+        """Make _folders and _parameters complete, before they are
+        listed"""
+        self._resolve_mounts()
+        with self._loading():
+            if self._stores and not self._stores_loaded:
+                for (store, path) in self._stores:
+                    for (name, obj) in store.load_children(self, path):
+                        if not (name in self._folders or name in self._parameters):
+                            self._insert_object(obj, name)
+                self._stores_loaded = 1
+
     def _get_object(self, objname):
-        return self._folders.get(objname) or self._parameters.get(objname)
+        if self._mounts:
+            self._resolve_mounts()
+        obj = self._folders.get(objname) or self._parameters.get(objname)
+        if obj is None and self._stores:
+            obj = self._load_object(objname)
+        return obj
         
     def _exists(self, objname):
-        return objname in self._folders or objname in self._parameters
+        if self._mounts:
+            self._resolve_mounts()
+        if objname in self._folders or objname in self._parameters:
+            return True
+        return bool(self._stores) and self._load_object(objname) is not None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager which buffers all writes made by this
+        thread, and writes them on exit, with one rewrite per file. If
+        an exception occurs, nothing is written and all changes to the
+        tree are undone. Nested transactions are part of the outermost
+        one."""
+        if _current_recorder() is not None:
+            yield
+            return
+
+        # Other threads must not see the tree while it may be rolled
+        # back
+        with self._locked(write=1):
+            transaction = _Transaction()
+            _scope.recorder = transaction
+            try:
+                yield
+                # Writes during commit must not be recorded
+                _scope.recorder = None
+                # Earlier writes must not overwrite the ones committed now
+                self.flush()
+                transaction.commit()
+            except BaseException:
+                _scope.recorder = None
+                transaction.rollback()
+                raise
+            finally:
+                _scope.recorder = None
+
+    def _enable_threadsafe(self):
+        """Make this root folder thread-safe, see open_hive()"""
+        self._lock = _RWLock()
+        self._load_lock = threading.RLock()
+        self._write_order = _WriteOrder()
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Hold the write lock in thread-safe mode, and queue the
+        writes made by the caller if the tree is in write-behind
+        mode"""
+        root = self._root
+        if root._lock is not None and root._queue is None \
+           and _current_recorder() is None \
+           and getattr(_scope, "queue", None) is None:
+            with self._writing_unlocked():
+                yield
+            return
+
+        with self._locked(write=1):
+            queue = self._root._queue
+            if queue is None or getattr(_scope, "queue", None) is not None:
+                yield
+                return
+
+            queue.check()
+            _scope.queue = queue
+            try:
+                yield
+            finally:
+                _scope.queue = None
+
+    @contextlib.contextmanager
+    def _writing_unlocked(self):
+        """In thread-safe mode, change the tree with the write lock
+        held, but write the files after it has been released, so that
+        readers never wait for file I/O. Files are written in the order
+        the tree was changed. If writing fails, the changes to the tree
+        are undone, unless it has been changed again since."""
+        root = self._root
+        transaction = _Transaction()
+        with root._lock.write():
+            _scope.recorder = transaction
+            try:
+                yield
+            except BaseException:
+                _scope.recorder = None
+                transaction.rollback()
+                raise
+            finally:
+                _scope.recorder = None
+            ticket = root._write_order.take()
+
+        try:
+            with root._write_order.turn(ticket):
+                transaction.commit()
+        except BaseException:
+            with root._lock.write():
+                if root._write_order.last() == ticket:
+                    transaction.rollback()
+            raise
+
+    def _locked(self, write=0):
+        """Take the read or write lock of the tree, in thread-safe
+        mode"""
+        lock = self._root._lock
+        if lock is None:
+            return contextlib.nullcontext()
+        if write:
+            return lock.write()
+        return lock.read()
+
+    def flush(self):
+        """Write all changes queued in write-behind mode"""
+        if self._root._queue is not None:
+            self._root._queue.flush()
+
+    def close(self):
+        """Write all changes queued in write-behind mode, and leave
+        write-behind mode"""
+        queue = self._root._queue
+        if queue is not None:
+            queue.close()
+            self._root._queue = None
 
     #
     # Get methods
@@ -382,78 +831,156 @@ class Folder(NamespaceObject):
         if default == None:
             default = []
 
-        folder = self.lookup(folderpath)
+        with self._locked():
+            folder = self.lookup(folderpath)
 
-        if not folder:
-            return default
-        else:
-            return list(folder._folders.keys())
+            if not folder:
+                return default
+            else:
+                folder._load_children()
+                return list(folder._folders.keys())
 
     def get_parameters(self, folderpath, default=None):
         """Get parameter names in this folder"""
         if default == None:
             default = []
 
-        folder = self.lookup(folderpath)
-        if not folder:
-            return default
-        else:
-            return list(folder._parameters.keys())
+        with self._locked():
+            folder = self.lookup(folderpath)
+            if not folder:
+                return default
+            else:
+                folder._load_children()
+                return list(folder._parameters.keys())
+
+    def walk(self, topdown=True, prune=None, depth=None):
+        """Walk the tree below this folder, like os.walk(). Yields
+        (path, folder, params, subfolders) for this folder and every
+        folder below it. path is relative to this folder, params is a
+        list of (name, Parameter) and subfolders a list of (name,
+        Folder). If topdown is true, a folder is yielded before its
+        subfolders, which may then be removed from subfolders to skip
+        them. prune(path, folder) is called for each subfolder, and
+        if it returns true, the subfolder is skipped. If depth is
+        given, folders more than depth levels below this folder are
+        skipped."""
+        return self._walk("/", topdown, prune, depth)
+
+    def _walk(self, path, topdown, prune, depth):
+        with self._locked():
+            self._load_children()
+            params = list(self._parameters.items())
+            # The root folder contains itself as "/". A "[/]" section
+            # in a mounted file also makes a folder called "/", which
+            # cannot be looked up.
+            subfolders = [(name, folder) for (name, folder) in self._folders.items()
+                          if name != "/"]
+        if topdown:
+            yield (path, self, params, subfolders)
+        for (name, subfolder) in subfolders:
+            subpath = path.rstrip("/") + "/" + name
+            if depth is not None and depth <= 0:
+                continue
+            if prune is not None and prune(subpath, subfolder):
+                continue
+            yield from subfolder._walk(subpath, topdown, prune,
+                                       None if depth is None else depth - 1)
+        if not topdown:
+            yield (path, self, params, subfolders)
 
     def delete(self, path, recursive=0):
-        obj = self.lookup(path)
+        with self._writing():
+            obj = self.lookup(path)
 
-        if not obj:
-            return 0
+            if not obj:
+                return 0
 
-        comps = _path2comps(path)
+            comps = _path2comps(path)
 
-        if [] != comps[:-1]:
-            parentfolder = self._lookup_list(comps[:-1])
-        else:
-            parentfolder = self
+            if [] != comps[:-1]:
+                parentfolder = self._lookup_list(comps[:-1])
+            else:
+                parentfolder = self
 
-        if isinstance(obj, Parameter):
-            return parentfolder._delete_param(comps[-1])
-        else:
-            subfolders = list(obj._folders.keys())
-            subparams = list(obj._parameters.keys())
+            if isinstance(obj, Parameter):
+                return parentfolder._delete_param(comps[-1])
+            else:
+                obj._load_children()
+                subfolders = list(obj._folders.keys())
+                subparams = list(obj._parameters.keys())
 
-            if ([] != subfolders or [] != subparams) and not recursive:
-                raise FolderNotEmpty
+                if ([] != subfolders or [] != subparams) and not recursive:
+                    raise FolderNotEmpty
 
-            return parentfolder._delete_folder(comps[-1])
+                return parentfolder._delete_folder(comps[-1])
 
     def _delete_folder(self, foldername):
         print(self, "_delete_folder(\"%s\")" % foldername, file=debugw)
         folder = self._folders[foldername]
-        for (subfoldername, subfolder) in list(folder._folders.items()):
-            if "/" == subfoldername:
-                continue
-            folder._delete_folder(subfoldername)
-        for (subparamname, subparam) in list(folder._parameters.items()):
-            folder._delete_param(subparamname)
 
-        self._folders[foldername]._write_delete_section()
+        # Remove the whole subtree with one rewrite per file
+        deletions = {}
+        folder._collect_deletions(deletions)
+        for (url, (sectionnames, params)) in deletions.items():
+            hfu = _open_updater(url)
+            hfu.delete_objects(sectionnames, params)
+
         del self._folders[foldername]
+        self._unindex_object(foldername)
+        folder._prefix = ""
+        folder._set_root(folder)
+        _record_undo(lambda: self._insert_object(folder, foldername))
         return 1
 
+    def _collect_deletions(self, deletions):
+        """Add the sections and parameter lines of this subtree to
+        deletions, a dict from write target to (sectionnames, params)"""
+        self._resolve_mounts()
+        if self.write_target:
+            deletions.setdefault(self.write_target, ([], []))[0].append(self.sectionname)
+        # Objects not loaded from the stores are deleted with the
+        # folder they are in
+        for (store, path) in self._stores:
+            if store.writable and \
+               (store.url, _fixup_sectionname(path)) != \
+               (self.write_target, _fixup_sectionname(self.sectionname)):
+                deletions.setdefault(store.url, ([], []))[0].append(path)
+        for (subfoldername, subfolder) in self._folders.items():
+            if "/" == subfoldername:
+                continue
+            subfolder._collect_deletions(deletions)
+        for param in self._parameters.values():
+            # Parameters read from other files cannot be removed
+            if param.write_target and param.source == param.write_target:
+                deletions.setdefault(param.write_target, ([], []))[1].append(
+                    (param.sectionname, param.paramname))
+
+    def _set_root(self, root):
+        for (subfoldername, subfolder) in self._folders.items():
+            if subfolder is not self:
+                subfolder._set_root(root)
+        self._root = root
+
     def _delete_param(self, paramname):
         print(self, "_delete_param(\"%s\")" % paramname, file=debugw)
-        self._parameters[paramname].write_update(delete=1)
+        param = self._parameters[paramname]
+        param.write_update(delete=1)
         del self._parameters[paramname]
+        self._unindex_object(paramname)
+        _record_undo(lambda: self._insert_object(param, paramname))
         return 1
 
     def _get_value(self, parampath, default, method):
-        param = self.lookup(parampath)
+        with self._locked():
+            param = self.lookup(parampath)
 
-        if not param:
-            return default
-        else:
-            # Check if param really is a Parameter
-            if not isinstance(param, Parameter):
-                raise NotAParameterError()
-            return method(param)
+            if not param:
+                return default
+            else:
+                # Check if param really is a Parameter
+                if not isinstance(param, Parameter):
+                    raise NotAParameterError()
+                return method(param)
 
     def get_string(self, parampath, default=None):
         return self._get_value(parampath, default, Parameter.get_string)
@@ -489,27 +1016,37 @@ class Folder(NamespaceObject):
     # Set methods
     #
     def _set_value(self, parampath, value, method):
-        comps = _path2comps(parampath)
-        folder_comps = comps[:-1]
-        if folder_comps:
-            folder = self._lookup_list(folder_comps, autocreate=1)
-        else:
-            folder = self
-        paramname = comps[-1]
-        param = folder.lookup(paramname)
-        if not param:
-            # Create new parameter
-            param = Parameter(None, folder.write_target,
-                              folder.sectionname, paramname, folder.write_target)
-            # Set the value
-            method(param, value)
-            folder._addobject(param, paramname)
-            # Write new parameter to disk
-            return param.write_new()
-        else:
-            # Update existing parameter
-            method(param, value)
-            return param.write_update()
+        with self._writing():
+            comps = _path2comps(parampath)
+            folder_comps = comps[:-1]
+            if folder_comps:
+                folder = self._lookup_list(folder_comps, autocreate=1)
+                if not isinstance(folder, Folder):
+                    # The path goes through a parameter
+                    raise ObjectExistsError
+            else:
+                folder = self
+            paramname = comps[-1]
+            param = folder.lookup(paramname)
+            if isinstance(param, Folder):
+                raise NotAParameterError()
+            if not param:
+                # Create new parameter
+                (write_target, sectionname) = folder._new_target()
+                param = Parameter(None, write_target,
+                                  sectionname, paramname, write_target)
+                # Set the value
+                method(param, value)
+                folder._addobject(param, paramname)
+                _record_undo(lambda: folder._remove_object(paramname))
+                # Write new parameter to disk
+                return param.write_new()
+            else:
+                # Update existing parameter
+                old_value = param._value
+                method(param, value)
+                _record_undo(lambda: param._assign(old_value))
+                return param.write_update()
 
     def set_string(self, parampath, value):
         return self._set_value(parampath, value, Parameter.set_string)
@@ -541,10 +1078,94 @@ class Folder(NamespaceObject):
     def set_binary_list(self, parampath, value):
         return self._set_value(parampath, value, Parameter.set_binary_list)
 
+    #
+    # asyncio methods
+    #
+    async def _async_write(self, path, function, *args):
+        """Run function(*args) in the default executor, after the
+        earlier async writes to the same file"""
+        loop = asyncio.get_running_loop()
+        async with _get_async_lock(loop, self._guess_write_target(path)):
+            return await loop.run_in_executor(None, functools.partial(function, *args))
+
+    def _guess_write_target(self, path):
+        """Get the URL that a write to path will most likely go to,
+        without loading anything"""
+        folder = self
+        for comp in _path2comps(path):
+            obj = folder._folders.get(comp) or folder._parameters.get(comp)
+            if isinstance(obj, Parameter):
+                return obj.write_target
+            if obj is None:
+                break
+            folder = obj
+        return folder._new_target()[0]
+
+    async def aset_string(self, parampath, value):
+        return await self._async_write(parampath, self.set_string, parampath, value)
+
+    async def aset_bool(self, parampath, value):
+        return await self._async_write(parampath, self.set_bool, parampath, value)
+
+    async def aset_integer(self, parampath, value):
+        return await self._async_write(parampath, self.set_integer, parampath, value)
+
+    async def aset_float(self, parampath, value):
+        return await self._async_write(parampath, self.set_float, parampath, value)
+
+    async def aset_binary(self, parampath, value):
+        return await self._async_write(parampath, self.set_binary, parampath, value)
+
+    async def aset_string_list(self, parampath, value):
+        return await self._async_write(parampath, self.set_string_list, parampath, value)
+
+    async def aset_bool_list(self, parampath, value):
+        return await self._async_write(parampath, self.set_bool_list, parampath, value)
+
+    async def aset_integer_list(self, parampath, value):
+        return await self._async_write(parampath, self.set_integer_list, parampath, value)
+
+    async def aset_float_list(self, parampath, value):
+        return await self._async_write(parampath, self.set_float_list, parampath, value)
+
+    async def aset_binary_list(self, parampath, value):
+        return await self._async_write(parampath, self.set_binary_list, parampath, value)
+
+    async def adelete(self, path, recursive=0):
+        return await self._async_write(path, self.delete, path, recursive)
+
+    async def aflush(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.flush)
+
     def lookup(self, objpath, autocreate=0):
         """Lookup an object. objname is like global/settings/background
         Returns None if object is not found.
         """
+        if autocreate:
+            with self._writing():
+                return self._lookup(objpath, autocreate)
+        with self._locked():
+            return self._lookup(objpath, autocreate)
+
+    def _lookup(self, objpath, autocreate):
+        root = self._root
+        if root._index is not None and not root._pending \
+           and not autocreate and objpath != "/":
+            key = self._prefix + _normpath(objpath)
+            obj = root._index.get(key)
+            if obj is not None:
+                return obj
+            # If the parent is a known folder, the object does not
+            # exist. Otherwise, let _lookup_list() decide, since it
+            # raises ObjectExistsError for paths through a parameter.
+            if "/" in key:
+                parent = root._index.get(key.rpartition("/")[0])
+            else:
+                parent = root
+            if isinstance(parent, Folder) and not parent._stores:
+                return None
+
         comps = _path2comps(objpath)
         return self._lookup_list(comps, autocreate)
 
@@ -567,9 +1188,11 @@ class Folder(NamespaceObject):
 
         create_folder = not obj and autocreate
         if create_folder:
-            obj = Folder(None, self.write_target,
-                         os.path.join(self.sectionname, obj_name))
+            (write_target, parent_sectionname) = self._new_target()
+            obj = Folder(None, write_target,
+                         os.path.join(parent_sectionname, obj_name))
             self._addobject(obj, obj_name)
+            _record_undo(lambda: self._remove_object(obj_name))
 
         if not obj:
             return
@@ -591,10 +1214,161 @@ class Folder(NamespaceObject):
             return obj._lookup_list(rest_comps, autocreate, sectionname)
 
 
-def open_hive(url, blacklist=None):
+def open_hive(url, blacklist=None, cache=None, lazy=0, workers=0,
+              write_behind=0, threadsafe=0):
+    rootfolder = _open_hive(url, blacklist, cache, lazy, workers)
+    if write_behind and rootfolder:
+        rootfolder._queue = _WriteBehind(write_behind)
+    if threadsafe and rootfolder:
+        rootfolder._enable_threadsafe()
+    return rootfolder
+
+async def open_hive_async(url, blacklist=None, cache=None, lazy=0, workers=0,
+                          write_behind=0):
+    """Like open_hive(), but parse in the default executor. The tree is
+    thread-safe, so that it can be read while async writes are done in
+    other threads."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(open_hive, url, blacklist, cache, lazy,
+                                workers, write_behind, threadsafe=1))
+
+# Event loop -> dict from URL to asyncio.Lock, serializing async writes
+_async_locks = weakref.WeakKeyDictionary()
+
+def _get_async_lock(loop, url):
+    locks = _async_locks.setdefault(loop, {})
+    lock = locks.get(url)
+    if lock is None:
+        lock = locks[url] = asyncio.Lock()
+    return lock
+
+def _open_hive(url, blacklist, cache, lazy, workers):
     # Relative URLs should be resolved relative to _get_cwd_url().
-    hfp = _HiveFileParser(urllib.parse.urljoin(_get_cwd_url(), url), blacklist)
-    return hfp.parse()
+    url = urllib.parse.urljoin(_get_cwd_url(), url)
+    if cache:
+        rootfolder = _load_snapshot(cache, url, blacklist)
+        if rootfolder:
+            return rootfolder
+
+    hfp = _HiveFileParser(url, blacklist)
+    if cache:
+        # A snapshot must describe the complete tree
+        hfp.dependencies = {}
+    else:
+        hfp.lazy = lazy
+    hfp.workers = workers
+    rootfolder = hfp.parse()
+
+    if cache and rootfolder:
+        _save_snapshot(cache, url, blacklist,
+                       list(hfp.dependencies.items()), rootfolder)
+    return rootfolder
+
+
+#
+# Snapshot cache
+#
+# A snapshot is a pickle file holding a header followed by the parsed
+# Folder tree. The header lists every file the parser touched together
+# with its size and times, so that staleness can be decided with one
+# stat() per dependency, before the tree itself is unpickled. The
+# ctime is included since a chmod changes the write_target of objects
+# without touching the mtime.
+#
+_SNAPSHOT_MAGIC = "hiveconf-snapshot"
+_SNAPSHOT_VERSION = 4
+
+def _stat_key(path):
+    """Get (size, mtime, ctime) for path, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+def _dependency_key(path):
+    if path.startswith("memory://"):
+        return get_memory_hive(_get_memory_name(path))
+    if path.startswith("environ:"):
+        # The value of the variable, see _EnvironStore
+        return _read_environ(path[len("environ:"):])[0]
+    return _stat_key(path)
+
+def _snapshot_header(url, blacklist, dependencies):
+    return (_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, url, list(blacklist or []),
+            os.geteuid(), dependencies)
+
+def _load_snapshot(cachefile, url, blacklist):
+    """Load a snapshot. Returns None if missing, invalid or stale."""
+    try:
+        with open(cachefile, "rb") as f:
+            header = pickle.load(f)
+            (magic, version, c_url, c_blacklist, c_euid, deps) = header
+            if (magic, version, c_url, c_blacklist, c_euid) != \
+               _snapshot_header(url, blacklist, None)[:5]:
+                print("Snapshot", cachefile, "does not match", file=debugw)
+                return None
+            for (path, key) in deps:
+                if _dependency_key(path) != key:
+                    print("Snapshot", cachefile, "is stale:", path, file=debugw)
+                    return None
+            return pickle.load(f)
+    except (OSError, EOFError, ValueError, TypeError,
+            pickle.UnpicklingError, AttributeError, ImportError):
+        # A broken cache is never fatal; we just parse again.
+        return None
+
+def _save_snapshot(cachefile, url, blacklist, dependencies, rootfolder):
+    """Write snapshot atomically. Failures are ignored."""
+    cachedir = os.path.dirname(os.path.abspath(cachefile))
+    try:
+        (fd, tmpname) = tempfile.mkstemp(dir=cachedir, prefix=".hivecache")
+    except OSError:
+        print("Couldn't create snapshot in", cachedir, file=debugw)
+        return
+    replaced = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(_snapshot_header(url, blacklist, dependencies), f,
+                        pickle.HIGHEST_PROTOCOL)
+            pickle.dump(rootfolder, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, cachefile)
+        replaced = 1
+    except Exception:
+        # Backends may hold objects which cannot be pickled, which
+        # raises TypeError and others
+        print("Couldn't write snapshot", cachefile, file=debugw)
+    finally:
+        if not replaced:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+
+
+class _LazyMount:
+    """A hivefile %mount that has not been parsed yet"""
+    def __init__(self, parser, url, seq):
+        self.parser = parser
+        self.url = url
+        self.seq = seq
+
+    def __repr__(self):
+        return "<_LazyMount: %s  seq=%s>" % (self.url, self.seq)
+
+    def is_due(self):
+        position = self.parser._position
+        return position is None or self.seq <= position
+
+    def resolve(self, folder):
+        print("Resolving lazy mount", self.url, file=debugw)
+        saved_position = self.parser._position
+        self.parser._position = self.seq + (0,)
+        try:
+            self.parser.parse(self.url, folder)
+        finally:
+            self.parser._position = saved_position
 
 
 class _HiveFileParser:
@@ -605,6 +1379,26 @@ class _HiveFileParser:
             self.blacklist = []
         else:
             self.blacklist = blacklist
+        # When not None, a dict mapping every path that the result
+        # depends on to its _stat_key(). Used by the snapshot cache.
+        self.dependencies = None
+        # If true, hivefile mounts are parsed on first use
+        self.lazy = 0
+        # Declaration position of the last %mount, as a tuple which
+        # sorts in the order an eager parse would visit the mounts.
+        # None when no parse is in progress.
+        self._position = None
+        # Number of threads used for reading glob-expanded mounts
+        self.workers = 0
+        # url -> Future with (stat_key, tokens), see _prefetch()
+        self._prefetched = {}
+
+    def _add_dependency(self, path, stat_key=None):
+        if self.dependencies is None or path in self.dependencies:
+            return
+        if stat_key is None:
+            stat_key = _dependency_key(path)
+        self.dependencies[path] = stat_key
 
     def parse(self, url=None, rootfolder=None):
         """Open and parse a hive file. Returns a folder"""
@@ -614,12 +1408,41 @@ class _HiveFileParser:
         if not rootfolder:
             rootfolder = Folder(url, url, "/")
             rootfolder._addobject(rootfolder, "/")
+            rootfolder._enable_index()
+            self._position = (0,)
+            try:
+                return self._parse_url(url, rootfolder)
+            finally:
+                self._position = None
 
+        return self._parse_url(url, rootfolder)
+
+    def _parse_url(self, url, rootfolder):
         print("Opening URL", url, file=debugw)
+        prefetched = self._prefetched.pop(url, None)
         try:
-            if _get_url_scheme(url) == "file" or _get_url_scheme(url) == "":
-                with open(_get_url_path(url), "r", encoding="UTF-8") as file:
-                    self._parse_file(file, rootfolder, url)
+            if prefetched:
+                (stat_key, tokens) = prefetched.result()
+                self._add_dependency(_get_url_path(url), stat_key)
+            elif _get_url_scheme(url) == "memory":
+                hive = _memory_hives.get(_get_memory_name(url))
+                if hive is None:
+                    return
+                with hive.lock:
+                    text = hive.text
+                self._add_dependency(url, text)
+                self._parse_file(io.StringIO(text, newline=""), rootfolder, url)
+                return rootfolder
+            elif _get_url_scheme(url) == "file" or _get_url_scheme(url) == "":
+                # Stat before reading, so that a change during the read
+                # makes the snapshot stale rather than silently wrong.
+                self._add_dependency(_get_url_path(url))
+                # The lock is released before parsing, so that it is not
+                # held while the %mount targets are locked.
+                with _file_lock(_get_url_path(url), shared=1), \
+                     open(_get_url_path(url), "r", encoding="UTF-8",
+                          newline="") as file:
+                    tokens = self._tokenize(file, url)
             else:
                 # FIXME: Url:s have broken unicode handling - we can't know the encoding
                 return
@@ -627,28 +1450,69 @@ class _HiveFileParser:
             # of the Hiveconf specification.
             return
 
+        self._parse_tokens(tokens, rootfolder, url)
         return rootfolder
 
 
     def _parse_file(self, file, rootfolder, url):
-        curfolder = rootfolder
+        tokens = self._tokenize(file, url)
+        self._parse_tokens(tokens, rootfolder, url)
+
+
+    def _prefetch(self, executor, urls):
+        """Start reading and tokenizing urls in executor. The results
+        are picked up by _parse_url() in the order the caller parses
+        the urls, so merging into the tree stays deterministic."""
+        def read(url):
+            path = _get_url_path(url)
+            stat_key = _stat_key(path)
+            with _file_lock(path, shared=1), \
+                 open(path, "r", encoding="UTF-8", newline="") as file:
+                return (stat_key, self._tokenize(file, url))
+
+        for url in urls:
+            if _get_url_scheme(url) == "file":
+                self._prefetched[url] = executor.submit(read, url)
+
+
+    def _tokenize(self, file, url):
+        """Read a hive file and split it into a list of
+        (linenum, kind, data) tuples. If the file is writable, the
+        offsets of its lines are remembered for _HiveFileUpdater."""
+        tokens = []
         linenum = 0
-        sectionname = ""
-
-        # Section [/] is implicit
-        self.handle_section(rootfolder, "/", url)
+        index = _new_offset_index(url)
+        offset = 0
 
-        # Read & parse entire hive file
+        # Read entire hive file
         while True:
             try:
                 line = file.readline()
             except UnicodeDecodeError:
-                raise UnicodeError("File %s contains non UTF-8 characters." % (url))
+                # Reported when reached, like any other error
+                tokens.append((linenum + 1, "encoding", None))
+                index = None
+                break
             linenum += 1
 
             if not line:
                 break
 
+            if index is not None and "\r" in line:
+                # The updater reads the file with newline translation,
+                # so the offsets would not match. See _OffsetIndex.
+                index = None
+
+            if index is not None and not line.endswith("\n"):
+                # The last line is terminated when a section is added,
+                # which would make its offsets stale
+                index = None
+
+            if index is not None:
+                end = offset + _byte_length(line)
+                index.add_line(line, offset, end)
+                offset = end
+
             line = line.strip()
 
             if line.startswith("#") or line.startswith(";") or not line:
@@ -657,19 +1521,48 @@ class _HiveFileParser:
             if line.startswith("["):
                 # Folder
                 if not line.endswith("]"):
-                    print("%s: line %d: Syntax error: line does not end with ]" \
-                          % (url, linenum), file=sys.stderr)
-                    continue
+                    tokens.append((linenum, "badsection", None))
+                else:
+                    tokens.append((linenum, "section", line[1:-1]))
+
+            elif line.startswith("%"):
+                # Directive
+                tokens.append((linenum, "directive", line.split()))
+
+            elif line.find("=") != -1:
+                # Parameter
+                (paramname, paramvalue) = line.split("=", 1)
+                tokens.append((linenum, "parameter",
+                               (paramname.strip(), paramvalue.strip())))
+            else:
+                tokens.append((linenum, "syntax", None))
+
+        if index is not None:
+            _cache_offset_index(_get_url_path(url), index)
+        return tokens
+
+
+    def _parse_tokens(self, tokens, rootfolder, url):
+        curfolder = rootfolder
+        sectionname = ""
+        writable = _check_write_access(url)
+
+        # Section [/] is implicit
+        self.handle_section(rootfolder, "/", url)
 
-                sectionname = line[1:-1]
+        for (linenum, kind, data) in tokens:
+            if kind == "section":
+                sectionname = data
                 print("Read section line", sectionname, file=debugw)
                 curfolder = self.handle_section(rootfolder, sectionname, url)
 
-            elif line.startswith("%"):
-                # Directive
-                fields = line.split()
-                directive = fields[0]
-                args = fields[1:]
+            elif kind == "badsection":
+                print("%s: line %d: Syntax error: line does not end with ]" \
+                      % (url, linenum), file=sys.stderr)
+
+            elif kind == "directive":
+                directive = data[0]
+                args = data[1:]
 
                 # %mount
                 if directive == "%mount":
@@ -677,13 +1570,10 @@ class _HiveFileParser:
                 else:
                     print("%s: line %d: unknown directive" % (url, linenum), file=sys.stderr)
 
-            elif line.find("=") != -1:
-                # Parameter
-                (paramname, paramvalue) = line.split("=", 1)
-                paramname = paramname.strip()
-                paramvalue = paramvalue.strip()
+            elif kind == "parameter":
+                (paramname, paramvalue) = data
                 print("Read parameter line", paramname, file=debugw)
-                if _check_write_access(url):
+                if writable:
                     write_target = url
                 else:
                     write_target = curfolder.write_target
@@ -691,6 +1581,10 @@ class _HiveFileParser:
                     curfolder._addobject(Parameter(paramvalue, url, sectionname, paramname, write_target), paramname)
                 except ObjectExistsError:
                     print("Object '%s' already exists" % paramname, file=debugw)
+
+            elif kind == "encoding":
+                raise UnicodeError("File %s contains non UTF-8 characters." % (url))
+
             else:
                 raise SyntaxError(url, linenum)
 
@@ -764,37 +1658,98 @@ class _HiveFileParser:
             print("%s: line %d: invalid syntax" % (url, linenum), file=sys.stderr)
             return
 
+        mount = _mounters.get(backend)
+        if mount is None:
+            print("%s: line %d: unsupported backend" % (url, linenum), file=sys.stderr)
+            return
+        mount(self, args[0], backend_args, curfolder, url, linenum)
+
+
+    def _mount_hivefile(self, arg, backend_args, curfolder, url, linenum):
         # Resolve URL, relative to the doc base URL
-        mnturl = urllib.parse.urljoin(url, args[0])
-        del args
+        mnturl = urllib.parse.urljoin(url, arg)
+        self._mount_hivefiles(self._get_urls_to_mount(mnturl), curfolder)
 
-        for mount_url in self._get_urls_to_mount(mnturl):
-            if backend == "hivefile":
-                self.parse(mount_url, curfolder)
 
-            elif backend == "filesystem": # FIXME: Separate function/module/library
-                paramname = "default" # FIXME
+    def _mount_memory(self, arg, backend_args, curfolder, url, linenum):
+        # The argument is the name of a registered hive
+        self._mount_hivefiles(["memory://" + name
+                               for name in _get_memory_hives_to_mount(arg)],
+                              curfolder)
 
-                # Parse specific options
-                for backend_arg in backend_args.split(","):
-                    try:
-                        (name, value) = backend_arg.split("=")
-                    except ValueError:
-                        continue
-                    
-                    if name == "name":
-                        paramname = value
 
-                with open(mount_url, "r", encoding="UTF-8") as f:
-                    paramvalue = f.read()
-                    curfolder._addobject(Parameter(paramvalue, mount_url, "", paramname, mount_url), paramname)
+    def _mount_hivefiles(self, urls_to_mount, curfolder):
+        if not self.lazy and self.workers > 1 and len(urls_to_mount) > 1:
+            # Read the files in parallel, but merge them one by one in
+            # sorted order, just like below.
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+                self._prefetch(executor, urls_to_mount)
+                try:
+                    for mount_url in urls_to_mount:
+                        self.parse(mount_url, curfolder)
+                finally:
+                    for mount_url in urls_to_mount:
+                        self._prefetched.pop(mount_url, None)
+            return
 
+        for mount_url in urls_to_mount:
+            if self.lazy:
+                seq = self._position[:-1] + (self._position[-1] + 1,)
+                self._position = seq
+                curfolder._add_mount(_LazyMount(self, mount_url, seq))
             else:
-                print("%s: line %d: unsupported backend" % (url, linenum), file=sys.stderr)
+                self.parse(mount_url, curfolder)
+
+
+    def _mount_backend(self, factory, urls, arg, backend_args, curfolder,
+                       url, linenum):
+        """Mount the Backend objects made by factory, see
+        register_backend()"""
+        if urls:
+            # Resolve URL, relative to the doc base URL
+            urls_to_mount = self._get_urls_to_mount(urllib.parse.urljoin(url, arg),
+                                                    create=0)
+        else:
+            urls_to_mount = [arg]
+        options = _parse_mount_options(backend_args)
+
+        for mount_url in urls_to_mount:
+            if urls and _get_url_scheme(mount_url) == "file" \
+               and not os.path.exists(_get_url_path(mount_url)):
+                print("%s: line %d: %s: No such file or directory"
+                      % (url, linenum, _get_url_path(mount_url)), file=sys.stderr)
                 continue
+            try:
+                backend = factory(mount_url, options)
+            except (Error, OSError, ValueError) as e:
+                print("%s: line %d: %s: %s" % (url, linenum,
+                                               _get_url_path(mount_url), e),
+                      file=sys.stderr)
+                continue
+            for message in backend.warnings:
+                print("%s: line %d: %s" % (url, linenum, message), file=sys.stderr)
+            for path in backend.dependencies:
+                self._add_dependency(path)
+
+            if backend.writable:
+                curfolder._update(backend.url)
+            if backend.point_lookups:
+                curfolder._mount_store(backend, backend.root)
+            else:
+                # Populate the mount point now, in the position of the
+                # %mount line, like a hive file
+                for (name, obj) in backend.load_children(curfolder, backend.root):
+                    try:
+                        curfolder._addobject(obj, name)
+                    except ObjectExistsError:
+                        # The first definition wins
+                        pass
 
 
-    def _get_urls_to_mount(self, mnturl):
+    def _get_urls_to_mount(self, mnturl, create=1):
+        """Get the URLs matched by mnturl. A missing hive file without
+        wildcards is created if create is true, and otherwise returned
+        as it is, to be reported by the caller."""
         if _get_url_scheme(mnturl) == "file":
             # Strip file://
             mntpath = _get_url_path(mnturl)
@@ -803,10 +1758,15 @@ class _HiveFileParser:
             # Glob local files
             urls_to_mount =[]
             print("Globbing path", mntpath, file=debugw)
+            if _has_glob_wildchars(mntpath):
+                # The set of matches changes with the directory mtime
+                self._add_dependency(os.path.dirname(mntpath))
             glob_result = glob.glob(mntpath)
             if glob_result:
                 glob_result.sort()
                 for file_to_mount in glob_result:
+                    if _has_glob_wildchars(os.path.dirname(mntpath)):
+                        self._add_dependency(os.path.dirname(file_to_mount))
                     for bl_file in self.blacklist:
                         if os.path.samefile(file_to_mount, bl_file):
                             break
@@ -814,7 +1774,9 @@ class _HiveFileParser:
                         urls_to_mount.append("file://" + file_to_mount)
             else:
                 # No files found. Create file if the path had no wildcards
-                if not _has_glob_wildchars(mntpath):
+                if not _has_glob_wildchars(mntpath) and not create:
+                    urls_to_mount.append("file://" + mntpath)
+                elif not _has_glob_wildchars(mntpath):
                     try:
                         # Touch
                         with open(mntpath, "w", encoding="UTF-8"):
@@ -831,7 +1793,1249 @@ class _HiveFileParser:
         return urls_to_mount
         
 
+#
+# File locking
+#
+
+# Seconds to wait for a lock before raising LockTimeout, see
+# set_lock_timeout()
+_lock_timeout = 10.0
+
+_lock_stats_lock = threading.Lock()
+_lock_stats = {}
+
+def set_lock_timeout(timeout):
+    """Set the number of seconds to wait for a hive file lock"""
+    global _lock_timeout
+    _lock_timeout = timeout
+
+def reset_lock_stats():
+    """Reset the counters returned by get_lock_stats()"""
+    with _lock_stats_lock:
+        _lock_stats.update(acquired=0, contended=0, timeouts=0,
+                           wait_time=0.0, max_wait_time=0.0)
+
+def get_lock_stats():
+    """Return a dict with counters for hive file locks taken by this
+    process: acquired, contended (had to wait), timeouts, wait_time
+    and max_wait_time (in seconds)."""
+    with _lock_stats_lock:
+        return dict(_lock_stats)
+
+reset_lock_stats()
+
+def _count_lock(waited, contended, timeout=0):
+    with _lock_stats_lock:
+        if timeout:
+            _lock_stats["timeouts"] += 1
+        else:
+            _lock_stats["acquired"] += 1
+        if contended:
+            _lock_stats["contended"] += 1
+        _lock_stats["wait_time"] += waited
+        _lock_stats["max_wait_time"] = max(_lock_stats["max_wait_time"], waited)
+
+def _acquire_lock(path, shared):
+    """Lock path with flock(). Returns a file descriptor which holds
+    the lock until closed, or None if the file cannot be opened."""
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    start = time.monotonic()
+    contended = 0
+    delay = 0.001
+    while True:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # Nothing to lock. Reading or writing will fail or create
+            # the file, as without locking.
+            return None
+
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                contended = 1
+                waited = time.monotonic() - start
+                if waited >= _lock_timeout:
+                    os.close(fd)
+                    _count_lock(waited, contended, timeout=1)
+                    raise LockTimeout("Timeout waiting for lock on %s" % path)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+        # An atomic write may have replaced the file while we were
+        # waiting. In that case we hold a lock on the old file.
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        fst = os.fstat(fd)
+        if st is None or (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+            _count_lock(time.monotonic() - start, contended)
+            return fd
+        os.close(fd)
+
+@contextlib.contextmanager
+def _file_lock(path, shared=0):
+    """Hold an advisory lock on path. Shared locks are taken while
+    reading hive files, exclusive locks while writing them."""
+    if fcntl is None:
+        yield
+        return
+    fd = _acquire_lock(path, shared)
+    try:
+        yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+#
+# Backends
+#
+
+class Backend:
+    """Base class for the objects made by the factories given to
+    register_backend(). A backend provides the folders and parameters
+    below a mount point. See doc/backends.txt."""
+    # Source of the objects. If writable is true, it is also the write
+    # target of the mount point, and changes to it are written with the
+    # updater registered for its URL scheme.
+    url = None
+    writable = 0
+    # The path of the mount point, passed to load_object() and
+    # load_children()
+    root = ""
+    # If true, load_object() is called for each object as it is looked
+    # up. Otherwise, the mount point is populated from load_children()
+    # when mounted, and other folders when first used.
+    point_lookups = 1
+    # Paths of files to check before reusing a snapshot cache
+    dependencies = ()
+    # Messages to report, with the position of the %mount line
+    warnings = ()
+
+    def load_object(self, folder, path, name):
+        """Get the object name in folder, which is at path, or None"""
+        for (objname, obj) in self.load_children(folder, path):
+            if objname == name:
+                return obj
+        return None
+
+    def load_children(self, folder, path):
+        """Get all objects in folder, which is at path, as a list of
+        (name, object)"""
+        return []
+
+    def join(self, path, name):
+        """Get the path of the folder name in the folder at path"""
+        return path.rstrip("/") + "/" + name
+
+    def make_folder(self, folder, path, name):
+        """Make the folder name in folder. path is the path of the new
+        folder. The objects in it are loaded from this backend."""
+        if self.writable:
+            obj = Folder(self.url, self.url, path)
+        else:
+            obj = Folder(self.url, folder.write_target,
+                         os.path.join(folder.sectionname, name))
+        obj._add_store(self, path)
+        return obj
+
+    def make_parameter(self, folder, path, name, value):
+        """Make the parameter name in folder, which is at path, with
+        the value value in hive file syntax. If the backend is writable,
+        changes are written to it, with path as section name."""
+        if self.writable:
+            return Parameter(value, self.url, path, name, self.url)
+        return Parameter(value, self.url, folder.sectionname, name,
+                         folder.write_target)
+
+
+# Backend name -> function(parser, arg, backend_args, folder, url,
+# linenum), which mounts arg on folder for the %mount at url:linenum
+_mounters = {}
+# URL scheme -> function(url) returning an updater, for writable
+# backends
+_updaters = {}
+
+def register_backend(name, factory, updater=None, urls=1):
+    """Make "%mount -t name" mount the Backend returned by
+    factory(url, options). If urls is true, the %mount argument is a
+    URL relative to the hive file, and may contain wildcards, and
+    factory is called for each matching URL. Otherwise it is passed
+    as is. options is a dict from the -a option. Objects with a write
+    target URL using the scheme name are written with the updater
+    returned by updater(url)."""
+    def mount(parser, arg, backend_args, folder, url, linenum):
+        parser._mount_backend(factory, urls, arg, backend_args, folder,
+                              url, linenum)
+    _mounters[name] = mount
+    if updater is not None:
+        _updaters[name] = updater
+
+def _parse_mount_options(backend_args):
+    """Parse the -a argument of %mount, name=value,... into a dict.
+    Invalid items are ignored."""
+    options = {}
+    for backend_arg in backend_args.split(","):
+        try:
+            (name, value) = backend_arg.split("=")
+        except ValueError:
+            continue
+        options[name] = value
+    return options
+
+
+#
+# Directory hierarchies, mounted with the filesystem backend
+#
+
+class _DirectoryStore(Backend):
+    """Store for a directory mounted with %mount -t filesystem. The
+    path of a folder is its directory. Subdirectories are folders, and
+    files are parameters. Names starting with a dot are ignored. The
+    objects are read only; changes are written to the write target of
+    the folder, like for read only hive files."""
+    def __init__(self, path):
+        self.url = "file://" + path
+        self.root = path
+        self.dependencies = [path]
+
+    def join(self, path, name):
+        return os.path.join(path, name)
+
+    def _make_object(self, folder, path, name, is_dir):
+        filename = os.path.join(path, name)
+        if is_dir:
+            return self.make_folder(folder, filename, name)
+        return _FileParameter(filename, folder.sectionname, name,
+                              folder.write_target)
+
+    def load_object(self, folder, path, name):
+        if name.startswith("."):
+            return None
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            return self._make_object(folder, path, name, 1)
+        if stat.S_ISREG(st.st_mode):
+            return self._make_object(folder, path, name, 0)
+        return None
+
+    def load_children(self, folder, path):
+        children = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        children.append((entry.name,
+                                         self._make_object(folder, path, entry.name, 1)))
+                    elif entry.is_file():
+                        children.append((entry.name,
+                                         self._make_object(folder, path, entry.name, 0)))
+        except OSError:
+            print("Cannot list", path, file=debugw)
+        return children
+
+
+class _ParameterFile(Backend):
+    """A single file mounted with %mount -t filesystem, as one
+    parameter"""
+    point_lookups = 0
+
+    def __init__(self, url, paramname):
+        self.url = url
+        path = _get_url_path(url)
+        self.dependencies = [path]
+        self.paramname = paramname
+        with open(path, "r", encoding="UTF-8") as f:
+            self.value = f.read()
+
+    def load_children(self, folder, path):
+        return [(self.paramname, Parameter(self.value, self.url, "",
+                                           self.paramname, self.url))]
+
+
+def _filesystem_backend(url, options):
+    path = _get_url_path(url)
+    if os.path.isdir(path):
+        # Subdirectories are folders and files are parameters, read
+        # on demand
+        return _DirectoryStore(path)
+    # FIXME: Default to the file name
+    return _ParameterFile(url, options.get("name", "default"))
+
+
+class _FileParameter(Parameter):
+    """A parameter whose value is the contents of a file. The file is
+    read when the value is first used, and read again only if its
+    inode, size or mtime has changed, or never, once the value has
+    been set."""
+    def __init__(self, filename, sectionname, paramname, write_target):
+        self._filename = filename
+        # Contents of the file and the (inode, size, mtime) it was read at
+        self._contents = None
+        self._key = None
+        self._assigned = 0
+        Parameter.__init__(self, None, "file://" + filename, sectionname,
+                           paramname, write_target)
+
+    @property
+    def _value(self):
+        if not self._assigned:
+            self._refresh()
+        return self._contents
+
+    @_value.setter
+    def _value(self, value):
+        # Parameter.__init__() assigns None
+        if value is not None:
+            self._contents = value
+            self._assigned = 1
+
+    def _decode(self, kind, decoder, error):
+        if not self._assigned:
+            self._refresh()
+        return Parameter._decode(self, kind, decoder, error)
+
+    def _refresh(self):
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            # Removed. Keep what we have.
+            if self._contents is None:
+                self._contents = ""
+            return
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if key == self._key:
+            return
+        print("Reading", self._filename, file=debugw)
+        with open(self._filename, "r", encoding="UTF-8") as f:
+            self._contents = f.read()
+        self._key = key
+        self._decoded = {}
+
+
+#
+# Memory backend
+#
+
+class _MemoryHive:
+    """Text of a hive registered with register_memory_hive()"""
+    def __init__(self, text, writable):
+        self.text = text
+        self.writable = writable
+        self.lock = threading.RLock()
+
+# Name -> _MemoryHive
+_memory_hives = {}
+
+def register_memory_hive(name, text="", writable=1):
+    """Register a hive kept in memory, with the hive file contents
+    text. Replaces any hive registered with the same name."""
+    _memory_hives[name] = _MemoryHive(text, writable)
+
+def unregister_memory_hive(name):
+    _memory_hives.pop(name, None)
+
+def get_memory_hive(name):
+    """Get the current text of a registered hive, or None"""
+    hive = _memory_hives.get(name)
+    if hive is None:
+        return None
+    with hive.lock:
+        return hive.text
+
+def _get_memory_name(url):
+    return url[len("memory://"):]
+
+def _get_memory_hives_to_mount(pattern):
+    """Like _HiveFileParser._get_urls_to_mount(), but for names of
+    memory hives"""
+    if _has_glob_wildchars(pattern):
+        return sorted(fnmatch.filter(list(_memory_hives), pattern))
+    if pattern not in _memory_hives:
+        # Missing files are created as well
+        _memory_hives.setdefault(pattern, _MemoryHive("", 1))
+    return [pattern]
+
+
+class _MemoryUpdater:
+    """Updater for memory hives. The text is edited with _HiveText, in
+    the same way as _HiveFileUpdater edits files."""
+    def __init__(self, source):
+        self.source = source
+        self.hive = _memory_hives.get(_get_memory_name(source))
+        if self.hive is None or not self.hive.writable:
+            raise ReadOnlySource()
+
+    def lock(self):
+        return self.hive.lock
+
+    def change_parameter(self, sectionname, paramname, value, new_param=0,
+                         delete_param=0):
+        self.apply_changes([("change_parameter",
+                             (sectionname, paramname, value, new_param,
+                              delete_param))])
+
+    def add_parameter(self, sectionname, paramname, value):
+        self.change_parameter(sectionname, paramname, value, new_param=1)
+
+    def add_section(self, sectionname):
+        self.apply_changes([("add_section", (sectionname,))])
+
+    def delete_section(self, sectionname):
+        self.delete_objects([sectionname], [])
+
+    def delete_objects(self, sectionnames, params):
+        self.apply_changes([("delete_objects", (sectionnames, params))])
+
+    def read_changes(self, changes):
+        text = _HiveText(self.hive.text)
+        for (method, args) in changes:
+            getattr(text, method)(*args)
+        return str(text)
+
+    def apply_changes(self, changes):
+        with self.lock():
+            self.hive.text = self.read_changes(changes)
+
+    def prepare(self, changes):
+        """Apply changes in memory, and return a function which makes
+        them visible. Must be called with the lock held."""
+        data = self.read_changes(changes)
+        return lambda: setattr(self.hive, "text", data)
+
+
+#
+# Environment backend
+#
+
+# Variable name -> (value, tree, invalid), see _read_environ()
+_environ_cache = {}
+_environ_lock = threading.Lock()
+
+def _read_environ(name):
+    """Parse the environment variable name, which holds space separated
+    path=value items, with shell quoting. The variable is read only
+    once, and is then removed from os.environ, since the paths are
+    relative to this application and should not be inherited by child
+    processes. Returns (value, tree, invalid), where tree maps the
+    path of each folder to a dict from the names in it to their values,
+    with None for folders, and invalid lists items that were ignored."""
+    with _environ_lock:
+        result = _environ_cache.get(name)
+        if result is None:
+            value = os.environ.pop(name, "")
+            result = _environ_cache[name] = (value,) + _parse_environ(value)
+        return result
+
+def _parse_environ(value):
+    tree = {"": {}}
+    invalid = []
+    try:
+        items = shlex.split(value)
+    except ValueError:
+        return (tree, [value])
+    for item in items:
+        (path, sep, paramvalue) = item.partition("=")
+        comps = [comp for comp in path.split("/") if comp]
+        if not sep or not comps \
+           or not _add_environ_parameter(tree, comps, paramvalue):
+            invalid.append(item)
+    return (tree, invalid)
+
+def _add_environ_parameter(tree, comps, value):
+    """Add the parameter at the path comps to tree. Returns false if
+    the path is already taken; the first definition wins."""
+    folderpath = ""
+    for comp in comps[:-1]:
+        if tree.get(folderpath, {}).get(comp) is not None:
+            # A parameter
+            return 0
+        folderpath += "/" + comp
+    if comps[-1] in tree.get(folderpath, {}):
+        return 0
+
+    folderpath = ""
+    for comp in comps[:-1]:
+        tree[folderpath].setdefault(comp, None)
+        folderpath += "/" + comp
+        tree.setdefault(folderpath, {})
+    tree[folderpath][comps[-1]] = value
+    return 1
+
+
+def _environ_backend(name, options):
+    return _EnvironStore(name)
+
+
+class _EnvironStore(Backend):
+    """Parameters from an environment variable, mounted with %mount -t
+    environ. The path of a folder is its key in the tree returned by
+    _read_environ(). Only the name of the variable is kept, so that a
+    snapshot never holds values from another process. The objects are
+    read only; changes are written to the write target of the
+    folder."""
+    def __init__(self, name):
+        self.name = name
+        self.url = "environ:" + name
+        self.dependencies = [self.url]
+        self.warnings = ["%s: invalid parameter %s" % (name, item)
+                         for item in self.read()[2]]
+
+    def read(self):
+        return _read_environ(self.name)
+
+    def _make_object(self, folder, path, name, value):
+        if value is None:
+            return self.make_folder(folder, path + "/" + name, name)
+        return self.make_parameter(folder, path, name, value)
+
+    def load_object(self, folder, path, name):
+        objects = self.read()[1].get(path, {})
+        if name not in objects:
+            return None
+        return self._make_object(folder, path, name, objects[name])
+
+    def load_children(self, folder, path):
+        objects = self.read()[1].get(path, {})
+        return [(name, self._make_object(folder, path, name, value))
+                for (name, value) in objects.items()]
+
+
+#
+# Compiled hive files
+#
+# A hivebin file holds a whole namespace as a table of keys, sorted
+# by their UTF-8 bytes, followed by a string area. The key of an
+# object is its path relative to the mount point, such as
+# "/host1/ip". Each table entry gives the offset and length of the
+# key and the value in the string area. Folders have the value length
+# -1. Parameter values are stored in hive file syntax, and decoded
+# when retrieved. The file is mapped with mmap, so processes using
+# the same file share its pages, and nothing is read until looked up.
+#
+_HIVEBIN_MAGIC = b"HIVEBIN\0"
+_HIVEBIN_VERSION = 1
+# magic, version, number of entries
+_HIVEBIN_HEADER = struct.Struct("<8sII")
+# key offset, key length, value offset, value length
+_HIVEBIN_ENTRY = struct.Struct("<QIQi")
+
+def compile_hive(url, output, blacklist=None):
+    """Compile the tree of the hive at url into the hivebin file
+    output, which is replaced atomically"""
+    rootfolder = open_hive(url, blacklist)
+    if not rootfolder:
+        raise NoSuchObjectError(url)
+    image = _build_hivebin(rootfolder)
+
+    outdir = os.path.dirname(os.path.abspath(output))
+    (fd, tmpname) = tempfile.mkstemp(dir=outdir, prefix=".hivebin")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, output)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+def _build_hivebin(folder):
+    """Get the tree below folder in the hivebin format, as bytes"""
+    entries = []
+    _collect_hivebin_entries(folder, "", entries)
+    entries.sort()
+
+    strings = bytearray()
+    table = []
+    start = _HIVEBIN_HEADER.size + _HIVEBIN_ENTRY.size * len(entries)
+    for (key, value) in entries:
+        keyoffset = start + len(strings)
+        strings += key
+        if value is None:
+            table.append(_HIVEBIN_ENTRY.pack(keyoffset, len(key), 0, -1))
+        else:
+            table.append(_HIVEBIN_ENTRY.pack(keyoffset, len(key),
+                                             start + len(strings), len(value)))
+            strings += value
+    return b"".join([_HIVEBIN_HEADER.pack(_HIVEBIN_MAGIC, _HIVEBIN_VERSION,
+                                          len(entries))]
+                    + table + [bytes(strings)])
+
+def _collect_hivebin_entries(folder, path, entries):
+    folder._load_children()
+    for (name, obj) in folder._items():
+        if obj is folder:
+            # The root folder contains itself
+            continue
+        key = path + "/" + name
+        if isinstance(obj, Folder):
+            entries.append((key.encode("UTF-8"), None))
+            _collect_hivebin_entries(obj, key, entries)
+        else:
+            entries.append((key.encode("UTF-8"), obj._value.encode("UTF-8")))
+
+
+# path -> _HivebinStore
+_hivebin_stores = {}
+_hivebin_stores_lock = threading.Lock()
+
+def _get_hivebin_store(path):
+    with _hivebin_stores_lock:
+        store = _hivebin_stores.get(path)
+        if store is None:
+            store = _hivebin_stores[path] = _HivebinStore(path)
+        return store
+
+
+def _hivebin_backend(url, options):
+    store = _get_hivebin_store(_get_url_path(url))
+    store.check()
+    return store
+
+
+def _hivebin_count(buf):
+    """Get the number of entries in the hivebin image buf, or None if
+    it is not valid"""
+    if len(buf) < _HIVEBIN_HEADER.size:
+        return None
+    (magic, version, count) = _HIVEBIN_HEADER.unpack_from(buf)
+    if magic != _HIVEBIN_MAGIC or version != _HIVEBIN_VERSION \
+       or _HIVEBIN_HEADER.size + count * _HIVEBIN_ENTRY.size > len(buf):
+        return None
+    return count
+
+
+class _HivebinKeys:
+    """Sequence of the keys in a mapped hivebin file, for bisect"""
+    def __init__(self, buf, count):
+        self._buf = buf
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        (keyoffset, keylen, valueoffset, valuelen) = _HIVEBIN_ENTRY.unpack_from(
+            self._buf, _HIVEBIN_HEADER.size + i * _HIVEBIN_ENTRY.size)
+        # bytes() is a no-op for mmap slices, but needed for the
+        # memoryview of a shared memory snapshot
+        return bytes(self._buf[keyoffset:keyoffset + keylen])
+
+
+class _HivebinStore(Backend):
+    """A compiled hive file mounted with %mount -t hivebin. The path of
+    a folder is its key. The objects are read only; changes are written
+    to the write target of the folder."""
+    def __init__(self, path):
+        self.path = path
+        self.url = "hivebin://" + path
+        self.dependencies = [path]
+        # The mapping, its _HivebinKeys and the _index_key() of the
+        # file it was made from
+        self._buf = None
+        self._keys = None
+        self._key = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def check(self):
+        """Map the file, unless already mapped and unchanged. Raises
+        OSError or ValueError if the file cannot be used."""
+        with self._lock:
+            with open(self.path, "rb") as f:
+                st = os.fstat(f.fileno())
+                if self._buf is not None and _index_key(st) == self._key:
+                    return
+                if st.st_size < _HIVEBIN_HEADER.size:
+                    raise ValueError("not a hivebin file")
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            count = _hivebin_count(buf)
+            if count is None:
+                buf.close()
+                raise ValueError("not a hivebin file")
+            # A replaced file keeps its old mapping alive until no
+            # memoryview of it remains; just drop our reference.
+            print("Mapped", self.path, file=debugw)
+            self._buf = buf
+            self._keys = _HivebinKeys(buf, count)
+            self._key = _index_key(st)
+
+    def _mapped(self):
+        if self._buf is None:
+            self.check()
+        return (self._buf, self._keys)
+
+    def _make_object(self, folder, path, name, buf, i):
+        (keyoffset, keylen, valueoffset, valuelen) = _HIVEBIN_ENTRY.unpack_from(
+            buf, _HIVEBIN_HEADER.size + i * _HIVEBIN_ENTRY.size)
+        if valuelen < 0:
+            return self.make_folder(folder, path + "/" + name, name)
+        value = bytes(buf[valueoffset:valueoffset + valuelen]).decode("UTF-8")
+        return self.make_parameter(folder, path, name, value)
+
+    def load_object(self, folder, path, name):
+        """Get the object name in the folder at path, or None"""
+        (buf, keys) = self._mapped()
+        keybytes = (path + "/" + name).encode("UTF-8")
+        i = bisect.bisect_left(keys, keybytes)
+        if i == len(keys) or keys[i] != keybytes:
+            return None
+        return self._make_object(folder, path, name, buf, i)
+
+    def load_children(self, folder, path):
+        """Get all objects in the folder at path, as (name, object)"""
+        (buf, keys) = self._mapped()
+        prefix = (path + "/").encode("UTF-8")
+        # All keys below path are in [path + "/", path + "0")
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_left(keys, prefix[:-1] + b"0", lo)
+        children = []
+        for i in range(lo, hi):
+            name = keys[i][len(prefix):]
+            if b"/" in name:
+                continue
+            name = name.decode("UTF-8")
+            children.append((name, self._make_object(folder, path, name, buf, i)))
+        return children
+
+
+#
+# Shared memory snapshots
+#
+# export_shared_hive() copies a tree, in the hivebin format, into a
+# shared memory segment called "<name>.<generation>". A small control
+# segment called <name> holds the current generation. Processes
+# attach to the segment of the current generation, and look objects
+# up in it just like in a mapped hivebin file, without parsing
+# anything. Each export gets the next generation, and unlinks the
+# segment of the previous one. Processes still attached to it keep
+# their mapping until they reopen the snapshot.
+#
+_SHARED_MAGIC = b"HIVESHM\0"
+# magic, generation
+_SHARED_CONTROL = struct.Struct("<8sQ")
+
+# name -> (control segment, data segment) exported by this process
+_shared_exports = {}
+# name -> control segment attached by this process
+_shared_controls = {}
+_shared_lock = threading.Lock()
+
+def _open_shared_memory(name, size=0):
+    """Create the shared memory segment name if size is given,
+    otherwise attach to it. The segment is not tracked by the resource
+    tracker of multiprocessing, which would unlink it when the process
+    exits; it lives until unlinked by export_shared_hive() or
+    unlink_shared_hive()."""
+    if shared_memory is None:
+        raise Error("shared memory not available")
+    try:
+        return shared_memory.SharedMemory(name, size > 0, size, track=False)
+    except TypeError:
+        # Python older than 3.13 always tracks the segment
+        pass
+    shm = shared_memory.SharedMemory(name, size > 0, size)
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _unlink_shared_memory(name, shm=None):
+    """Unlink the shared memory segment name, if it exists"""
+    if shm is None:
+        try:
+            shm = _open_shared_memory(name)
+        except FileNotFoundError:
+            return
+    shm.close()
+    if os.name == "posix" and not hasattr(shm, "_track"):
+        # unlink() unregisters the segment from the resource tracker,
+        # which was already done by _open_shared_memory()
+        resource_tracker.register(shm._name, "shared_memory")
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+def _read_generation(control):
+    (magic, generation) = _SHARED_CONTROL.unpack_from(control.buf)
+    if magic != _SHARED_MAGIC:
+        return None
+    return generation
+
+def export_shared_hive(folder, name):
+    """Copy the tree below folder into a new generation of the shared
+    memory snapshot name. Returns the generation."""
+    image = _build_hivebin(folder)
+    with _shared_lock:
+        (control, data) = _shared_exports.get(name, (None, None))
+        if control is None:
+            try:
+                control = _open_shared_memory(name, _SHARED_CONTROL.size)
+            except FileExistsError:
+                # Exported earlier, perhaps by another process
+                control = _open_shared_memory(name)
+        previous = _read_generation(control) or 0
+        generation = previous + 1
+        segment = _open_shared_memory("%s.%d" % (name, generation), len(image))
+        segment.buf[:len(image)] = image
+        _SHARED_CONTROL.pack_into(control.buf, 0, _SHARED_MAGIC, generation)
+        _shared_exports[name] = (control, segment)
+        print("Exported", name, "generation", generation, file=debugw)
+        if previous:
+            _unlink_shared_memory("%s.%d" % (name, previous), data)
+    return generation
+
+def unlink_shared_hive(name):
+    """Remove the shared memory snapshot name. Processes attached to
+    it can keep using it."""
+    with _shared_lock:
+        (control, data) = _shared_exports.pop(name, (None, None))
+        if control is None:
+            try:
+                control = _open_shared_memory(name)
+            except FileNotFoundError:
+                return
+        generation = _read_generation(control)
+        # Tell processes which have attached to the control segment
+        # that it is gone
+        _SHARED_CONTROL.pack_into(control.buf, 0, b"", 0)
+        if generation:
+            _unlink_shared_memory("%s.%d" % (name, generation), data)
+        _unlink_shared_memory(name, control)
+
+def get_shared_hive_generation(name):
+    """Get the current generation of the shared memory snapshot name,
+    or None if it does not exist"""
+    with _shared_lock:
+        control = _shared_controls.get(name)
+        if control is not None:
+            generation = _read_generation(control)
+            if generation is not None:
+                return generation
+            # Unlinked, and perhaps exported again
+            del _shared_controls[name]
+            control.close()
+        try:
+            control = _open_shared_memory(name)
+        except FileNotFoundError:
+            return None
+        generation = _read_generation(control)
+        if generation is None:
+            control.close()
+        else:
+            _shared_controls[name] = control
+        return generation
+
+def open_shared_hive(name, threadsafe=0):
+    """Attach to the current generation of the shared memory snapshot
+    name. Returns the root folder, or None if it does not exist."""
+    while 1:
+        generation = get_shared_hive_generation(name)
+        if generation is None:
+            return None
+        try:
+            shm = _open_shared_memory("%s.%d" % (name, generation))
+            break
+        except FileNotFoundError:
+            # Replaced after we read the generation
+            if get_shared_hive_generation(name) == generation:
+                return None
+    store = _SharedHivebinStore(name, generation, shm)
+    rootfolder = Folder(store.url, None, "/")
+    rootfolder._addobject(rootfolder, "/")
+    rootfolder._add_store(store, "")
+    if threadsafe:
+        rootfolder._enable_threadsafe()
+    return rootfolder
+
+def is_shared_hive_current(folder):
+    """Return false if a newer generation of the shared memory snapshot
+    that folder was opened from has been exported"""
+    for (store, path) in folder._root._stores:
+        if isinstance(store, _SharedHivebinStore):
+            return get_shared_hive_generation(store.name) == store.generation
+    return 1
+
+
+class _SharedHivebinStore(_HivebinStore):
+    """One generation of a shared memory snapshot. The mapping never
+    changes; a new generation is used by opening it again."""
+    def __init__(self, name, generation, shm):
+        self.name = name
+        self.generation = generation
+        self.url = "shm://" + name
+        self.dependencies = []
+        count = _hivebin_count(shm.buf)
+        if count is None:
+            raise ValueError("not a hiveconf snapshot")
+        self._shm = shm
+        self._buf = shm.buf
+        self._keys = _HivebinKeys(shm.buf, count)
+        self._key = generation
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        raise TypeError("shared memory snapshots cannot be pickled")
+
+    def check(self):
+        pass
+
+
+#
+# SQLite backend
+#
+
+# path -> _SqliteStore
+_sqlite_stores = {}
+_sqlite_stores_lock = threading.Lock()
+
+def _get_sqlite_store(path):
+    with _sqlite_stores_lock:
+        store = _sqlite_stores.get(path)
+        if store is None:
+            store = _sqlite_stores[path] = _SqliteStore(path)
+        return store
+
+
+def _sqlite_backend(url, options):
+    if sqlite3 is None:
+        raise Error("sqlite backend not available")
+    store = _get_sqlite_store(_get_url_path(url))
+    try:
+        store.check()
+    except sqlite3.Error as e:
+        raise Error(str(e))
+    return store
+
+
+class _SqliteStore(Backend):
+    """A database mounted with %mount -t sqlite. Every folder and
+    parameter is a row in the table hive, keyed by the path of its
+    folder relative to the mount point (like a section name) and its
+    name. Folders have a NULL value."""
+    root = "/"
+
+    def __init__(self, path):
+        self.path = path
+        self.url = "sqlite://" + path
+        self.dependencies = [path]
+        self.writable = os.access(path, os.W_OK)
+        self._conn = None
+        # Serializes use of the connection, which is shared by all
+        # threads
+        self._lock = threading.RLock()
+        # Nesting level of transaction()
+        self._depth = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_conn"], state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._conn is None:
+            if self.writable:
+                conn = sqlite3.connect(self.path, timeout=_lock_timeout,
+                                       isolation_level=None,
+                                       check_same_thread=False)
+                conn.execute("CREATE TABLE IF NOT EXISTS hive ("
+                             "parent TEXT NOT NULL, "
+                             "name TEXT NOT NULL, "
+                             "value TEXT, "
+                             "PRIMARY KEY (parent, name)) WITHOUT ROWID")
+            else:
+                conn = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(self.path),
+                                       uri=True, timeout=_lock_timeout,
+                                       isolation_level=None,
+                                       check_same_thread=False)
+            self._conn = conn
+        return self._conn
+
+    def execute(self, sql, args=()):
+        """Run a statement, and return the number of changed rows"""
+        with self._lock:
+            return self._connect().execute(sql, args).rowcount
+
+    def query(self, sql, args=()):
+        """Run a query, and return all rows. The rows are fetched
+        while the connection is locked."""
+        with self._lock:
+            return self._connect().execute(sql, args).fetchall()
+
+    def check(self):
+        """Raise sqlite3.Error if the database cannot be used"""
+        self.query("SELECT 1 FROM hive LIMIT 1")
+
+    def _make_object(self, folder, path, name, value):
+        if value is None:
+            return self.make_folder(folder, os.path.join(path, name), name)
+        return self.make_parameter(folder, path, name, value)
+
+    def load_object(self, folder, path, name):
+        """Get the object name in the folder at path, or None"""
+        rows = self.query("SELECT value FROM hive WHERE parent = ? AND name = ?",
+                          (path, name))
+        if not rows:
+            return None
+        return self._make_object(folder, path, name, rows[0][0])
+
+    def load_children(self, folder, path):
+        """Get all objects in the folder at path, as (name, object)"""
+        rows = self.query("SELECT name, value FROM hive WHERE parent = ?",
+                          (path,))
+        return [(name, self._make_object(folder, path, name, value))
+                for (name, value) in rows]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the statements of the caller in one database
+        transaction. May be nested."""
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self._depth = 0
+
+
+class _SqliteUpdater:
+    """Updater for databases mounted with %mount -t sqlite. Section
+    names are folder paths relative to the mount point."""
+    def __init__(self, source):
+        self.source = source
+        self.store = _get_sqlite_store(_get_url_path(source))
+        if not self.store.writable:
+            raise ReadOnlySource()
+
+    def lock(self):
+        return self.store.transaction()
+
+    def change_parameter(self, sectionname, paramname, value, new_param=0,
+                         delete_param=0):
+        sectionname = _fixup_sectionname(sectionname)
+        with self.lock():
+            if new_param:
+                self.add_section(sectionname)
+                self.store.execute("INSERT OR REPLACE INTO hive VALUES (?, ?, ?)",
+                                   (sectionname, paramname, value))
+                return
+            if delete_param:
+                rowcount = self.store.execute(
+                    "DELETE FROM hive WHERE parent = ? AND name = ? "
+                    "AND value IS NOT NULL", (sectionname, paramname))
+            else:
+                rowcount = self.store.execute(
+                    "UPDATE hive SET value = ? WHERE parent = ? AND name = ? "
+                    "AND value IS NOT NULL", (value, sectionname, paramname))
+            if rowcount == 0:
+                raise NoSuchParameterError()
+
+    def add_parameter(self, sectionname, paramname, value):
+        self.change_parameter(sectionname, paramname, value, new_param=1)
+
+    def add_section(self, sectionname):
+        """Add the folder sectionname and its parents"""
+        parent = "/"
+        with self.lock():
+            for name in _path2comps(_fixup_sectionname(sectionname)):
+                if name == "/":
+                    break
+                self.store.execute("INSERT OR IGNORE INTO hive VALUES (?, ?, NULL)",
+                                   (parent, name))
+                parent = os.path.join(parent, name)
+
+    def delete_section(self, sectionname):
+        self.delete_objects([sectionname], [])
+
+    def delete_objects(self, sectionnames, params):
+        """Remove the folders in sectionnames with all their contents,
+        and the parameters in params"""
+        with self.lock():
+            for sectionname in sectionnames:
+                sectionname = _fixup_sectionname(sectionname)
+                if sectionname == "/":
+                    self.store.execute("DELETE FROM hive")
+                    continue
+                # All folders below sectionname are in the range
+                # [sectionname + "/", sectionname + "0")
+                self.store.execute("DELETE FROM hive WHERE parent = ? OR "
+                                   "(parent >= ? AND parent < ?)",
+                                   (sectionname, sectionname + "/", sectionname + "0"))
+                (parent, name) = os.path.split(sectionname)
+                self.store.execute("DELETE FROM hive WHERE parent = ? AND name = ?",
+                                   (parent, name))
+            for (sectionname, paramname) in params:
+                self.store.execute("DELETE FROM hive WHERE parent = ? AND name = ? "
+                                   "AND value IS NOT NULL",
+                                   (_fixup_sectionname(sectionname), paramname))
+
+    def apply_changes(self, changes):
+        """Apply changes in one database transaction"""
+        with self.lock():
+            for (method, args) in changes:
+                getattr(self, method)(*args)
+
+    def prepare(self, changes):
+        """Apply changes. They are committed when the lock is released."""
+        self.apply_changes(changes)
+        return lambda: None
+
+
+# fsync policies for set_write_policy()
+FSYNC_NONE = "none"
+FSYNC_FILE = "file"
+FSYNC_DIRECTORY = "directory"
+
+def set_write_policy(atomic=None, fsync=None):
+    """Configure how hive files are written. If atomic is true, files
+    are rewritten through a temporary file which is renamed over the
+    original. fsync is FSYNC_NONE, FSYNC_FILE or FSYNC_DIRECTORY. None
+    leaves a setting unchanged."""
+    if atomic is not None:
+        _HiveFileUpdater.atomic = atomic
+    if fsync is not None:
+        if fsync not in (FSYNC_NONE, FSYNC_FILE, FSYNC_DIRECTORY):
+            raise ValueError("Invalid fsync policy: %s" % fsync)
+        _HiveFileUpdater.fsync = fsync
+
+# Files modified less than this many nanoseconds ago may be changed
+# again without a visible change of mtime. Offset indexes for such
+# files are not kept, unless we made the change ourselves.
+_RACY_INTERVAL = 2 * 10**9
+
+# filename -> _OffsetIndex, see _HiveFileUpdater._find_offset()
+_offset_indexes = {}
+
+def _index_key(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+def _byte_length(line):
+    if line.isascii():
+        return len(line)
+    return len(line.encode("UTF-8"))
+
+def _cache_offset_index(filename, index):
+    """Keep index for later updates, unless the file is too new"""
+    if time.time_ns() - index.key[1] >= _RACY_INTERVAL:
+        _offset_indexes[filename] = index
+
+def _new_offset_index(url):
+    """Get an empty _OffsetIndex to fill in while reading url, or None
+    if the file cannot be written to."""
+    if not _check_write_access(url):
+        return None
+    try:
+        st = os.stat(_get_url_path(url))
+    except OSError:
+        return None
+    return _OffsetIndex(_index_key(st))
+
+def _build_offset_index(filename, key):
+    """Read filename and index it, or return None if not possible"""
+    index = _OffsetIndex(key)
+    offset = 0
+    try:
+        with open(filename, "r", encoding="UTF-8", newline="") as f:
+            for line in f:
+                if "\r" in line or not line.endswith("\n"):
+                    return None
+                end = offset + _byte_length(line)
+                index.add_line(line, offset, end)
+                offset = end
+    except (OSError, UnicodeDecodeError):
+        return None
+    return index
+
+
+class _OffsetIndex:
+    """Byte offsets of the section and parameter lines in a hive file,
+    as found by _HiveFileUpdater._find_offset(). Each value is (start,
+    end) of the first matching line. key is the _index_key() of the
+    indexed file. Files with CR line endings are not indexed, since
+    _HiveFileUpdater converts them to LF when rewriting. Neither are
+    files without a newline at the end, since it is added by
+    add_section()."""
+    def __init__(self, key):
+        self.key = key
+        # sectionname -> (start, end)
+        self.sections = {}
+        # (sectionname, paramname) -> (start, end)
+        self.parameters = {}
+        # Section of the last line added
+        self.sectionname = ""
+
+    def add_line(self, line, start, end):
+        """Index the line at start. Lines must be added in order."""
+        line = line.strip()
+
+        if line.startswith("#") or line.startswith(";") or not line:
+            return
+
+        if line.startswith("["):
+            if line.endswith("]"):
+                self.sectionname = line[1:-1]
+                self.sections.setdefault(self.sectionname, (start, end))
+        elif line.find("=") != -1:
+            paramname = line.split("=", 1)[0].strip()
+            self.parameters.setdefault((self.sectionname, paramname),
+                                       (start, end))
+
+    def replace_line(self, sectionname, paramname, start, old_end, new_end):
+        """Update offsets after the bytes from start to old_end have
+        been replaced by the parameter line ending at new_end. If
+        start == old_end, a line was inserted."""
+        delta = new_end - old_end
+        if delta:
+            for entries in (self.sections, self.parameters):
+                for (name, (s, e)) in entries.items():
+                    if s >= old_end:
+                        entries[name] = (s + delta, e + delta)
+        self.parameters[(sectionname, paramname)] = (start, new_end)
+
+
 class _HiveFileUpdater:
+    # See set_write_policy()
+    atomic = 0
+    fsync = FSYNC_NONE
+    # True while this updater holds the file lock, see lock()
+    _locked = 0
+    # _OffsetIndex used by the current operation
+    _index = None
+
     # FIXME: Broken for parameter files. 
     def __init__(self, source):
         self.source = source
@@ -841,12 +3045,31 @@ class _HiveFileUpdater:
             # Only able to write to local files right now
             raise ReadOnlySource()
 
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold an exclusive lock on the file. May be nested."""
+        if self._locked:
+            yield
+            return
+        with _file_lock(self.filename):
+            self._locked = 1
+            try:
+                yield
+            finally:
+                self._locked = 0
+
     def change_parameter(self, sectionname, paramname, value, new_param=0,
                          delete_param=0):
         """Change existing parameter line in file"""
-        # FIXME: Use file locking
-        with open(self.filename, "r+", encoding="UTF-8") as f:
+        if self.atomic:
+            self.apply_changes([("change_parameter",
+                                 (sectionname, paramname, value, new_param,
+                                  delete_param))])
+            return
+
+        with self.lock(), open(self.filename, "r+", encoding="UTF-8") as f:
             parameter_offset = self._find_offset(f, sectionname, paramname, new_param)
+            line_end = f.tell()
             rest_data = f.read()
 
             if parameter_offset == None:
@@ -857,7 +3080,7 @@ class _HiveFileUpdater:
                     self.add_section(sectionname)
                     # Now we can add the parameter at the end.
                     f.seek(0, 2)
-                    parameter_offset = f.tell()
+                    parameter_offset = line_end = f.tell()
                 else:
                     raise NoSuchParameterError()
 
@@ -865,30 +3088,93 @@ class _HiveFileUpdater:
             f.seek(parameter_offset)
             if not delete_param:
                 print(paramname + "=" + value, file=f)
+            new_end = f.tell()
 
             # Write rest
             f.write(rest_data)
             f.truncate()
+            self._sync(f)
+
+            if delete_param:
+                # A parameter further down may now be the first match
+                self._drop_index()
+            elif self._index is not None:
+                self._index.replace_line(sectionname, paramname,
+                                         parameter_offset, line_end, new_end)
+                self._store_index(f)
 
     def add_parameter(self, sectionname, paramname, value):
         self.change_parameter(sectionname, paramname, value, new_param=1)
 
     def delete_section(self, sectionname):
-        with open(self.filename, "r+", encoding="UTF-8") as f:
-            section_offset = self._find_offset(f, sectionname, None, get_section=1)
-            # FIXME: the readline() below looks weird. Currently this will
-            #        remove the section-line AND the next line.
-            #        Either remove only the section-line or the entire
-            #        section including all parameters (and subsections?).
-            #        See https://www.cendio.com/bugzilla/show_bug.cgi?id=6122
-            f.readline()
-            rest_data = f.read()
-            f.seek(section_offset)
-            f.write(rest_data)
-            f.truncate()
+        """Remove all sections named sectionname, including their
+        contents"""
+        self.delete_objects([sectionname], [])
+
+    def delete_objects(self, sectionnames, params):
+        """Remove the sections in sectionnames, including their
+        contents, and the parameter lines in params, a list of
+        (sectionname, paramname), with a single rewrite of the file"""
+        self.apply_changes([("delete_objects", (sectionnames, params))])
 
     def _find_offset(self, f, sectionname, paramname, new_param=0,
                      get_section=0):
+        """Find the offset of a parameter line, or of a section line if
+        get_section is true. If new_param is true, find the offset where
+        a new parameter should be inserted. f is left positioned after
+        the line found, or at the end of the file if None is
+        returned."""
+        self._index = self._get_index(f)
+
+        # Top level parameters are added first in the file
+        if sectionname == "" and new_param:
+            return f.tell()
+
+        if self._index is None:
+            return self._scan_offset(f, sectionname, paramname, new_param,
+                                     get_section)
+
+        if get_section or new_param:
+            entry = self._index.sections.get(sectionname)
+        else:
+            entry = self._index.parameters.get((sectionname, paramname))
+        if entry is None:
+            f.seek(0, 2)
+            return None
+
+        (start, end) = entry
+        f.seek(end)
+        if new_param:
+            return end
+        return start
+
+    def _get_index(self, f):
+        """Get a valid _OffsetIndex for the open file f. Returns None
+        if the file cannot be indexed."""
+        key = _index_key(os.fstat(f.fileno()))
+        for index in (self._index, _offset_indexes.get(self.filename)):
+            if index is not None and index.key == key:
+                return index
+
+        print("Indexing", self.filename, file=debugw)
+        index = _build_offset_index(self.filename, key)
+        if index is not None:
+            _cache_offset_index(self.filename, index)
+        return index
+
+    def _store_index(self, f):
+        """Make the current index valid for the file as we just wrote it"""
+        f.flush()
+        self._index.key = _index_key(os.fstat(f.fileno()))
+        _offset_indexes[self.filename] = self._index
+
+    def _drop_index(self):
+        self._index = None
+        _offset_indexes.pop(self.filename, None)
+
+    def _scan_offset(self, f, sectionname, paramname, new_param=0,
+                     get_section=0):
+        """Like _find_offset(), but by reading the file from f's position"""
         correct_section = 0 
 
         # If this parameter is at top level, we are already in the
@@ -940,6 +3226,963 @@ class _HiveFileUpdater:
 
     def add_section(self, sectionname):
         """Add new section to end of file"""
-        with open(self.filename, "a", encoding="UTF-8") as f:
+        if self.atomic:
+            self.apply_changes([("add_section", (sectionname,))])
+            return
+
+        with self.lock(), open(self.filename, "a", encoding="UTF-8") as f:
+            # Use the index only if it is valid without reading the file
+            key = _index_key(os.fstat(f.fileno()))
+            if self._index is None or self._index.key != key:
+                self._index = _offset_indexes.get(self.filename)
+
             print("", file=f)
+            start = f.tell()
             print("[%s]" % sectionname, file=f)
+            self._sync(f)
+
+            if self._index is not None and self._index.key == key:
+                self._index.add_line("[%s]" % sectionname, start, f.tell())
+                self._store_index(f)
+
+    def _sync(self, f):
+        if self.fsync != FSYNC_NONE:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read_changes(self, changes):
+        """Read the file and apply changes in memory. changes is a
+        list of (method, args) for _HiveText. Returns the new contents."""
+        with open(self.filename, "r", encoding="UTF-8") as f:
+            text = _HiveText(f.read())
+        for (method, args) in changes:
+            getattr(text, method)(*args)
+        return str(text)
+
+    def write_contents(self, data):
+        """Replace the contents of the file"""
+        self._drop_index()
+        if self.atomic and self._replace_contents(data):
+            return
+
+        with open(self.filename, "r+", encoding="UTF-8") as f:
+            f.write(data)
+            f.truncate()
+            self._sync(f)
+
+    def _replace_contents(self, data):
+        """Write data to a temporary file in the same directory and
+        rename it over the file. Returns false if this is not possible
+        without changing permissions or ownership, in which case
+        nothing has been done."""
+        # Replace the target of symbolic links, not the link
+        filename = os.path.realpath(self.filename)
+        dirname = os.path.dirname(filename)
+        st = os.stat(filename)
+        try:
+            (fd, tmpname) = tempfile.mkstemp(
+                dir=dirname, prefix="." + os.path.basename(filename) + ".")
+        except OSError:
+            print("Cannot create temporary file in", dirname, file=debugw)
+            return 0
+
+        try:
+            with os.fdopen(fd, "w", encoding="UTF-8") as f:
+                f.write(data)
+                self._sync(f)
+                os.chmod(tmpname, stat.S_IMODE(st.st_mode))
+                if (st.st_uid, st.st_gid) != (os.geteuid(), os.getegid()):
+                    # Only privileged users can give files away
+                    os.chown(tmpname, st.st_uid, st.st_gid)
+            os.replace(tmpname, filename)
+        except PermissionError:
+            os.unlink(tmpname)
+            print("Cannot preserve ownership of", filename, file=debugw)
+            return 0
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+        if self.fsync == FSYNC_DIRECTORY:
+            dirfd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        return 1
+
+    def apply_changes(self, changes):
+        """Apply changes with a single read and write of the file"""
+        with self.lock():
+            self.write_contents(self.read_changes(changes))
+
+    def prepare(self, changes):
+        """Apply changes in memory, and return a function which writes
+        the result. Must be called with the lock held."""
+        data = self.read_changes(changes)
+        return lambda: self.write_contents(data)
+
+
+class _HiveText:
+    """A hive file as a list of lines. The methods edit the lines in
+    the same way as the corresponding _HiveFileUpdater methods edit
+    the file.
+
+    To apply many changes in linear time, sections and parameters are
+    found with an index of the lines, and new parameter lines are kept
+    in _pending until the lines are needed, so that the indexes stay
+    valid."""
+    def __init__(self, data):
+        self.lines = data.splitlines(True)
+        # Built by _build_index(): sectionname -> index of its first
+        # section line, and (sectionname, paramname) -> index of the
+        # first parameter line, or the _pending cell holding it
+        self._sections = None
+        self._params = None
+        # Index of a line, or -1 for the start of the file -> cells
+        # ([line]) to insert after it, in the order they were added.
+        # The last one added comes first.
+        self._pending = {}
+
+    def __str__(self):
+        self._flush()
+        return "".join(self.lines)
+
+    def _terminate_line(self, index):
+        if index >= 0 and not self.lines[index].endswith("\n"):
+            self.lines[index] += "\n"
+
+    def _flush(self):
+        """Insert the pending lines, and forget the indexes"""
+        if self._pending:
+            pending = self._pending
+            lines = [cell[0] for cell in reversed(pending.get(-1, ()))]
+            for (index, line) in enumerate(self.lines):
+                lines.append(line)
+                if index in pending:
+                    lines.extend(cell[0] for cell in reversed(pending[index]))
+            self.lines = lines
+            self._pending = {}
+        self._sections = None
+        self._params = None
+
+    def _build_index(self):
+        """Index the lines like _find_index() searches them"""
+        sections = {}
+        params = {}
+        sectionname = ""
+        for (index, line) in enumerate(self.lines):
+            line = line.strip()
+
+            if line.startswith("#") or line.startswith(";") or not line:
+                continue
+
+            if line.startswith("["):
+                # Ignore invalid section lines
+                if line.endswith("]"):
+                    sectionname = line[1:-1]
+                    sections.setdefault(sectionname, index)
+
+            elif line.find("=") != -1:
+                paramname = line.split("=", 1)[0].strip()
+                params.setdefault((sectionname, paramname), index)
+        self._sections = sections
+        self._params = params
+
+    def _find_index(self, sectionname, paramname, new_param=0,
+                    get_section=0):
+        """Same as _HiveFileUpdater._find_offset(), but returns a line
+        index"""
+        correct_section = (sectionname == "")
+        if correct_section and new_param:
+            return 0
+
+        for (index, line) in enumerate(self.lines):
+            line = line.strip()
+
+            if line.startswith("#") or line.startswith(";") or not line:
+                continue
+
+            if line.startswith("["):
+                # Section
+                if not line.endswith("]"):
+                    # Ignore invalid section lines
+                    continue
+
+                correct_section = (sectionname == line[1:-1])
+                if correct_section and get_section:
+                    return index
+                elif correct_section and new_param:
+                    return index + 1
+
+            elif correct_section and line.find("=") != -1:
+                (line_paramname, line_paramvalue) = line.split("=", 1)
+                if paramname == line_paramname.strip():
+                    return index
+
+        return None
+
+    def change_parameter(self, sectionname, paramname, value, new_param=0,
+                         delete_param=0):
+        line = paramname + "=" + value + "\n"
+        if delete_param:
+            self._flush()
+            index = self._find_index(sectionname, paramname)
+            if index is None:
+                raise NoSuchParameterError()
+            del self.lines[index]
+            return
+
+        if self._params is None:
+            self._build_index()
+
+        if new_param:
+            if sectionname == "":
+                index = -1
+            else:
+                index = self._sections.get(sectionname)
+                if index is None:
+                    self.add_section(sectionname)
+                    index = len(self.lines) - 1
+                self._terminate_line(index)
+            cell = [line]
+            self._pending.setdefault(index, []).append(cell)
+            # The new line comes before any other in the section
+            self._params[(sectionname, paramname)] = cell
+            return
+
+        index = self._params.get((sectionname, paramname))
+        if index is None:
+            raise NoSuchParameterError()
+        if isinstance(index, list):
+            index[0] = line
+        else:
+            self.lines[index] = line
+
+    def add_parameter(self, sectionname, paramname, value):
+        self.change_parameter(sectionname, paramname, value, new_param=1)
+
+    def delete_section(self, sectionname):
+        self.delete_objects([sectionname], [])
+
+    def delete_objects(self, sectionnames, params):
+        self._flush()
+        # [a] and [/a] are the same section
+        sectionnames = set(map(_fixup_sectionname, sectionnames))
+        params = set((_fixup_sectionname(sectionname), paramname)
+                     for (sectionname, paramname) in params)
+        sectionname = ""
+        dropping = 0
+        lines = []
+        for line in self.lines:
+            stripped = line.strip()
+
+            if stripped.startswith("[") and stripped.endswith("]"):
+                sectionname = _fixup_sectionname(stripped[1:-1])
+                dropping = sectionname in sectionnames
+            elif dropping or stripped.startswith("#") or stripped.startswith(";"):
+                pass
+            elif stripped.find("=") != -1:
+                paramname = stripped.split("=", 1)[0].strip()
+                if (sectionname, paramname) in params:
+                    # Only the first match, like change_parameter()
+                    params.remove((sectionname, paramname))
+                    continue
+
+            if not dropping:
+                lines.append(line)
+        self.lines = lines
+
+    def add_section(self, sectionname):
+        if self.lines and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += "\n"
+        else:
+            self.lines.append("\n")
+        self.lines.append("[%s]\n" % sectionname)
+        if self._sections is not None:
+            self._sections.setdefault(sectionname, len(self.lines) - 1)
+
+
+class _RecordingUpdater:
+    """Updater which records changes instead of writing them"""
+    def __init__(self, recorder, source):
+        # Fail early, if source cannot be written
+        _make_updater(source)
+        self.recorder = recorder
+        self.source = source
+
+    def change_parameter(self, sectionname, paramname, value, new_param=0,
+                         delete_param=0):
+        self.recorder.record(self.source, "change_parameter",
+                             (sectionname, paramname, value, new_param,
+                              delete_param))
+
+    def add_parameter(self, sectionname, paramname, value):
+        self.change_parameter(sectionname, paramname, value, new_param=1)
+
+    def delete_section(self, sectionname):
+        self.recorder.record(self.source, "delete_section", (sectionname,))
+
+    def delete_objects(self, sectionnames, params):
+        self.recorder.record(self.source, "delete_objects",
+                             (sectionnames, params))
+
+    def add_section(self, sectionname):
+        self.recorder.record(self.source, "add_section", (sectionname,))
+
+
+# Queues with unwritten changes, flushed at exit
+_write_behind_queues = weakref.WeakSet()
+
+@atexit.register
+def _flush_write_behind_queues():
+    for queue in list(_write_behind_queues):
+        try:
+            queue.close()
+        except Exception as e:
+            print("hiveconf: Unable to write changes:", e, file=sys.stderr)
+
+
+def _run_write_behind(ref, interval, dirty, stop):
+    """Background thread of a _WriteBehind. Only holds a weak reference
+    to it, so that it can be garbage collected."""
+    while True:
+        dirty.wait()
+        # Let more changes accumulate
+        if stop.wait(interval):
+            return
+        queue = ref()
+        if queue is None:
+            return
+        try:
+            queue.flush()
+        except Exception as e:
+            print("Write-behind flush failed:", e, file=debugw)
+            queue.error = e
+        del queue
+
+
+def _finalize_write_behind(changes, dirty, stop):
+    """Stop the thread of a garbage collected _WriteBehind, and write
+    its remaining changes"""
+    stop.set()
+    dirty.set()
+    for (url, url_changes) in changes.items():
+        try:
+            _make_updater(url).apply_changes(url_changes)
+        except Exception as e:
+            print("hiveconf: Unable to write changes:", e, file=sys.stderr)
+
+
+class _WriteBehind:
+    """Writes to a tree in write-behind mode, see open_hive(). Changes
+    are recorded like in a transaction, and written by a background
+    thread, interval seconds after the first unwritten change."""
+    def __init__(self, interval):
+        self.interval = interval
+        # URL -> list of (method, args), in order
+        self.changes = {}
+        # URL -> {(sectionname, paramname): index in changes[URL]} of
+        # parameter changes which a later value can replace
+        self.latest = {}
+        # Exception from a failed background flush
+        self.error = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=_run_write_behind,
+            args=(weakref.ref(self), interval, self._dirty, self._stop),
+            daemon=True, name="hiveconf write-behind")
+        self._thread.start()
+        weakref.finalize(self, _finalize_write_behind, self.changes,
+                         self._dirty, self._stop).atexit = False
+        _write_behind_queues.add(self)
+
+    def record(self, url, method, args):
+        with self._lock:
+            changes = self.changes.setdefault(url, [])
+            latest = self.latest.setdefault(url, {})
+            if method == "change_parameter":
+                (sectionname, paramname, value, new_param, delete_param) = args
+                key = (sectionname, paramname)
+                if delete_param:
+                    latest.pop(key, None)
+                elif key in latest and not new_param:
+                    # Coalesce with the pending change
+                    index = latest[key]
+                    (old_method, old_args) = changes[index]
+                    changes[index] = (method, old_args[:2] + (value,) + old_args[3:])
+                    return
+                else:
+                    latest[key] = len(changes)
+            elif method != "add_section":
+                # Sections were deleted. A later parameter may be
+                # added to a new section, so stop coalescing.
+                latest.clear()
+            changes.append((method, args))
+            self._dirty.set()
+
+    def add_undo(self, action):
+        # Changes to the tree are kept even if writing fails
+        pass
+
+    def check(self):
+        """Raise the error from the last background flush, once"""
+        error = self.error
+        if error is not None:
+            self.error = None
+            raise error
+
+    def flush(self):
+        """Write all queued changes, with one rewrite per file. Changes
+        which could not be written are kept, and the first error is
+        raised."""
+        with self._flush_lock:
+            with self._lock:
+                # self.changes is kept, it is used by the finalizer
+                changes = dict(self.changes)
+                self.changes.clear()
+                self.latest = {}
+                self._dirty.clear()
+
+            failed = {}
+            error = None
+            for (url, url_changes) in changes.items():
+                try:
+                    _make_updater(url).apply_changes(url_changes)
+                except Exception as e:
+                    failed[url] = url_changes
+                    if error is None:
+                        error = e
+
+            if failed:
+                with self._lock:
+                    for (url, url_changes) in failed.items():
+                        self.changes[url] = url_changes + self.changes.get(url, [])
+                        self.latest[url] = {}
+                    self._dirty.set()
+                raise error
+            self.error = None
+
+    def close(self):
+        """Stop the background thread, and write all queued changes"""
+        self._stop.set()
+        self._dirty.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+        _write_behind_queues.discard(self)
+
+
+class _WriteOrder:
+    """Tickets for writing files in the order a thread-safe tree was
+    changed, see Folder._writing_unlocked()"""
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._issued = 0
+        self._serving = 0
+
+    def take(self):
+        """Get the next ticket. Called with the tree write lock held."""
+        with self._cond:
+            self._issued += 1
+            return self._issued - 1
+
+    def last(self):
+        """Get the last ticket taken"""
+        return self._issued - 1
+
+    @contextlib.contextmanager
+    def turn(self, ticket):
+        """Wait until all earlier tickets have been served"""
+        with self._cond:
+            while self._serving != ticket:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._serving += 1
+                self._cond.notify_all()
+
+
+class _Transaction:
+    """Writes recorded during Folder.transaction()"""
+    def __init__(self):
+        # URL -> list of (method, args), in order
+        self.changes = {}
+        # Functions undoing changes to the tree, in order
+        self.undo = []
+
+    def record(self, url, method, args):
+        self.changes.setdefault(url, []).append((method, args))
+
+    def add_undo(self, action):
+        self.undo.append(action)
+
+    def commit(self):
+        # Apply all changes in memory first, so that errors such as
+        # NoSuchParameterError are found before any file is written.
+        # All files stay locked until the last one is written. They
+        # are locked in sorted order to avoid deadlocks.
+        with contextlib.ExitStack() as stack:
+            writes = []
+            for url in sorted(self.changes):
+                updater = _make_updater(url)
+                stack.enter_context(updater.lock())
+                writes.append(updater.prepare(self.changes[url]))
+            for write in writes:
+                write()
+
+    def rollback(self):
+        for action in reversed(self.undo):
+            action()
+
+
+#
+# Daemon
+#
+# hiveconfd keeps parsed hives in memory, and serves requests from
+# open_daemon_hive() over a Unix socket. Each request and response is
+# a JSON object on a line of its own. A request holds "op", the URL
+# of the hive, the path of the folder it applies to, and the
+# arguments of the operation. Values are passed as strings, in hive
+# file syntax, and are encoded and decoded by the client. Before each
+# request, the files a hive was parsed from are checked with stat(),
+# and the hive is parsed again if any has changed.
+#
+
+def get_daemon_socket():
+    """Get the path of the socket of hiveconfd, from $HIVECONFD_SOCKET
+    or the default, or None if the daemon should not be used"""
+    path = os.environ.get("HIVECONFD_SOCKET")
+    if path is not None:
+        return path or None
+    rundir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(rundir, "hiveconfd-%d.sock" % os.getuid())
+
+def open_daemon_hive(url, socket_path=None, timeout=10):
+    """Open the hive at url through hiveconfd. Returns a RemoteFolder
+    for the root folder, or None if no daemon is running, or if the
+    hive depends on the state of this process, such as environment
+    variables mounted with %mount -t environ."""
+    if socket_path is None:
+        socket_path = get_daemon_socket()
+        if socket_path is None:
+            return None
+    try:
+        # Do not trust a socket created by another user
+        if os.stat(socket_path).st_uid not in (os.getuid(), 0):
+            print("Ignoring", socket_path, "owned by another user", file=debugw)
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+    except OSError as e:
+        print("Cannot connect to", socket_path, ":", e, file=debugw)
+        return None
+    url = urllib.parse.urljoin(_get_cwd_url(), url)
+    connection = _DaemonConnection(sock, url)
+    try:
+        response = connection.request("open", "/", "/")
+    except NoSuchObjectError:
+        return None
+    if response["local"]:
+        # The daemon would use its own environment, not ours
+        print("Not using hiveconfd for", url, ":", ", ".join(response["local"]),
+              file=debugw)
+        connection.close()
+        return None
+    return RemoteFolder(connection, "/", response)
+
+
+def _error_response(e):
+    """Make a daemon response for the Error e. Its arguments and
+    attributes are included when they can be sent, so that the client
+    can rebuild it with _make_remote_error()."""
+    response = {"error": e.__class__.__name__, "message": str(e)}
+    try:
+        json.dumps([e.args, vars(e)])
+    except (TypeError, ValueError):
+        return response
+    response.update(args=list(e.args), attributes=vars(e))
+    return response
+
+
+def _make_remote_error(response):
+    """Rebuild the exception of an error response. The constructor of
+    the class is not called, since it may take other arguments than
+    the ones in args. An Error with the message is used if the
+    exception cannot be rebuilt."""
+    message = response.get("message", "")
+    error = globals().get(response["error"])
+    if not (isinstance(error, type) and issubclass(error, Error)) or \
+       "attributes" not in response:
+        return Error(message)
+    e = error.__new__(error)
+    e.args = tuple(response["args"])
+    vars(e).update(response["attributes"])
+    try:
+        str(e)
+    except Exception:
+        return Error(message)
+    return e
+
+
+class _DaemonConnection:
+    def __init__(self, sock, url):
+        self.sock = sock
+        self.url = url
+        self.rfile = sock.makefile("rb")
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def request(self, op, folder, path, **args):
+        args.update(op=op, hive=self.url, folder=folder, path=path)
+        line = json.dumps(args).encode("UTF-8") + b"\n"
+        with self.lock:
+            self.sock.sendall(line)
+            line = self.rfile.readline()
+        if not line:
+            raise Error("hiveconfd closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise _make_remote_error(response)
+        return response
+
+
+class RemoteFolder:
+    """A folder of a hive opened with open_daemon_hive(). It has the
+    get, set and delete methods, lookup(), get_folders() and
+    get_parameters() of Folder. lookup() returns a RemoteFolder for
+    folders, and a Parameter holding a copy of the value for
+    parameters."""
+    def __init__(self, connection, path, info):
+        self._connection = connection
+        self._path = path
+        self.sources = info["sources"]
+        self.write_target = info["write_target"]
+        self.sectionname = info["sectionname"]
+
+    def __repr__(self):
+        return "<RemoteFolder: %s  hive=%s>" % (self._path, self._connection.url)
+
+    def _request(self, op, path, **args):
+        return self._connection.request(op, self._path, path, **args)
+
+    def _subfolder(self, path, info):
+        path = self._path.rstrip("/") + "/" + path.lstrip("/")
+        return RemoteFolder(self._connection, path, info)
+
+    def lookup(self, objpath):
+        info = self._request("lookup", objpath)
+        if info["type"] == "folder":
+            return self._subfolder(objpath, info)
+        if info["type"] == "parameter":
+            return _make_remote_parameter(info)
+        return None
+
+    def walk(self, topdown=True, prune=None, depth=None):
+        """Like Folder.walk(). The tree down to depth is fetched from
+        the daemon with one request, before anything is yielded."""
+        # path -> (params, subfolders)
+        nodes = {}
+        result = self._request("walk", "/", depth=depth)["result"]
+        for (path, params, subfolders) in result:
+            params = [(name, _make_remote_parameter(paraminfo))
+                      for (name, paraminfo) in params]
+            subfolders = [(name, self._subfolder(path.rstrip("/") + "/" + name,
+                                                 info))
+                          for (name, info) in subfolders]
+            nodes[path] = (params, subfolders)
+        return self._walk(nodes, "/", self, topdown, prune)
+
+    def _walk(self, nodes, path, folder, topdown, prune):
+        (params, subfolders) = nodes[path]
+        if topdown:
+            yield (path, folder, params, subfolders)
+        for (name, subfolder) in subfolders:
+            subpath = path.rstrip("/") + "/" + name
+            if subpath not in nodes:
+                # Below depth
+                continue
+            if prune is not None and prune(subpath, subfolder):
+                continue
+            yield from self._walk(nodes, subpath, subfolder, topdown, prune)
+        if not topdown:
+            yield (path, folder, params, subfolders)
+
+    def get_folders(self, folderpath, default=None):
+        if default == None:
+            default = []
+        result = self._request("folders", folderpath)["result"]
+        if result is None:
+            return default
+        return result
+
+    def get_parameters(self, folderpath, default=None):
+        if default == None:
+            default = []
+        result = self._request("parameters", folderpath)["result"]
+        if result is None:
+            return default
+        return result
+
+    def delete(self, path, recursive=0):
+        return self._request("delete", path, recursive=recursive)["result"]
+
+    def _get_value(self, parampath, default, method):
+        value = self._request("get", parampath)["value"]
+        if value is None:
+            return default
+        return method(Parameter(value, self._connection.url, "", "", None))
+
+    def _set_value(self, parampath, value, method):
+        # Encode the value like Folder does
+        param = Parameter("", self._connection.url, "", "", None)
+        method(param, value)
+        return self._request("set", parampath, value=param._value)["result"]
+
+
+def _make_remote_parameter(info):
+    return Parameter(info["value"], info["source"], info["sectionname"],
+                     info["paramname"], info["write_target"])
+
+def _add_remote_methods():
+    for kind in ("string", "bool", "integer", "float", "binary",
+                 "string_list", "bool_list", "integer_list", "float_list",
+                 "binary_list"):
+        def get(self, parampath, default=None, method=getattr(Parameter, "get_" + kind)):
+            return self._get_value(parampath, default, method)
+        def set(self, parampath, value, method=getattr(Parameter, "set_" + kind)):
+            return self._set_value(parampath, value, method)
+        get.__name__ = "get_" + kind
+        set.__name__ = "set_" + kind
+        setattr(RemoteFolder, get.__name__, get)
+        setattr(RemoteFolder, set.__name__, set)
+
+_add_remote_methods()
+
+
+class _DaemonHive:
+    """A hive kept in memory by the daemon"""
+    def __init__(self, url):
+        self.url = url
+        self.root = None
+        # path -> _dependency_key() when the hive was parsed
+        self.dependencies = {}
+        self.lock = threading.Lock()
+
+    def get_root(self):
+        """Get the root folder, parsing the hive again if any file it
+        was parsed from has changed"""
+        with self.lock:
+            if self.root is not None:
+                for (path, key) in self.dependencies.items():
+                    if _dependency_key(path) != key:
+                        print("Reloading", self.url, ":", path, "changed", file=debugw)
+                        self.root = None
+                        break
+            if self.root is None:
+                hfp = _HiveFileParser(self.url, None)
+                hfp.dependencies = {}
+                root = hfp.parse()
+                if not root:
+                    raise NoSuchObjectError(self.url)
+                root._enable_threadsafe()
+                (self.root, self.dependencies) = (root, hfp.dependencies)
+            return self.root
+
+    def local_dependencies(self):
+        """Get the dependencies whose contents depend on the process
+        reading them: environment variables and memory hives"""
+        with self.lock:
+            return sorted(path for path in self.dependencies
+                          if path.startswith(("environ:", "memory://")))
+
+    def written(self, url, old_key):
+        """Accept the current state of the file at url, which was
+        changed by the daemon itself. old_key is the _dependency_key()
+        of the file before the change. If it is not the one the tree
+        was parsed from, another process has changed the file as well,
+        and the hive is parsed again on next use."""
+        path = _get_url_path(url)
+        with self.lock:
+            if path in self.dependencies:
+                if self.dependencies[path] == old_key:
+                    self.dependencies[path] = _dependency_key(path)
+                else:
+                    self.root = None
+
+
+class HiveDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server for open_daemon_hive() clients, listening on the Unix
+    socket socket_path. Writes are done one at a time per file."""
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        self.hives = {}
+        # Write target URL -> lock held while writing to it
+        self.write_locks = {}
+        self.lock = threading.Lock()
+        if os.path.exists(socket_path):
+            # Left by a daemon which has exited?
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise Error("%s: hiveconfd is already running" % socket_path)
+            finally:
+                probe.close()
+        oldmask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path,
+                                                   _DaemonRequestHandler)
+        finally:
+            os.umask(oldmask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+    def get_hive(self, url):
+        with self.lock:
+            hive = self.hives.get(url)
+            if hive is None:
+                hive = self.hives[url] = _DaemonHive(url)
+            return hive
+
+    def write_lock(self, url):
+        with self.lock:
+            return self.write_locks.setdefault(url, threading.Lock())
+
+    def handle_request_line(self, line):
+        """Handle one request. Returns the response."""
+        try:
+            request = json.loads(line)
+            hive = self.get_hive(request["hive"])
+            root = hive.get_root()
+            folder = root.lookup(request["folder"])
+            if not isinstance(folder, Folder):
+                raise NoSuchFolderError(request["folder"])
+            op = getattr(self, "op_" + request["op"], None)
+            if op is None:
+                raise Error("unknown operation %r" % request["op"])
+            return op(hive, folder, request)
+        except Error as e:
+            return _error_response(e)
+        except (ValueError, KeyError, TypeError) as e:
+            return _error_response(Error("bad request: %s" % e))
+        except OSError as e:
+            return _error_response(Error(str(e)))
+
+    def _write(self, hive, folder, path, function, *args):
+        url = folder._guess_write_target(path)
+        with self.write_lock(url):
+            if url:
+                old_key = _dependency_key(_get_url_path(url))
+            result = function(*args)
+            if url:
+                hive.written(url, old_key)
+        return result
+
+    def _info(self, obj):
+        """Get the attributes of obj for a lookup response"""
+        if isinstance(obj, Folder):
+            return {"type": "folder", "sources": obj.sources,
+                    "write_target": obj.write_target,
+                    "sectionname": obj.sectionname}
+        if isinstance(obj, Parameter):
+            return {"type": "parameter", "value": obj._value,
+                    "source": obj.source, "sectionname": obj.sectionname,
+                    "paramname": obj.paramname,
+                    "write_target": obj.write_target}
+        return {"type": None}
+
+    def op_open(self, hive, folder, request):
+        return dict(self._info(folder), local=hive.local_dependencies())
+
+    def op_lookup(self, hive, folder, request):
+        return self._info(folder.lookup(request["path"]))
+
+    def op_get(self, hive, folder, request):
+        return {"value": folder._get_value(request["path"], None,
+                                           Parameter.get_string)}
+
+    def op_folders(self, hive, folder, request):
+        obj = folder.lookup(request["path"])
+        if not isinstance(obj, Folder):
+            return {"result": None}
+        return {"result": folder.get_folders(request["path"])}
+
+    def op_parameters(self, hive, folder, request):
+        obj = folder.lookup(request["path"])
+        if not isinstance(obj, Folder):
+            return {"result": None}
+        return {"result": folder.get_parameters(request["path"])}
+
+    def op_walk(self, hive, folder, request):
+        """Get (path, [(name, lookup response), ...] for parameters,
+        [(name, lookup response), ...] for subfolders) for the folder
+        at path, which may be "/" for the folder itself, and every
+        folder at most depth levels below it"""
+        if request["path"] in ("", "/"):
+            obj = folder
+        else:
+            obj = folder.lookup(request["path"])
+        if not isinstance(obj, Folder):
+            raise NoSuchFolderError(request["path"])
+        result = []
+        for (path, subfolder, params, subfolders) in \
+                obj.walk(depth=request.get("depth")):
+            result.append((path,
+                           [(name, self._info(param)) for (name, param) in params],
+                           [(name, self._info(f)) for (name, f) in subfolders]))
+        return {"result": result}
+
+    def op_set(self, hive, folder, request):
+        path = request["path"]
+        return {"result": self._write(hive, folder, path, folder.set_string,
+                                      path, request["value"])}
+
+    def op_delete(self, hive, folder, request):
+        path = request["path"]
+        return {"result": self._write(hive, folder, path, folder.delete,
+                                      path, request.get("recursive", 0))}
+
+
+class _DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            response = self.server.handle_request_line(line)
+            self.wfile.write(json.dumps(response).encode("UTF-8") + b"\n")
+
+
+def run_daemon(socket_path=None):
+    """Run hiveconfd on socket_path until interrupted"""
+    if socket_path is None:
+        socket_path = get_daemon_socket()
+    server = HiveDaemon(socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+_mounters["hivefile"] = _HiveFileParser._mount_hivefile
+_mounters["memory"] = _HiveFileParser._mount_memory
+_updaters["memory"] = _MemoryUpdater
+register_backend("filesystem", _filesystem_backend)
+register_backend("sqlite", _sqlite_backend, _SqliteUpdater)
+register_backend("hivebin", _hivebin_backend)
+register_backend("environ", _environ_backend, urls=0)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*-Python-*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+def get_origin_dir():
+    """Get program origin directory"""
+    return os.path.dirname(os.path.realpath(__file__))
+
+sys.path.append(os.path.realpath(os.path.join(get_origin_dir(), "../")))
+sys.path.append(os.path.realpath(os.path.join(get_origin_dir(), "../benchmarks")))
+import hiveconf
+import genhive
+import bench
+
+
+class GenerateHiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_generate_hive(self):
+        # When
+        hive = genhive.generate_hive(self.tmpdir, sections=7, params=6, depth=3,
+                                     mounts=2, fanout=3)
+        # Then
+        self.assertEqual(len(hive["files"]), 6)
+        self.assertEqual(len(hive["params"]), 42)
+        root = hiveconf.open_hive(hive["root"])
+        for (path, paramtype) in hive["params"]:
+            getter = getattr(root, "get_" + paramtype)
+            self.assertIsNotNone(getter(path), path)
+        self.assertEqual(root.get_integer("/s5/d1/d2/p1"), 6)
+        self.assertEqual(root.lookup("/s5/d1/d2/p1").source,
+                         "file://" + os.path.join(self.tmpdir, "glob", "g2.hconf"))
+
+
+class RunBenchmarksTest(unittest.TestCase):
+    def test_run_benchmarks(self):
+        # Given
+        config = {"ops": 20, "writes": 3, "repeat": 2, "seed": 0,
+                  "hive": {"sections": 5, "params": 5, "mounts": 1}}
+        # When
+        data = bench.run_benchmarks(config)
+        # Then
+        self.assertEqual(data["config"], config)
+        self.assertEqual(list(data["results"]),
+                         [name for (name, func) in bench.BENCHMARKS])
+        for result in data["results"].values():
+            self.assertGreater(result["ops_per_sec"], 0)
+            self.assertLessEqual(result["p50_us"], result["p99_us"])
+            self.assertLessEqual(result["p99_us"], result["max_us"])
+            self.assertIn("peak_memory_bytes", result)
+        self.assertEqual(data["results"]["delete"]["ops"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,13 @@
 # For more information, see http://www.cendio.com
 import os
 import sys
+import shutil
+import tempfile
+import threading
+import asyncio
+import time
+import gc
+import weakref
 import unittest
 import getopt
 
@@ -397,6 +404,13 @@ class HiveconfParameterTest(unittest.TestCase):
         # Then
         self.assertEqual(p._value, "2ef0f1f2")
 
+    def test_set_binary_not_bytes(self):
+        # Given
+        p = hiveconf.Parameter("50", "file1", "section1", "param1", "file1")
+        # When/Then
+        self.assertRaises(hiveconf.BadBinaryFormat, p.set_binary, "zz")
+        self.assertEqual(p._value, "50")
+
     def test_set_string_list(self):
         # Given
         p = hiveconf.Parameter("A B C D E F G H", "file1", "section1", "param1", "file1")
@@ -437,6 +451,55 @@ class HiveconfParameterTest(unittest.TestCase):
         # Then
         self.assertEqual(p._value, "464f4f 424152")
 
+    def test_get_integer_memoized(self):
+        # Given
+        p = hiveconf.Parameter("12", "file1", "section1", "param1", "file1")
+        p.get_integer()
+        # When
+        with mock.patch.object(p, "_value", "not used"):
+            r = p.get_integer()
+        # Then
+        self.assertEqual(r, 12)
+
+    def test_get_integer_memoized_error(self):
+        # Given
+        p = hiveconf.Parameter("twelve", "file1", "section1", "param1", "file1")
+        self.assertRaises(hiveconf.BadIntegerFormat, p.get_integer)
+        # When / Then
+        self.assertRaises(hiveconf.BadIntegerFormat, p.get_integer)
+        self.assertEqual(p._decoded["integer"], (0, (hiveconf.BadIntegerFormat, ())))
+
+    def test_get_list_memoized_error_message(self):
+        # Given
+        p = hiveconf.Parameter("1 x", "file1", "section1", "param1", "file1")
+        with self.assertRaises(ValueError) as first:
+            p.get_integer_list()
+        # When
+        with self.assertRaises(ValueError) as second:
+            p.get_integer_list()
+        # Then
+        self.assertIn("invalid literal for int()", str(first.exception))
+        self.assertEqual(str(second.exception), str(first.exception))
+
+    def test_set_invalidates_memo(self):
+        # Given
+        p = hiveconf.Parameter("1 2", "file1", "section1", "param1", "file1")
+        p.get_integer_list()
+        p.get_string_list()
+        # When
+        p.set_integer_list([3])
+        # Then
+        self.assertEqual(p.get_integer_list(), [3])
+        self.assertEqual(p.get_string_list(), ["3"])
+
+    def test_get_list_memoized_returns_copy(self):
+        # Given
+        p = hiveconf.Parameter("1 2", "file1", "section1", "param1", "file1")
+        # When
+        p.get_integer_list().append(3)
+        # Then
+        self.assertEqual(p.get_integer_list(), [1, 2])
+
 
 class HiveconfFolderTest(unittest.TestCase):
     # -- Help Functions --
@@ -571,8 +634,8 @@ class HiveconfFolderTest(unittest.TestCase):
     @mock.patch("hiveconf.Folder._lookup_list")
     @mock.patch("hiveconf.urllib.parse.urlsplit", return_value=("file", "n", "f", "q", "f"))
     @mock.patch("hiveconf.Parameter.write_update")
-    @mock.patch("hiveconf._HiveFileUpdater.delete_section")
-    def test_delete_param_recursive(self, delete_section, write_update, urlsplit,
+    @mock.patch("hiveconf._HiveFileUpdater.delete_objects")
+    def test_delete_param_recursive(self, delete_objects, write_update, urlsplit,
                                     lookup_list, lookup, check_write_access):
         # Given
         child = hiveconf.Parameter("val1", "file1", "r/p", "c", "file1")
@@ -586,16 +649,16 @@ class HiveconfFolderTest(unittest.TestCase):
         r = root.delete("r/p", recursive=1)
         # Then
         self.assertEqual(r, 1)
-        write_update.assert_called_once_with(delete=1)
-        delete_section.assert_called_once_with("/r/p")
+        write_update.assert_not_called()
+        delete_objects.assert_called_once_with(["/r/p"], [("r/p", "c")])
 
     @mock.patch("hiveconf._check_write_access", return_value=True)
     @mock.patch("hiveconf.Folder.lookup")
     @mock.patch("hiveconf.Folder._lookup_list")
     @mock.patch("hiveconf.urllib.parse.urlsplit", return_value=("file", "n", "f", "q", "f"))
     @mock.patch("hiveconf.Parameter.write_update")
-    @mock.patch("hiveconf._HiveFileUpdater.delete_section")
-    def test_delete_param_recursive_non_ascii(self, delete_section, write_update, urlsplit,
+    @mock.patch("hiveconf._HiveFileUpdater.delete_objects")
+    def test_delete_param_recursive_non_ascii(self, delete_objects, write_update, urlsplit,
                                               lookup_list, lookup, check_write_access):
         # Given
         child = hiveconf.Parameter("val1", "file1", "я/þ", "¢", "file1")
@@ -609,15 +672,15 @@ class HiveconfFolderTest(unittest.TestCase):
         r = root.delete("я/þ", recursive=1)
         # Then
         self.assertEqual(r, 1)
-        write_update.assert_called_once_with(delete=1)
-        delete_section.assert_called_once_with("/я/þ")
+        write_update.assert_not_called()
+        delete_objects.assert_called_once_with(["/я/þ"], [("я/þ", "¢")])
 
     @mock.patch("hiveconf._check_write_access", return_value=True)
     @mock.patch("hiveconf.Folder.lookup")
     @mock.patch("hiveconf.Folder._lookup_list")
     @mock.patch("hiveconf._HiveFileUpdater.__init__", return_value=None)
-    @mock.patch("hiveconf._HiveFileUpdater.delete_section")
-    def test_delete_folder(self, delete_section, hivefileupdater, lookup_list,
+    @mock.patch("hiveconf._HiveFileUpdater.delete_objects")
+    def test_delete_folder(self, delete_objects, hivefileupdater, lookup_list,
                            lookup, check_write_access):
         # Given
         child = hiveconf.Folder("file1", "file1", "r/p/c")
@@ -631,12 +694,14 @@ class HiveconfFolderTest(unittest.TestCase):
         r = root.delete("r/p/c")
         # Then
         self.assertEqual(r, 1)
-        delete_section.assert_called_with(child.sectionname)
+        delete_objects.assert_called_once_with([child.sectionname], [])
 
+    @mock.patch("hiveconf._check_write_access", return_value=True)
     @mock.patch("hiveconf.Folder._lookup_list")
     @mock.patch("hiveconf._HiveFileUpdater.__init__", return_value=None)
-    @mock.patch("hiveconf._HiveFileUpdater.delete_section")
-    def test_delete_folder_no_parent(self, delete_section, hivefileupdater, lookup_list):
+    @mock.patch("hiveconf._HiveFileUpdater.delete_objects")
+    def test_delete_folder_no_parent(self, delete_objects, hivefileupdater, lookup_list,
+                                     check_write_access):
         # Given
         root = hiveconf.Folder("file1", "file1", "/")
         root._addobject(root, "/") # special setup for rootfolder
@@ -645,14 +710,14 @@ class HiveconfFolderTest(unittest.TestCase):
         r = root.delete("/", recursive=1) # recursive since it has itself as subfolder
         # Then
         self.assertEqual(r, 1)
-        delete_section.assert_called_with(root.sectionname)
+        delete_objects.assert_called_once_with([root.sectionname], [])
 
     @mock.patch("hiveconf._check_write_access", return_value=True)
     @mock.patch("hiveconf.Folder.lookup")
     @mock.patch("hiveconf.Folder._lookup_list")
     @mock.patch("hiveconf._HiveFileUpdater.__init__", return_value=None)
-    @mock.patch("hiveconf._HiveFileUpdater.delete_section")
-    def test_delete_folder_recursive(self, delete_section, hivefileupdater,
+    @mock.patch("hiveconf._HiveFileUpdater.delete_objects")
+    def test_delete_folder_recursive(self, delete_objects, hivefileupdater,
                                      lookup_list, lookup, check_write_access):
         # Given
         child = hiveconf.Folder("file1", "file1", "r/p/c")
@@ -666,16 +731,15 @@ class HiveconfFolderTest(unittest.TestCase):
         r = root.delete("r/p", recursive=1)
         # Then
         self.assertEqual(r, 1)
-        self.assertEqual(delete_section.call_count, 2)
-        delete_section.assert_any_call(child.sectionname)
-        delete_section.assert_any_call(parent.sectionname)
+        delete_objects.assert_called_once_with(
+            [parent.sectionname, child.sectionname], [])
 
     @mock.patch("hiveconf._check_write_access", return_value=True)
     @mock.patch("hiveconf.Folder.lookup")
     @mock.patch("hiveconf.Folder._lookup_list")
     @mock.patch("hiveconf._HiveFileUpdater.__init__", return_value=None)
-    @mock.patch("hiveconf._HiveFileUpdater.delete_section")
-    def test_delete_folder_recursive_non_ascii(self, delete_section, hivefileupdater,
+    @mock.patch("hiveconf._HiveFileUpdater.delete_objects")
+    def test_delete_folder_recursive_non_ascii(self, delete_objects, hivefileupdater,
                                                lookup_list, lookup, check_write_access):
         # Given
         child = hiveconf.Folder("file1", "file1", "я/þ/¢")
@@ -689,9 +753,8 @@ class HiveconfFolderTest(unittest.TestCase):
         r = root.delete("я/þ", recursive=1)
         # Then
         self.assertEqual(r, 1)
-        self.assertEqual(delete_section.call_count, 2)
-        delete_section.assert_any_call(child.sectionname)
-        delete_section.assert_any_call(parent.sectionname)
+        delete_objects.assert_called_once_with(
+            [parent.sectionname, child.sectionname], [])
 
     @mock.patch("hiveconf._check_write_access", return_value=True)
     @mock.patch("hiveconf.Folder._lookup_list")
@@ -2087,6 +2150,8 @@ class HiveFileUpdaterTest(unittest.TestCase):
     def setUp(self):
         # Creates empty file if it doesnt exist
         self._clear_test_file("UTF-8")
+        # The test file is rewritten behind the updater's back
+        hiveconf._offset_indexes.clear()
 
     def tearDown(self):
         if os.path.exists(self.test_filename):
@@ -2352,19 +2417,14 @@ class HiveFileUpdaterTest(unittest.TestCase):
 
 
     def test_delete_section_file_contains_section(self):
-        # FIXME: This test is disabled since delete_section() is broken,
-        #        see https://www.cendio.com/bugzilla/show_bug.cgi?id=6122
-        # The test below is written according to this broken behaviour.
-        self.skipTest("delete_section is broken.")
-
         # Given
         encoding = "UTF-8"
         sectionname = "section_1"
-        content_list = ["[%s]" % (sectionname), "section content", "rest of file"]
+        content_list = ["[%s]" % (sectionname), "a=1", "b=2", "[section_2]", "rest of file"]
         updater_obj = hiveconf._HiveFileUpdater("file://path/file.hconf")
         updater_obj.filename = self.test_filename
 
-        expected_content_list = ["rest of file"]
+        expected_content_list = ["[section_2]", "rest of file"]
         expected_content = self._content_list_to_string(expected_content_list)
 
         self._clear_test_file(encoding)
@@ -2379,19 +2439,14 @@ class HiveFileUpdaterTest(unittest.TestCase):
             self.assertEqual(file_content, expected_content)
 
     def test_delete_section_file_contains_section_non_ascii(self):
-        # FIXME: This test is disabled since delete_section() is broken,
-        #        see https://www.cendio.com/bugzilla/show_bug.cgi?id=6122
-        # The test below is written according to this broken behaviour.
-        self.skipTest("delete_section is broken.")
-
         # Given
         encoding = "UTF-8"
         sectionname = "secti☺η_←æ"
-        content_list = ["[%s]" % (sectionname), "sectiøn日cöntent", "rëst of ḟḯʟℯ"]
+        content_list = ["[%s]" % (sectionname), "sectiøn=日cöntent", "[ḟḯʟℯ]", "rëst=of"]
         updater_obj = hiveconf._HiveFileUpdater("file://path//食パン.hconf")
         updater_obj.filename = self.test_filename
 
-        expected_content_list = ["rëst of ḟḯʟℯ"]
+        expected_content_list = ["[ḟḯʟℯ]", "rëst=of"]
         expected_content = self._content_list_to_string(expected_content_list)
 
         self._clear_test_file(encoding)
@@ -2406,19 +2461,15 @@ class HiveFileUpdaterTest(unittest.TestCase):
             self.assertEqual(file_content, expected_content)
 
     def test_delete_section_file_with_lines_to_skip(self):
-        # FIXME: This test is disabled since delete_section() is broken,
-        #        see https://www.cendio.com/bugzilla/show_bug.cgi?id=6122
-        # The test below is written according to this broken behaviour.
-        self.skipTest("delete_section is broken.")
-
         # Given
         encoding = "UTF-8"
         sectionname = "section_1"
-        content_list = ["# line 1", "; line 2", "  ", "[%s]" % (sectionname), "remove", "rest of file"]
+        content_list = ["# line 1", "; line 2", "  ", "[%s]" % (sectionname), "remove=1",
+                        "[%s]" % (sectionname), "# remove", "[rest]"]
         updater_obj = hiveconf._HiveFileUpdater("file://path/file.hconf")
         updater_obj.filename = self.test_filename
 
-        expected_content_list = ["# line 1", "; line 2", "  ", "rest of file"]
+        expected_content_list = ["# line 1", "; line 2", "  ", "[rest]"]
         expected_content = self._content_list_to_string(expected_content_list)
 
         self._clear_test_file(encoding)
@@ -2432,24 +2483,57 @@ class HiveFileUpdaterTest(unittest.TestCase):
             file_content = file.read()
             self.assertEqual(file_content, expected_content)
 
-    def test_delete_section_file_with_invalid_section(self):
-        # FIXME: This test is disabled since delete_section() is broken,
-        #        see https://www.cendio.com/bugzilla/show_bug.cgi?id=6122
-        # The test below is written according to this broken behaviour.
-        self.skipTest("delete_section is broken.")
+    def test_delete_section_missing(self):
+        # Given
+        encoding = "UTF-8"
+        content_list = ["[section_1]", "a=1"]
+        updater_obj = hiveconf._HiveFileUpdater("file://path/file.hconf")
+        updater_obj.filename = self.test_filename
+
+        self._clear_test_file(encoding)
+        self._set_up_test_file(content_list, encoding)
+
+        # When
+        updater_obj.delete_section("section_2")
+
+        # Then
+        with open(self.test_filename, "r", encoding=encoding) as file:
+            self.assertEqual(file.read(), self._content_list_to_string(content_list))
+
+    def test_delete_objects(self):
+        # Given
+        encoding = "UTF-8"
+        content_list = ["top=1", "[a]", "x=1", "y=2", "[a/b]", "z=3", "[c]", "y=4", "[a]", "y=5"]
+        updater_obj = hiveconf._HiveFileUpdater("file://path/file.hconf")
+        updater_obj.filename = self.test_filename
+
+        expected_content_list = ["top=1", "[a]", "x=1", "[c]", "y=4", "[a]", "y=5"]
+        expected_content = self._content_list_to_string(expected_content_list)
+
+        self._clear_test_file(encoding)
+        self._set_up_test_file(content_list, encoding)
+
+        # When
+        updater_obj.delete_objects(["a/b"], [("a", "y"), ("c", "missing")])
+
+        # Then
+        with open(self.test_filename, "r", encoding=encoding) as file:
+            self.assertEqual(file.read(), expected_content)
 
+    def test_delete_section_file_with_invalid_section(self):
         # Given
         encoding = "UTF-8"
         sectionname = "section_1"
         content_list = ["[missing_end_bracket",
                         "[%s]" % (sectionname),
                         "this line is removed",
+                        "[missing_end_bracket",
+                        "[section_2]",
                         "this is not removed"]
         updater_obj = hiveconf._HiveFileUpdater("file://path/file.hconf")
         updater_obj.filename = self.test_filename
 
-        # This is how it works... yep.
-        expected_content_list = ["[missing_end_bracket", "this is not removed"]
+        expected_content_list = ["[missing_end_bracket", "[section_2]", "this is not removed"]
         expected_content = self._content_list_to_string(expected_content_list)
 
         self._clear_test_file(encoding)
@@ -2536,5 +2620,2193 @@ class HiveconfIntegrationTest(unittest.TestCase):
         self.assertEqual(self.hive.get_integer("/sub2/int1"), 3)
 
 
+class SnapshotCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        self.mounted = os.path.join(self.tmpdir, "mounted.hconf")
+        self.cache = os.path.join(self.tmpdir, "top.hcache")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("%mount mounted.hconf\n")
+        with open(self.mounted, "w", encoding="UTF-8") as f:
+            f.write("[/sub]\nint1 = 3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_snapshot_is_used(self):
+        # Given
+        hiveconf.open_hive(self.top, cache=self.cache)
+        # When
+        with mock.patch("hiveconf._HiveFileParser.parse") as parse:
+            hive = hiveconf.open_hive(self.top, cache=self.cache)
+        # Then
+        parse.assert_not_called()
+        self.assertEqual(hive.get_integer("/sub/int1"), 3)
+        self.assertEqual(hive.lookup("/sub").write_target,
+                         "file://" + self.mounted)
+
+    def test_snapshot_stale_after_mounted_file_change(self):
+        # Given
+        hiveconf.open_hive(self.top, cache=self.cache)
+        with open(self.mounted, "w", encoding="UTF-8") as f:
+            f.write("[/sub]\nint1 = 42\n")
+        # When
+        hive = hiveconf.open_hive(self.top, cache=self.cache)
+        # Then
+        self.assertEqual(hive.get_integer("/sub/int1"), 42)
+
+    def test_snapshot_stale_after_glob_match_added(self):
+        # Given
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("%mount *.conf\n")
+        hiveconf.open_hive(self.top, cache=self.cache)
+        with open(os.path.join(self.tmpdir, "new.conf"), "w",
+                  encoding="UTF-8") as f:
+            f.write("added = yes\n")
+        # When
+        hive = hiveconf.open_hive(self.top, cache=self.cache)
+        # Then
+        self.assertEqual(hive.get_string("/added"), "yes")
+
+    def test_snapshot_broken_file(self):
+        # Given
+        with open(self.cache, "wb") as f:
+            f.write(b"garbage")
+        # When
+        hive = hiveconf.open_hive(self.top, cache=self.cache)
+        # Then
+        self.assertEqual(hive.get_integer("/sub/int1"), 3)
+
+    def test_snapshot_not_picklable(self):
+        # When
+        with mock.patch("hiveconf.pickle.dump",
+                        side_effect=TypeError("cannot pickle '_thread.lock' object")):
+            hive = hiveconf.open_hive(self.top, cache=self.cache)
+        # Then
+        self.assertEqual(hive.get_integer("/sub/int1"), 3)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["mounted.hconf", "top.hconf"])
+
+
+class LazyMountTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "w", encoding="UTF-8") as f:
+            f.write(content)
+        return path
+
+    def test_mount_not_parsed_before_use(self):
+        # Given
+        top = self._write("top.hconf", "[/a]\n%mount a.hconf\n"
+                          "[/b]\n%mount b.hconf\n")
+        self._write("a.hconf", "x = 1\n")
+        self._write("b.hconf", "y = 2\n")
+        hive = hiveconf.open_hive(top, lazy=1)
+        # When
+        with mock.patch("hiveconf._HiveFileParser._parse_tokens", autospec=True,
+                        side_effect=hiveconf._HiveFileParser._parse_tokens) as parse:
+            r = hive.get_integer("/a/x")
+        # Then
+        self.assertEqual(r, 1)
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(len(hive.lookup("/b")._mounts), 1)
+        self.assertEqual(hive.get_parameters("/b"), ["y"])
+
+    def test_precedence_between_mounts(self):
+        # Given
+        top = self._write("top.hconf", "%mount a.hconf\n%mount b.hconf\n")
+        self._write("a.hconf", "[/s]\nx = a\n")
+        self._write("b.hconf", "[/s]\nx = b\ny = b\n")
+        # When
+        hive = hiveconf.open_hive(top, lazy=1)
+        # Then
+        self.assertEqual(hive.get_string("/s/x"), "a")
+        self.assertEqual(hive.get_string("/s/y"), "b")
+
+    def test_precedence_mount_before_definition(self):
+        # Given
+        top = self._write("top.hconf", "[/s]\n%mount a.hconf\nx = top\n")
+        self._write("a.hconf", "x = a\n")
+        # When
+        hive = hiveconf.open_hive(top, lazy=1)
+        # Then
+        self.assertEqual(hive.get_string("/s/x"), "a")
+
+    def test_precedence_nested_mount(self):
+        # Given
+        top = self._write("top.hconf", "%mount a.hconf\n%mount c.hconf\n")
+        self._write("a.hconf", "%mount b.hconf\nx = a\n")
+        self._write("b.hconf", "x = b\ny = b\n")
+        self._write("c.hconf", "y = c\nz = c\n")
+        # When
+        hive = hiveconf.open_hive(top, lazy=1)
+        # Then
+        self.assertEqual(hive.get_string("/x"), "b")
+        self.assertEqual(hive.get_string("/y"), "b")
+        self.assertEqual(hive.get_string("/z"), "c")
+
+    def test_get_folders_resolves(self):
+        # Given
+        top = self._write("top.hconf", "%mount a.hconf\n")
+        self._write("a.hconf", "[/f1]\n[/f2]\n")
+        # When
+        hive = hiveconf.open_hive(top, lazy=1)
+        # Then
+        self.assertEqual(sorted(hive.get_folders("/")), ["/", "f1", "f2"])
+
+
+class ParallelMountTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("%mount d/*.hconf\n")
+        os.mkdir(os.path.join(self.tmpdir, "d"))
+        for i in range(20):
+            with open(os.path.join(self.tmpdir, "d", "%02d.hconf" % i), "w",
+                      encoding="UTF-8") as f:
+                f.write("[/shared]\nwinner = %d\nown%d = %d\n" % (i, i, i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_result_as_serial(self):
+        # When
+        serial = hiveconf.open_hive(self.top)
+        parallel = hiveconf.open_hive(self.top, workers=4)
+        # Then
+        self.assertEqual(parallel.get_integer("/shared/winner"), 0)
+        self.assertEqual(parallel.get_parameters("/shared"),
+                         serial.get_parameters("/shared"))
+        self.assertEqual(parallel.lookup("/shared").sources,
+                         serial.lookup("/shared").sources)
+
+    def test_syntax_error_reported_at_merge(self):
+        # Given
+        with open(os.path.join(self.tmpdir, "d", "05.hconf"), "w",
+                  encoding="UTF-8") as f:
+            f.write("bad line\n")
+        # When / Then
+        with self.assertRaises(hiveconf.SyntaxError):
+            hiveconf.open_hive(self.top, workers=4)
+
+
+class PathIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("top = 1\n[/a/b]\nparam = 2\n")
+        self.hive = hiveconf.open_hive(self.top)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index_built_during_parse(self):
+        # Then
+        self.assertEqual(sorted(self.hive._index), ["a", "a/b", "a/b/param", "top"])
+        self.assertIs(self.hive.lookup("/a/b/param"),
+                      self.hive._lookup_list(["a", "b", "param"]))
+
+    def test_lookup_relative_to_subfolder(self):
+        # Given
+        folder = self.hive.lookup("/a")
+        # When
+        r = folder.lookup("b/param")
+        # Then
+        self.assertEqual(r.get_string(), "2")
+
+    def test_lookup_missing(self):
+        # Then
+        self.assertIsNone(self.hive.lookup("/a/b/missing"))
+        self.assertIsNone(self.hive.lookup("/missing/deeper"))
+        self.assertIs(self.hive.lookup("/"), self.hive)
+
+    def test_lookup_through_parameter(self):
+        # When / Then
+        with self.assertRaises(hiveconf.ObjectExistsError):
+            self.hive.lookup("/top/below")
+
+    def test_index_follows_set_and_delete(self):
+        # When
+        self.hive.set_string("/c/d/new", "x")
+        self.hive.delete("/a/b", recursive=1)
+        # Then
+        self.assertEqual(sorted(self.hive._index), ["a", "c", "c/d", "c/d/new", "top"])
+        self.assertEqual(self.hive.get_string("/c/d/new"), "x")
+        self.assertIsNone(self.hive.lookup("/a/b/param"))
+
+
+def make_changes(hive):
+    """Changes used for comparing write methods"""
+    hive.set_integer("/a/x", 10)
+    hive.set_string("/a/new", "n")
+    hive.set_string("/c/d/p", "deep")
+    hive.set_integer("/top", 5)
+    hive.delete("/b/z")
+    hive.set_integer("/a/x", 11)
+
+
+class TransactionTest(unittest.TestCase):
+    content = ("top = 1\n"
+               "[/a]\n"
+               "x = 1\n"
+               "y = 2\n"
+               "[/b]\n"
+               "z = 3\n")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        self.other = os.path.join(self.tmpdir, "other.hconf")
+        for filename in (self.top, self.other):
+            with open(filename, "w", encoding="UTF-8") as f:
+                f.write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, filename):
+        with open(filename, encoding="UTF-8") as f:
+            return f.read()
+
+    def test_same_result_as_without_transaction(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        other = hiveconf.open_hive(self.other)
+        make_changes(other)
+        # When
+        with mock.patch("hiveconf._HiveFileUpdater.write_contents", autospec=True,
+                        side_effect=hiveconf._HiveFileUpdater.write_contents) as write:
+            with hive.transaction():
+                make_changes(hive)
+                # Nothing is written until the end
+                self.assertEqual(self._read(self.top), self.content)
+        # Then
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(self._read(self.top), self._read(self.other))
+        self.assertEqual(hive.get_integer("/a/x"), 11)
+
+    def test_many_changes_same_result_as_without_transaction(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        other = hiveconf.open_hive(self.other)
+
+        def changes(h):
+            for i in range(50):
+                h.set_integer("/a/n%d" % i, i)
+                h.set_integer("/b/n%d" % i, i)
+                h.set_integer("/r%d" % i, i)
+            for i in range(0, 50, 7):
+                h.set_integer("/a/n%d" % i, -i)
+            h.delete("/a/n3")
+            h.set_integer("/a/y", 20)
+            h.set_integer("/a/n60", 60)
+        changes(other)
+        # When
+        with hive.transaction():
+            changes(hive)
+        # Then
+        self.assertEqual(self._read(self.top), self._read(self.other))
+        self.assertEqual(hive.get_integer("/a/n14"), -14)
+        self.assertIsNone(hive.lookup("/a/n3"))
+
+    def test_set_below_parameter(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When/Then
+        with self.assertRaises(hiveconf.ObjectExistsError):
+            hive.set_string("/top/sub", "x")
+        self.assertEqual(self._read(self.top), self.content)
+
+    def test_set_folder(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When/Then
+        with self.assertRaises(hiveconf.NotAParameterError):
+            hive.set_string("/a", "x")
+        self.assertEqual(self._read(self.top), self.content)
+
+    def test_rollback_on_exception(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        with self.assertRaises(RuntimeError):
+            with hive.transaction():
+                make_changes(hive)
+                raise RuntimeError()
+        # Then
+        self.assertEqual(self._read(self.top), self.content)
+        self.assertEqual(hive.get_integer("/a/x"), 1)
+        self.assertEqual(hive.get_integer("/top"), 1)
+        self.assertEqual(hive.get_integer("/b/z"), 3)
+        self.assertIsNone(hive.lookup("/a/new"))
+        self.assertIsNone(hive.lookup("/c"))
+
+    def test_rollback_on_commit_error(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("[/a]\ny = 2\n")
+        # When
+        with self.assertRaises(hiveconf.NoSuchParameterError):
+            with hive.transaction():
+                hive.set_integer("/a/y", 20)
+                hive.set_integer("/a/x", 10)
+        # Then
+        self.assertEqual(self._read(self.top), "[/a]\ny = 2\n")
+        self.assertEqual(hive.get_integer("/a/y"), 2)
+
+    def test_nested_transaction(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        with hive.transaction():
+            with hive.transaction():
+                hive.set_integer("/a/x", 10)
+            self.assertEqual(self._read(self.top), self.content)
+        # Then
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 10)
+
+
+class AtomicWriteTest(unittest.TestCase):
+    content = TransactionTest.content
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        self.other = os.path.join(self.tmpdir, "other.hconf")
+        for filename in (self.top, self.other):
+            with open(filename, "w", encoding="UTF-8") as f:
+                f.write(self.content)
+        os.chmod(self.top, 0o640)
+
+    def tearDown(self):
+        hiveconf.set_write_policy(atomic=0, fsync=hiveconf.FSYNC_NONE)
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, filename):
+        with open(filename, encoding="UTF-8") as f:
+            return f.read()
+
+    def test_same_result_as_in_place(self):
+        # Given
+        make_changes(hiveconf.open_hive(self.other))
+        hive = hiveconf.open_hive(self.top)
+        inode = os.stat(self.top).st_ino
+        hiveconf.set_write_policy(atomic=1)
+        # When
+        make_changes(hive)
+        # Then
+        self.assertEqual(self._read(self.top), self._read(self.other))
+        self.assertNotEqual(os.stat(self.top).st_ino, inode)
+        self.assertEqual(os.stat(self.top).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["other.hconf", "top.hconf"])
+
+    @mock.patch("hiveconf.os.fsync")
+    def test_fsync_directory(self, fsync):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        hiveconf.set_write_policy(atomic=1, fsync=hiveconf.FSYNC_DIRECTORY)
+        # When
+        hive.set_integer("/a/x", 5)
+        # Then
+        self.assertEqual(fsync.call_count, 2)
+
+    @mock.patch("hiveconf.os.fsync")
+    def test_fsync_file_in_place(self, fsync):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        hiveconf.set_write_policy(fsync=hiveconf.FSYNC_FILE)
+        # When
+        hive.set_integer("/a/x", 5)
+        # Then
+        self.assertEqual(fsync.call_count, 1)
+        self.assertEqual(hive.get_integer("/a/x"), 5)
+
+    def test_invalid_fsync_policy(self):
+        # When / Then
+        with self.assertRaises(ValueError):
+            hiveconf.set_write_policy(fsync="always")
+
+
+@unittest.skipIf(hiveconf.fcntl is None, "no fcntl")
+class FileLockTest(unittest.TestCase):
+    content = TransactionTest.content
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write(self.content)
+        hiveconf.reset_lock_stats()
+
+    def tearDown(self):
+        hiveconf.set_lock_timeout(10.0)
+        hiveconf.set_write_policy(atomic=0)
+        shutil.rmtree(self.tmpdir)
+
+    def _hold(self, operation):
+        """Lock the file through another open file description"""
+        fd = os.open(self.top, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        hiveconf.fcntl.flock(fd, operation)
+        return fd
+
+    def test_write_counts_lock(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        hiveconf.reset_lock_stats()
+        # When
+        hive.set_integer("/a/x", 5)
+        # Then
+        stats = hiveconf.get_lock_stats()
+        self.assertEqual(stats["acquired"], 1)
+        self.assertEqual(stats["contended"], 0)
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 5)
+
+    def test_write_timeout(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        self._hold(hiveconf.fcntl.LOCK_SH)
+        hiveconf.set_lock_timeout(0.05)
+        # When / Then
+        with self.assertRaises(hiveconf.LockTimeout):
+            hive.set_integer("/a/x", 5)
+        stats = hiveconf.get_lock_stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["contended"], 1)
+        self.assertGreaterEqual(stats["wait_time"], 0.05)
+
+    def test_write_waits_for_reader(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        hiveconf.reset_lock_stats()
+        fd = self._hold(hiveconf.fcntl.LOCK_SH)
+        timer = threading.Timer(0.05, hiveconf.fcntl.flock,
+                                (fd, hiveconf.fcntl.LOCK_UN))
+        timer.start()
+        # When
+        hive.set_integer("/a/x", 5)
+        timer.join()
+        # Then
+        stats = hiveconf.get_lock_stats()
+        self.assertEqual(stats["contended"], 1)
+        self.assertGreater(stats["max_wait_time"], 0)
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 5)
+
+    def test_readers_share_lock(self):
+        # Given
+        self._hold(hiveconf.fcntl.LOCK_SH)
+        hiveconf.set_lock_timeout(0.05)
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_integer("/a/x"), 1)
+        self.assertEqual(hiveconf.get_lock_stats()["contended"], 0)
+
+    def test_read_waits_for_writer(self):
+        # Given
+        self._hold(hiveconf.fcntl.LOCK_EX)
+        hiveconf.set_lock_timeout(0.05)
+        # When / Then
+        with self.assertRaises(hiveconf.LockTimeout):
+            hiveconf.open_hive(self.top)
+
+    def test_lock_follows_atomic_replace(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        fd = self._hold(hiveconf.fcntl.LOCK_EX)
+        def replace():
+            tmpname = self.top + ".tmp"
+            with open(tmpname, "w", encoding="UTF-8") as f:
+                f.write(self.content.replace("x = 1", "x = 7"))
+            os.replace(tmpname, self.top)
+            hiveconf.fcntl.flock(fd, hiveconf.fcntl.LOCK_UN)
+        timer = threading.Timer(0.05, replace)
+        timer.start()
+        # When
+        hive.set_integer("/a/y", 9)
+        timer.join()
+        # Then
+        result = hiveconf.open_hive(self.top)
+        self.assertEqual(result.get_integer("/a/x"), 7)
+        self.assertEqual(result.get_integer("/a/y"), 9)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "no fork")
+    def test_reader_releases_lock_before_mounts(self):
+        # Given
+        root = os.path.join(self.tmpdir, "zroot.hconf")
+        sub = os.path.join(self.tmpdir, "d", "sub.hconf")
+        os.mkdir(os.path.dirname(sub))
+        with open(root, "w", encoding="UTF-8") as f:
+            f.write("x = 1\n[/d]\n%mount d/sub.hconf\n")
+        with open(sub, "w", encoding="UTF-8") as f:
+            f.write("y = 2\n")
+        hive = hiveconf.open_hive(root)
+        # A transaction locks d/sub.hconf before zroot.hconf
+        fd = os.open(sub, os.O_RDONLY)
+        hiveconf.fcntl.flock(fd, hiveconf.fcntl.LOCK_EX)
+        (rfd, wfd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(fd)
+                reader = hiveconf.open_hive(root)
+                os.write(wfd, reader.get_string("/d/y").encode())
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        time.sleep(0.2)
+        hiveconf.set_lock_timeout(0.5)
+        # When
+        try:
+            hive.set_integer("/x", 5)
+        finally:
+            os.close(fd)
+            os.waitpid(pid, 0)
+        # Then
+        self.assertEqual(os.read(rfd, 100), b"2")
+        os.close(rfd)
+        self.assertEqual(hiveconf.open_hive(root).get_integer("/x"), 5)
+
+
+class OffsetIndexTest(unittest.TestCase):
+    content = ("top = 1\n"
+               "# Ωmega\n"
+               "[/a]\n"
+               "ü = 1\n"
+               "y = 2\n"
+               "[/b]\n"
+               "z = 3\n")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        self._write(self.content)
+        hiveconf._offset_indexes.clear()
+
+    def tearDown(self):
+        hiveconf._offset_indexes.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, content, newline=None):
+        with open(self.top, "w", encoding="UTF-8", newline=newline) as f:
+            f.write(content)
+        # Old enough to be indexed
+        os.utime(self.top, (0, 0))
+
+    def _read(self):
+        with open(self.top, encoding="UTF-8") as f:
+            return f.read()
+
+    def _check_index(self):
+        index = hiveconf._offset_indexes[self.top]
+        with open(self.top, "rb") as f:
+            data = f.read()
+        for ((sectionname, paramname), (start, end)) in index.parameters.items():
+            line = data[start:end].decode("UTF-8")
+            self.assertEqual(line.split("=")[0].strip(), paramname)
+        for (sectionname, (start, end)) in index.sections.items():
+            self.assertEqual(data[start:end].decode("UTF-8").strip(),
+                             "[%s]" % sectionname)
+
+    def test_parse_primes_index(self):
+        # When
+        hiveconf.open_hive(self.top)
+        # Then
+        index = hiveconf._offset_indexes[self.top]
+        self.assertEqual(sorted(index.parameters),
+                         [("", "top"), ("/a", "y"), ("/a", "ü"), ("/b", "z")])
+        self._check_index()
+
+    @mock.patch("hiveconf._HiveFileUpdater._scan_offset")
+    @mock.patch("hiveconf._build_offset_index")
+    def test_updates_use_index(self, build, scan):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.set_string("/a/ü", "ÿÿÿ")
+        hive.set_integer("/a/new", 4)
+        hive.set_integer("/b/z", 30)
+        hive.set_integer("/c/w", 5)
+        hive.set_integer("/c/v", 6)
+        # Then
+        build.assert_not_called()
+        scan.assert_not_called()
+        self.assertEqual(self._read(),
+                         "top = 1\n"
+                         "# Ωmega\n"
+                         "[/a]\n"
+                         "new=4\n"
+                         "ü=ÿÿÿ\n"
+                         "y = 2\n"
+                         "[/b]\n"
+                         "z=30\n"
+                         "\n"
+                         "[/c]\n"
+                         "v=6\n"
+                         "w=5\n")
+        self._check_index()
+
+    def test_external_change_rebuilds_index(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        self._write("# Moved down\n" + self.content)
+        # When
+        hive.set_integer("/a/y", 20)
+        # Then
+        self.assertEqual(self._read(),
+                         "# Moved down\n" + self.content.replace("y = 2", "y=20"))
+        self._check_index()
+
+    def test_crlf_line_endings(self):
+        # Given
+        self._write(self.content, newline="\r\n")
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.set_integer("/b/z", 30)
+        # Then
+        with open(self.top, "rb") as f:
+            self.assertTrue(f.read().endswith(b"[/b]\r\nz=30\n"))
+
+    def test_crlf_two_writes(self):
+        # Given
+        self._write("[/a]\r\nx = 1\r\ny = 2\r\n[/b]\r\nz = 3\r\n", newline="")
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.set_string("/a/x", "10")
+        hive.set_string("/b/z", "30")
+        # Then
+        self.assertNotIn(self.top, hiveconf._offset_indexes)
+        self.assertEqual(self._read(), "[/a]\nx=10\ny = 2\n[/b]\nz=30\n")
+        hive = hiveconf.open_hive(self.top)
+        self.assertEqual(hive.get_string("/a/x"), "10")
+        self.assertEqual(hive.get_string("/a/y"), "2")
+        self.assertEqual(hive.get_string("/b/z"), "30")
+
+    def test_no_newline_at_end(self):
+        # Given
+        self._write("z = 3")
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.set_string("/c/w", "1")
+        hive.set_string("/z", "65")
+        # Then
+        self.assertEqual(self._read(), "z=65\n[/c]\nw=1\n")
+
+    def test_delete_drops_index(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.delete("/a/y")
+        # Then
+        self.assertNotIn(self.top, hiveconf._offset_indexes)
+        self.assertEqual(self._read(), self.content.replace("y = 2\n", ""))
+
+
+class RecursiveDeleteTest(unittest.TestCase):
+    content = ("top = 1\n"
+               "[/a]\n"
+               "x = 1\n"
+               "[/a/b]\n"
+               "y = 2\n"
+               "[/a/b/c]\n"
+               "z = 3\n"
+               "[/d]\n"
+               "w = 4\n")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with open(self.top, encoding="UTF-8") as f:
+            return f.read()
+
+    def test_one_rewrite(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        with mock.patch("hiveconf._HiveFileUpdater.write_contents", autospec=True,
+                        side_effect=hiveconf._HiveFileUpdater.write_contents) as write:
+            r = hive.delete("/a", recursive=1)
+        # Then
+        self.assertEqual(r, 1)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(self._read(), "top = 1\n[/d]\nw = 4\n")
+        self.assertIsNone(hive.lookup("/a/b/c/z"))
+        self.assertIsNone(hive.lookup("/a/b"))
+        self.assertEqual(hive.get_integer("/d/w"), 4)
+
+    def test_rollback(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        with self.assertRaises(RuntimeError):
+            with hive.transaction():
+                hive.delete("/a", recursive=1)
+                raise RuntimeError()
+        # Then
+        self.assertEqual(self._read(), self.content)
+        self.assertEqual(hive.get_integer("/a/b/c/z"), 3)
+        self.assertEqual(hive.get_folders("/a"), ["b"])
+
+    def test_sections_without_slash(self):
+        # Given
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("top = 1\n[a]\nx = 1\n[a/b]\n[/a/b/c]\nz = 3\n[d]\nw = 4\n")
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.delete("/a", recursive=1)
+        hive.delete("/d/w")
+        # Then
+        self.assertEqual(self._read(), "top = 1\n[d]\n")
+        self.assertEqual(hiveconf.open_hive(self.top).get_folders("/"), ["/", "d"])
+
+
+class WriteBehindTest(unittest.TestCase):
+    content = TransactionTest.content
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with open(self.top, encoding="UTF-8") as f:
+            return f.read()
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_flush(self):
+        # Given
+        hive = hiveconf.open_hive(self.top, write_behind=60)
+        # When
+        for value in range(10):
+            hive.set_integer("/a/x", value)
+        hive.set_integer("/c/new", 5)
+        # Then
+        self.assertEqual(self._read(), self.content)
+        self.assertEqual(hive.get_integer("/a/x"), 9)
+        self.assertEqual(hive.get_integer("/c/new"), 5)
+        self.assertEqual(len(hive._queue.changes[hive.write_target]), 3)
+        with mock.patch("hiveconf._HiveFileUpdater.apply_changes", autospec=True,
+                        side_effect=hiveconf._HiveFileUpdater.apply_changes) as apply:
+            hive.flush()
+        self.assertEqual(apply.call_count, 1)
+        result = hiveconf.open_hive(self.top)
+        self.assertEqual(result.get_integer("/a/x"), 9)
+        self.assertEqual(result.get_integer("/c/new"), 5)
+
+    def test_background_flush(self):
+        # Given
+        hive = hiveconf.open_hive(self.top, write_behind=0.01)
+        # When
+        hive.set_integer("/a/x", 5)
+        hive.delete("/b", recursive=1)
+        # Then
+        self._wait_for(lambda: self._read() != self.content)
+        self.assertEqual(self._read(), "top = 1\n[/a]\nx=5\ny = 2\n")
+
+    def test_flush_error_is_raised(self):
+        # Given
+        hive = hiveconf.open_hive(self.top, write_behind=60)
+        hive.set_integer("/a/x", 5)
+        # When / Then
+        with mock.patch("hiveconf._HiveFileUpdater.apply_changes",
+                        side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                hive.flush()
+        # The changes are kept
+        hive.flush()
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 5)
+
+    def test_background_error_is_raised(self):
+        # Given
+        hive = hiveconf.open_hive(self.top, write_behind=0.01)
+        with mock.patch("hiveconf._HiveFileUpdater.apply_changes",
+                        side_effect=OSError("disk full")):
+            hive.set_integer("/a/x", 5)
+            self._wait_for(lambda: hive._queue.error is not None)
+        # When / Then
+        with self.assertRaises(OSError):
+            hive.set_integer("/a/y", 6)
+        hive.flush()
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 5)
+
+    def test_transaction_writes_queue_first(self):
+        # Given
+        hive = hiveconf.open_hive(self.top, write_behind=60)
+        hive.set_integer("/a/x", 5)
+        # When
+        with hive.transaction():
+            hive.set_integer("/a/x", 6)
+            hive.set_integer("/a/y", 7)
+        # Then
+        result = hiveconf.open_hive(self.top)
+        self.assertEqual(result.get_integer("/a/x"), 6)
+        self.assertEqual(result.get_integer("/a/y"), 7)
+        self.assertEqual(hive._queue.changes, {})
+
+    def test_close_stops_thread(self):
+        # Given
+        hive = hiveconf.open_hive(self.top, write_behind=60)
+        thread = hive._queue._thread
+        hive.set_integer("/a/x", 5)
+        # When
+        hive.close()
+        # Then
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(hive._queue)
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 5)
+        # Later changes are written at once
+        hive.set_integer("/a/x", 6)
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 6)
+
+    def test_garbage_collected_queue_stops_thread(self):
+        # Given
+        hive = hiveconf.open_hive(self.top, write_behind=60)
+        thread = hive._queue._thread
+        hive.set_integer("/a/x", 5)
+        queue = weakref.ref(hive._queue)
+        # When
+        del hive
+        gc.collect()
+        # Then
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(queue())
+        self.assertEqual(hiveconf.open_hive(self.top).get_integer("/a/x"), 5)
+
+
+@unittest.skipIf(hiveconf.sqlite3 is None, "no sqlite3")
+class SqliteMountTest(unittest.TestCase):
+    rows = [("/", "host1", None),
+            ("/", "host2", None),
+            ("/", "shared", "db"),
+            ("/", "late", "db"),
+            ("/host1", "ip", "10.0.0.1"),
+            ("/host1", "disks", None),
+            ("/host1/disks", "sda", "500"),
+            ("/host2", "ip", "10.0.0.2")]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, "inv.db")
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        conn = hiveconf.sqlite3.connect(self.db)
+        conn.execute("CREATE TABLE hive (parent TEXT NOT NULL, name TEXT NOT NULL, "
+                     "value TEXT, PRIMARY KEY (parent, name)) WITHOUT ROWID")
+        conn.executemany("INSERT INTO hive VALUES (?, ?, ?)", self.rows)
+        conn.commit()
+        conn.close()
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("[/inv]\n"
+                    "shared = file\n"
+                    "%mount -t sqlite inv.db\n"
+                    "late = file\n"
+                    "[/other]\n"
+                    "x = 1\n")
+
+    def tearDown(self):
+        for store in hiveconf._sqlite_stores.values():
+            if store._conn is not None:
+                store._conn.close()
+        hiveconf._sqlite_stores.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def _rows(self):
+        conn = hiveconf.sqlite3.connect(self.db)
+        try:
+            return sorted(conn.execute("SELECT * FROM hive").fetchall(),
+                          key=lambda row: (row[0], row[1]))
+        finally:
+            conn.close()
+
+    def test_lookup_loads_on_demand(self):
+        # When
+        hive = hiveconf.open_hive(self.top)
+        inv = hive.lookup("/inv")
+        # Then
+        self.assertEqual(sorted(inv._folders), [])
+        self.assertEqual(hive.get_string("/inv/host1/disks/sda"), "500")
+        self.assertEqual(sorted(inv._folders), ["host1"])
+        self.assertEqual(sorted(inv._folders["host1"]._folders), ["disks"])
+        self.assertIsNone(hive.lookup("/inv/host1/missing"))
+        self.assertIsNone(hive.lookup("/inv/host3/ip"))
+
+    def test_concurrent_queries(self):
+        # Given
+        store = hiveconf._get_sqlite_store(self.db)
+        expected = store.query("SELECT name, value FROM hive WHERE parent = ?", ("/",))
+        results = []
+
+        def query():
+            for i in range(200):
+                results.append(store.query(
+                    "SELECT name, value FROM hive WHERE parent = ?", ("/",)))
+        # When
+        threads = [threading.Thread(target=query) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Then
+        self.assertEqual(len(expected), 4)
+        self.assertEqual(results, [expected] * 1600)
+
+    def test_mount_over_existing_folder(self):
+        # Given
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("[/inv/host1]\n"
+                    "name = file\n"
+                    "[/inv]\n"
+                    "%mount -t sqlite inv.db\n")
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/inv/host1/name"), "file")
+        self.assertEqual(hive.get_string("/inv/host1/ip"), "10.0.0.1")
+        self.assertEqual(hive.get_string("/inv/host1/disks/sda"), "500")
+        self.assertEqual(sorted(hive.get_parameters("/inv/host1")), ["ip", "name"])
+
+    @mock.patch("hiveconf.print")
+    def test_missing_database(self, _print):
+        # Given
+        os.remove(self.db)
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/inv/late"), "file")
+        self.assertFalse(os.path.exists(self.db))
+        _print.assert_any_call("%s: line 3: %s: No such file or directory"
+                               % ("file://" + self.top, self.db), file=sys.stderr)
+
+    def test_first_definition_wins(self):
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/inv/shared"), "file")
+        self.assertEqual(hive.get_string("/inv/late"), "db")
+
+    def test_listing(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When / Then
+        self.assertEqual(sorted(hive.get_folders("/inv")), ["host1", "host2"])
+        self.assertEqual(sorted(hive.get_parameters("/inv")), ["late", "shared"])
+        self.assertEqual(sorted(hive.get_parameters("/inv/host1")), ["ip"])
+
+    def test_set(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.set_string("/inv/host1/ip", "10.0.0.9")
+        hive.set_integer("/inv/host2/port", 22)
+        hive.set_integer("/inv/host3/nic/speed", 1000)
+        # Then
+        rows = self._rows()
+        self.assertIn(("/host1", "ip", "10.0.0.9"), rows)
+        self.assertIn(("/host2", "port", "22"), rows)
+        self.assertIn(("/", "host3", None), rows)
+        self.assertIn(("/host3", "nic", None), rows)
+        self.assertIn(("/host3/nic", "speed", "1000"), rows)
+        result = hiveconf.open_hive(self.top)
+        self.assertEqual(result.get_integer("/inv/host3/nic/speed"), 1000)
+
+    def test_delete(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        hive.delete("/inv/host2/ip")
+        hive.delete("/inv/host1", recursive=1)
+        # Then
+        self.assertEqual(self._rows(), [("/", "host2", None),
+                                        ("/", "late", "db"),
+                                        ("/", "shared", "db")])
+        self.assertIsNone(hive.lookup("/inv/host1/ip"))
+
+    def test_transaction_rollback(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        rows = self._rows()
+        # When
+        with mock.patch("hiveconf._HiveFileUpdater.write_contents",
+                        side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                with hive.transaction():
+                    hive.set_string("/inv/host1/ip", "10.0.0.9")
+                    hive.set_integer("/other/x", 2)
+        # Then
+        self.assertEqual(self._rows(), rows)
+        self.assertEqual(hive.get_string("/inv/host1/ip"), "10.0.0.1")
+
+    def test_delete_rollback(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        rows = self._rows()
+        # When
+        with self.assertRaises(KeyError):
+            with hive.transaction():
+                hive.delete("/inv/host2/ip")
+                hive.delete("/inv/host1", recursive=1)
+                raise KeyError("boom")
+        # Then
+        self.assertEqual(self._rows(), rows)
+        self.assertEqual(hive.get_string("/inv/host2/ip"), "10.0.0.2")
+        self.assertEqual(hive.get_integer("/inv/host1/disks/sda"), 500)
+        self.assertIs(hive.lookup("/inv/host1/disks")._root, hive)
+        self.assertEqual(hive.get_folders("/inv/host1"), ["disks"])
+
+
+class DirectoryMountTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        conf = os.path.join(self.tmpdir, "myapp.d")
+        os.makedirs(os.path.join(conf, "db"))
+        self._write(os.path.join(conf, "port"), "8080")
+        self._write(os.path.join(conf, "db", "host"), "localhost")
+        self._write(os.path.join(conf, ".hidden"), "x")
+        self._write(os.path.join(self.tmpdir, "workgroup.txt"), "MYGROUP")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("[/app]\n"
+                    "%mount -t filesystem myapp.d\n"
+                    "[/global]\n"
+                    "%mount -t filesystem -a name=workgroup workgroup.txt\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, filename, contents):
+        with open(filename, "w", encoding="UTF-8") as f:
+            f.write(contents)
+
+    def test_lookup_loads_on_demand(self):
+        # When
+        hive = hiveconf.open_hive(self.top)
+        app = hive.lookup("/app")
+        # Then
+        self.assertEqual(app._folders, {})
+        self.assertEqual(app._parameters, {})
+        self.assertEqual(hive.get_string("/app/db/host"), "localhost")
+        self.assertEqual(hive.get_integer("/app/port"), 8080)
+        self.assertIsNone(hive.lookup("/app/.hidden"))
+        self.assertIsNone(hive.lookup("/app/missing"))
+
+    def test_listing(self):
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(sorted(hive.get_folders("/app")), ["db"])
+        self.assertEqual(sorted(hive.get_parameters("/app")), ["port"])
+
+    def test_reads_are_cached(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        with mock.patch("hiveconf.open", side_effect=open, create=True) as mock_open:
+            self.assertEqual(hive.get_string("/app/port"), "8080")
+            self.assertEqual(hive.get_string("/app/port"), "8080")
+            self.assertEqual(hive.get_integer("/app/port"), 8080)
+        # Then
+        self.assertEqual(mock_open.call_count, 1)
+
+    def test_changed_file_is_read_again(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        self.assertEqual(hive.get_integer("/app/port"), 8080)
+        # When
+        self._write(os.path.join(self.tmpdir, "myapp.d", "port"), "80")
+        # Then
+        self.assertEqual(hive.get_integer("/app/port"), 80)
+
+    def test_single_file_mount(self):
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/global/workgroup"), "MYGROUP")
+
+    def test_set_writes_hive_file(self):
+        # Given
+        hive = hiveconf.open_hive(self.top)
+        # When
+        self.assertTrue(hive.set_string("/app/db/user", "admin"))
+        self.assertTrue(hive.set_string("/app/port", "80"))
+        # Then
+        hive = hiveconf.open_hive(self.top)
+        self.assertEqual(hive.get_string("/app/db/user"), "admin")
+        self.assertEqual(hive.get_string("/app/port"), "80")
+        with open(os.path.join(self.tmpdir, "myapp.d", "port"), encoding="UTF-8") as f:
+            self.assertEqual(f.read(), "8080")
+
+
+class HivebinTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, "src.hconf")
+        self.hbin = os.path.join(self.tmpdir, "src.hbin")
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        self._write(self.src, "[/]\n"
+                    "name = server\n"
+                    "[hosts/host1]\n"
+                    "ip = 10.0.0.1\n"
+                    "ports = 22 80\n"
+                    "[hosts/host1/disks]\n"
+                    "sda = 500\n"
+                    "[hosts/host1-old]\n"
+                    "ip = 10.0.0.9\n"
+                    "[hosts/h\u00e5st]\n"
+                    "ip = 10.0.0.2\n")
+        self._write(self.top, "[/bin]\n"
+                    "name = top\n"
+                    "%mount -t hivebin src.hbin\n")
+
+    def tearDown(self):
+        hiveconf._hivebin_stores.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, filename, contents):
+        with open(filename, "w", encoding="UTF-8") as f:
+            f.write(contents)
+
+    def test_lookup(self):
+        # Given
+        hiveconf.compile_hive(self.src, self.hbin)
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.lookup("/bin")._folders, {})
+        self.assertEqual(hive.get_string("/bin/hosts/host1/ip"), "10.0.0.1")
+        self.assertEqual(hive.get_integer_list("/bin/hosts/host1/ports"), [22, 80])
+        self.assertEqual(hive.get_integer("/bin/hosts/host1/disks/sda"), 500)
+        self.assertEqual(hive.get_string("/bin/hosts/h\u00e5st/ip"), "10.0.0.2")
+        self.assertEqual(hive.get_string("/bin/name"), "top")
+        self.assertIsNone(hive.lookup("/bin/hosts/host2"))
+        self.assertIsNone(hive.lookup("/bin/hosts/host1/disks/sdb"))
+
+    def test_listing(self):
+        # Given
+        hiveconf.compile_hive(self.src, self.hbin)
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(sorted(hive.get_folders("/bin/hosts")),
+                         ["host1", "host1-old", "h\u00e5st"])
+        self.assertEqual(hive.get_parameters("/bin/hosts"), [])
+        self.assertEqual(sorted(hive.get_parameters("/bin/hosts/host1")),
+                         ["ip", "ports"])
+        self.assertEqual(sorted(hive.get_parameters("/bin")), ["name"])
+
+    def test_set_writes_hive_file(self):
+        # Given
+        hiveconf.compile_hive(self.src, self.hbin)
+        hive = hiveconf.open_hive(self.top)
+        # When
+        self.assertTrue(hive.set_string("/bin/hosts/host1/gw", "10.0.0.254"))
+        # Then
+        hive = hiveconf.open_hive(self.top)
+        self.assertEqual(hive.get_string("/bin/hosts/host1/gw"), "10.0.0.254")
+        self.assertEqual(hive.get_string("/bin/hosts/host1/ip"), "10.0.0.1")
+        self.assertEqual(hive.get_string("/bin/hosts/host1/disks/sda"), "500")
+
+    def test_recompiled_file_is_mapped_again(self):
+        # Given
+        hiveconf.compile_hive(self.src, self.hbin)
+        hive = hiveconf.open_hive(self.top)
+        self.assertEqual(hive.get_string("/bin/hosts/host1/ip"), "10.0.0.1")
+        # When
+        self._write(self.src, "[hosts/host1]\nip = 10.0.0.3\n")
+        hiveconf.compile_hive(self.src, self.hbin)
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/bin/hosts/host1/ip"), "10.0.0.3")
+
+    def test_snapshot(self):
+        # Given
+        hiveconf.compile_hive(self.src, self.hbin)
+        cache = os.path.join(self.tmpdir, "top.hcache")
+        hiveconf.open_hive(self.top, cache=cache)
+        # When
+        hive = hiveconf.open_hive(self.top, cache=cache)
+        # Then
+        self.assertEqual(hive.get_string("/bin/hosts/host1/ip"), "10.0.0.1")
+
+    @mock.patch("hiveconf.print")
+    def test_not_a_hivebin_file(self, _print):
+        # Given
+        self._write(self.hbin, "[/]\nname = x\n")
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/bin/name"), "top")
+        _print.assert_any_call(mock.ANY, file=sys.stderr)
+
+    @mock.patch("hiveconf.print")
+    def test_missing_file(self, _print):
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/bin/name"), "top")
+        self.assertFalse(os.path.exists(self.hbin))
+        _print.assert_any_call("%s: line 3: %s: No such file or directory"
+                               % ("file://" + self.top, self.hbin), file=sys.stderr)
+
+
+@unittest.skipIf(hiveconf.shared_memory is None, "no shared memory")
+class SharedSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.name = "hiveconf-test-%d" % os.getpid()
+        hiveconf.register_memory_hive("shm", "[/]\n"
+                                      "name = server\n"
+                                      "[hosts/host1]\n"
+                                      "ip = 10.0.0.1\n"
+                                      "ports = 22 80\n"
+                                      "[hosts/h\u00e5st]\n"
+                                      "ip = 10.0.0.2\n")
+        self.hive = hiveconf.open_hive("memory://shm")
+
+    def tearDown(self):
+        hiveconf.unlink_shared_hive(self.name)
+        hiveconf.unregister_memory_hive("shm")
+
+    def test_open(self):
+        # Given
+        hiveconf.export_shared_hive(self.hive, self.name)
+        # When
+        shared = hiveconf.open_shared_hive(self.name)
+        # Then
+        self.assertEqual(shared.get_string("/name"), "server")
+        self.assertEqual(shared.get_integer_list("/hosts/host1/ports"), [22, 80])
+        self.assertEqual(shared.get_string("/hosts/h\u00e5st/ip"), "10.0.0.2")
+        self.assertEqual(sorted(shared.get_folders("/hosts")),
+                         ["host1", "h\u00e5st"])
+        self.assertIsNone(shared.lookup("/hosts/host2"))
+
+    def test_read_only(self):
+        # Given
+        hiveconf.export_shared_hive(self.hive, self.name)
+        shared = hiveconf.open_shared_hive(self.name)
+        # When
+        result = shared.set_string("/name", "other")
+        # Then
+        self.assertFalse(result)
+        self.assertEqual(self.hive.get_string("/name"), "server")
+
+    def test_open_missing(self):
+        # When
+        shared = hiveconf.open_shared_hive(self.name)
+        # Then
+        self.assertIsNone(shared)
+        self.assertIsNone(hiveconf.get_shared_hive_generation(self.name))
+
+    def test_new_generation(self):
+        # Given
+        self.assertEqual(hiveconf.export_shared_hive(self.hive, self.name), 1)
+        shared = hiveconf.open_shared_hive(self.name)
+        self.hive.set_string("/name", "changed")
+        # When
+        generation = hiveconf.export_shared_hive(self.hive, self.name)
+        # Then
+        self.assertEqual(generation, 2)
+        self.assertEqual(hiveconf.get_shared_hive_generation(self.name), 2)
+        self.assertFalse(hiveconf.is_shared_hive_current(shared))
+        # The old generation is still usable
+        self.assertEqual(shared.get_string("/name"), "server")
+        shared = hiveconf.open_shared_hive(self.name)
+        self.assertTrue(hiveconf.is_shared_hive_current(shared))
+        self.assertEqual(shared.get_string("/name"), "changed")
+
+    def test_unlink(self):
+        # Given
+        hiveconf.export_shared_hive(self.hive, self.name)
+        shared = hiveconf.open_shared_hive(self.name)
+        # When
+        hiveconf.unlink_shared_hive(self.name)
+        # Then
+        self.assertIsNone(hiveconf.open_shared_hive(self.name))
+        self.assertFalse(hiveconf.is_shared_hive_current(shared))
+        self.assertEqual(shared.get_string("/hosts/host1/ip"), "10.0.0.1")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "no fork")
+    def test_forked_worker(self):
+        # Given
+        hiveconf.export_shared_hive(self.hive, self.name)
+        (rfd, wfd) = os.pipe()
+        # When
+        pid = os.fork()
+        if pid == 0:
+            try:
+                shared = hiveconf.open_shared_hive(self.name)
+                os.write(wfd, shared.get_string("/hosts/host1/ip").encode())
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        os.waitpid(pid, 0)
+        # Then
+        self.assertEqual(os.read(rfd, 100), b"10.0.0.1")
+        os.close(rfd)
+        self.assertEqual(hiveconf.get_shared_hive_generation(self.name), 1)
+
+
+class EnvironMountTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("[/app]\n"
+                    "mandatory = locked\n"
+                    "%mount -t environ HIVEPARAMS_TEST\n"
+                    "background = white\n"
+                    "[/app/window]\n"
+                    "width = 640\n")
+        hiveconf._environ_cache.clear()
+
+    def tearDown(self):
+        hiveconf._environ_cache.clear()
+        os.environ.pop("HIVEPARAMS_TEST", None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_overlay(self):
+        # Given
+        os.environ["HIVEPARAMS_TEST"] = ("/background=black mandatory=open "
+                                         "'window/title=My app' window/width=800")
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/app/background"), "black")
+        self.assertEqual(hive.get_string("/app/mandatory"), "locked")
+        self.assertEqual(hive.get_string("/app/window/title"), "My app")
+        self.assertEqual(hive.get_integer("/app/window/width"), 800)
+        self.assertEqual(sorted(hive.get_parameters("/app/window")),
+                         ["title", "width"])
+
+    def test_overlay_of_folder_from_earlier_mount(self):
+        # Given
+        mand = os.path.join(self.tmpdir, "mand.hconf")
+        app = os.path.join(self.tmpdir, "app.hconf")
+        with open(mand, "w", encoding="UTF-8") as f:
+            f.write("[/global]\nmandatory = 1\n")
+        with open(app, "w", encoding="UTF-8") as f:
+            f.write("[/global]\nbackground = white\n")
+        with open(self.top, "w", encoding="UTF-8") as f:
+            f.write("[/]\n"
+                    "%mount mand.hconf\n"
+                    "%mount -t environ HIVEPARAMS_TEST\n"
+                    "%mount app.hconf\n")
+        os.environ["HIVEPARAMS_TEST"] = ("/global/background=black "
+                                         "/global/extra=1 /global/mandatory=9")
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/global/background"), "black")
+        self.assertEqual(hive.get_string("/global/extra"), "1")
+        self.assertEqual(hive.get_string("/global/mandatory"), "1")
+        self.assertEqual(sorted(hive.get_parameters("/global")),
+                         ["background", "extra", "mandatory"])
+
+    def test_read_once_and_removed(self):
+        # Given
+        os.environ["HIVEPARAMS_TEST"] = "background=black"
+        # When
+        hiveconf.open_hive(self.top)
+        os.environ["HIVEPARAMS_TEST"] = "background=red"
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/app/background"), "black")
+        self.assertEqual(os.environ["HIVEPARAMS_TEST"], "background=red")
+        del os.environ["HIVEPARAMS_TEST"]
+        hiveconf._environ_cache.clear()
+        hiveconf.open_hive(self.top)
+        self.assertNotIn("HIVEPARAMS_TEST", os.environ)
+
+    def test_unset(self):
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/app/background"), "white")
+
+    @mock.patch("hiveconf.print")
+    def test_invalid_items(self, _print):
+        # Given
+        os.environ["HIVEPARAMS_TEST"] = "noequal a=1 a/x=2 a=2 'b=x y'"
+        # When
+        hive = hiveconf.open_hive(self.top)
+        # Then
+        self.assertEqual(hive.get_string("/app/a"), "1")
+        self.assertEqual(hive.get_string("/app/b"), "x y")
+        for item in ("noequal", "a/x=2", "a=2"):
+            _print.assert_any_call(
+                "%s: line 3: HIVEPARAMS_TEST: invalid parameter %s"
+                % ("file://" + self.top, item), file=sys.stderr)
+
+    def test_snapshot_depends_on_value(self):
+        # Given
+        cache = os.path.join(self.tmpdir, "top.hcache")
+        os.environ["HIVEPARAMS_TEST"] = "background=black"
+        hive = hiveconf.open_hive(self.top, cache=cache)
+        self.assertEqual(hive.get_string("/app/background"), "black")
+        # When
+        hiveconf._environ_cache.clear()
+        os.environ["HIVEPARAMS_TEST"] = "background=red"
+        hive = hiveconf.open_hive(self.top, cache=cache)
+        # Then
+        self.assertEqual(hive.get_string("/app/background"), "red")
+
+
+class MemoryBackendTest(unittest.TestCase):
+    text = ("[/]\n"
+            "name = main\n"
+            "[/app]\n"
+            "color = red\n"
+            "%mount -t memory app-*\n")
+
+    def tearDown(self):
+        hiveconf._memory_hives.clear()
+
+    def test_open(self):
+        # Given
+        hiveconf.register_memory_hive("main", self.text)
+        hiveconf.register_memory_hive("app-1", "color = blue\nsize = 1\n")
+        hiveconf.register_memory_hive("app-2", "size = 2\nshape = round\n")
+        # When
+        hive = hiveconf.open_hive("memory://main")
+        # Then
+        self.assertEqual(hive.get_string("/name"), "main")
+        self.assertEqual(hive.get_string("/app/color"), "red")
+        self.assertEqual(hive.get_integer("/app/size"), 1)
+        self.assertEqual(hive.get_string("/app/shape"), "round")
+        self.assertIsNone(hiveconf.open_hive("memory://missing"))
+
+    def test_writes_like_hive_files(self):
+        # Given
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, "main.hconf")
+        with open(filename, "w", encoding="UTF-8") as f:
+            f.write(self.text)
+        hiveconf.register_memory_hive("main", self.text)
+        # When
+        for url in ("memory://main", filename):
+            hive = hiveconf.open_hive(url)
+            hive.set_string("/name", "changed")
+            hive.set_string("/app/width", "10")
+            hive.set_string("/new/folder/param", "1")
+            hive.delete("/app/color")
+        # Then
+        with open(filename, encoding="UTF-8") as f:
+            self.assertEqual(hiveconf.get_memory_hive("main"), f.read())
+
+    def test_write_target(self):
+        # Given
+        hiveconf.register_memory_hive("main", self.text)
+        hiveconf.register_memory_hive("app-1", "size = 1\n", writable=0)
+        hive = hiveconf.open_hive("memory://main")
+        # When
+        self.assertTrue(hive.set_string("/app/size", "2"))
+        # Then
+        self.assertEqual(hiveconf.get_memory_hive("app-1"), "size = 1\n")
+        self.assertIn("size=2\n", hiveconf.get_memory_hive("main"))
+
+    def test_mount_creates_missing(self):
+        # Given
+        hiveconf.register_memory_hive("main", "[/app]\n%mount -t memory app\n")
+        # When
+        hive = hiveconf.open_hive("memory://main")
+        # Then
+        self.assertEqual(hiveconf.get_memory_hive("app"), "")
+        self.assertIsNotNone(hive.lookup("/app"))
+
+    def test_transaction_rollback(self):
+        # Given
+        hiveconf.register_memory_hive("main", self.text)
+        hive = hiveconf.open_hive("memory://main")
+        # When
+        with self.assertRaises(RuntimeError):
+            with hive.transaction():
+                hive.set_string("/name", "changed")
+                raise RuntimeError()
+        # Then
+        self.assertEqual(hiveconf.get_memory_hive("main"), self.text)
+        self.assertEqual(hive.get_string("/name"), "main")
+
+
+class DictBackend(hiveconf.Backend):
+    """Backend serving a dict from folder path to dict of objects,
+    with None for folders"""
+    tree = {"": {"host1": None, "name": "dict"},
+            "/host1": {"ip": "10.0.0.1", "port": "22"}}
+
+    def __init__(self, url, options):
+        self.url = url
+        self.loaded = []
+
+    def load_object(self, folder, path, name):
+        self.loaded.append(path + "/" + name)
+        objects = self.tree.get(path, {})
+        if name not in objects:
+            return None
+        if objects[name] is None:
+            return self.make_folder(folder, path + "/" + name, name)
+        return self.make_parameter(folder, path, name, objects[name])
+
+    def load_children(self, folder, path):
+        self.loaded.append(path + "/*")
+        return [(name, self.load_object(folder, path, name))
+                for name in self.tree.get(path, {})]
+
+
+class EagerDictBackend(DictBackend):
+    point_lookups = 0
+
+
+class WritableDictBackend(DictBackend):
+    writable = 1
+    changes = []
+
+    def __init__(self, url, options):
+        DictBackend.__init__(self, "wdict://" + url, options)
+
+
+class DictUpdater:
+    def __init__(self, source):
+        self.source = source
+
+    def change_parameter(self, sectionname, paramname, value, new_param=0,
+                         delete_param=0):
+        WritableDictBackend.changes.append(
+            (self.source, sectionname, paramname, value, new_param))
+
+    def add_parameter(self, sectionname, paramname, value):
+        self.change_parameter(sectionname, paramname, value, new_param=1)
+
+
+class BackendRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.backends = []
+        def factory(cls):
+            def make(url, options):
+                backend = cls(url, options)
+                self.backends.append(backend)
+                return backend
+            return make
+        hiveconf.register_backend("dict", factory(DictBackend))
+        hiveconf.register_backend("eager", factory(EagerDictBackend))
+        hiveconf.register_backend("wdict", factory(WritableDictBackend),
+                                  updater=DictUpdater, urls=0)
+        WritableDictBackend.changes = []
+        hiveconf.register_memory_hive("top", "[/d]\n"
+                                      "%mount -t dict some/url\n"
+                                      "[/e]\n"
+                                      "name = top\n"
+                                      "%mount -t eager url\n"
+                                      "port = 80\n"
+                                      "[/w]\n"
+                                      "%mount -t wdict inv\n")
+
+    def tearDown(self):
+        for name in ("dict", "eager", "wdict"):
+            hiveconf._mounters.pop(name)
+        hiveconf._updaters.pop("wdict")
+        hiveconf._memory_hives.clear()
+
+    def test_point_lookups(self):
+        # When
+        hive = hiveconf.open_hive("memory://top")
+        # Then
+        backend = self.backends[0]
+        self.assertEqual(backend.loaded, [])
+        self.assertEqual(hive.get_string("/d/host1/ip"), "10.0.0.1")
+        self.assertEqual(backend.loaded, ["/host1", "/host1/ip"])
+        self.assertEqual(sorted(hive.get_parameters("/d/host1")), ["ip", "port"])
+        self.assertIn("/host1/*", backend.loaded)
+
+    def test_eager(self):
+        # When
+        hive = hiveconf.open_hive("memory://top")
+        # Then
+        backend = self.backends[1]
+        self.assertEqual(backend.loaded, ["/*", "/host1", "/name"])
+        self.assertEqual(hive.get_string("/e/name"), "top")
+        self.assertEqual(hive.get_string("/e/host1/port"), "22")
+        self.assertEqual(hive.get_string("/e/port"), "80")
+        self.assertNotIn("/host1/port", backend.loaded[:3])
+
+    def test_write(self):
+        # Given
+        hive = hiveconf.open_hive("memory://top")
+        # When
+        hive.set_string("/w/host1/ip", "10.0.0.5")
+        hive.set_string("/w/new", "1")
+        # Then
+        self.assertEqual(WritableDictBackend.changes,
+                         [("wdict://inv", "/host1", "ip", "10.0.0.5", 0),
+                          ("wdict://inv", "", "new", "1", 1)])
+
+    @mock.patch("hiveconf.print")
+    def test_factory_error(self, _print):
+        # Given
+        def factory(url, options):
+            raise hiveconf.Error("broken")
+        hiveconf.register_backend("dict", factory)
+        # When
+        hive = hiveconf.open_hive("memory://top")
+        # Then
+        _print.assert_any_call("memory://top: line 2: some/url: broken",
+                               file=sys.stderr)
+        self.assertEqual(hive.get_string("/e/name"), "top")
+
+
+class RWLockTest(unittest.TestCase):
+    def test_readers_share(self):
+        # Given
+        lock = hiveconf._RWLock()
+        barrier = threading.Barrier(3, timeout=5)
+        def reader():
+            with lock.read():
+                barrier.wait()
+        threads = [threading.Thread(target=reader) for i in range(2)]
+        # When
+        for thread in threads:
+            thread.start()
+        # Then: both readers hold the lock at the same time
+        barrier.wait()
+        for thread in threads:
+            thread.join()
+
+    def test_writer_excludes_readers(self):
+        # Given
+        lock = hiveconf._RWLock()
+        events = []
+        def reader():
+            with lock.read():
+                events.append("read")
+        # When
+        with lock.write():
+            thread = threading.Thread(target=reader)
+            thread.start()
+            thread.join(0.1)
+            events.append("written")
+        thread.join()
+        # Then
+        self.assertEqual(events, ["written", "read"])
+
+    def test_reentrant(self):
+        # Given
+        lock = hiveconf._RWLock()
+        # When / Then
+        with lock.write(), lock.write(), lock.read(), lock.read():
+            pass
+        with lock.read():
+            with self.assertRaises(RuntimeError):
+                with lock.write():
+                    pass
+        with lock.write():
+            pass
+
+
+class ThreadSafeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.filename, "w", encoding="UTF-8") as f:
+            f.write("[/app]\nname = x\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_concurrent_writes_and_reads(self):
+        # Given
+        hive = hiveconf.open_hive(self.filename, threadsafe=1)
+        errors = []
+        def writer(n):
+            try:
+                for i in range(10):
+                    hive.set_integer("/app/t%d/p%d" % (n, i), i)
+            except Exception as e:
+                errors.append(e)
+        def reader():
+            try:
+                for i in range(50):
+                    for name in hive.get_folders("/app"):
+                        hive.get_parameters("/app/" + name)
+                    hive.get_string("/app/name")
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        threads += [threading.Thread(target=reader) for n in range(4)]
+        # When
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Then
+        self.assertEqual(errors, [])
+        hive = hiveconf.open_hive(self.filename)
+        for n in range(4):
+            for i in range(10):
+                self.assertEqual(hive.get_integer("/app/t%d/p%d" % (n, i)), i)
+
+    def test_lazy_mount_loaded_once(self):
+        # Given
+        for i in range(20):
+            with open(os.path.join(self.tmpdir, "m%02d.hconf" % i), "w",
+                      encoding="UTF-8") as f:
+                f.write("[/m%02d]\nvalue = %d\n" % (i, i))
+        with open(self.filename, "a", encoding="UTF-8") as f:
+            f.write("%mount m*.hconf\n")
+        hive = hiveconf.open_hive(self.filename, lazy=1, threadsafe=1)
+        results = []
+        def reader():
+            results.append([hive.lookup("/app/m%02d/value" % i) for i in range(20)])
+        threads = [threading.Thread(target=reader) for i in range(4)]
+        # When
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Then
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertEqual([id(param) for param in result],
+                             [id(param) for param in results[0]])
+        self.assertEqual(results[0][7].get_integer(), 7)
+
+    def test_transaction_blocks_readers(self):
+        # Given
+        hive = hiveconf.open_hive(self.filename, threadsafe=1)
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(hive.get_string("/app/name")))
+        # When
+        with hive.transaction():
+            hive.set_string("/app/name", "y")
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(seen, [])
+        thread.join()
+        # Then
+        self.assertEqual(seen, ["y"])
+
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.filename, "w", encoding="UTF-8") as f:
+            f.write("[/app]\nname = x\nsize = 1\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_open_and_write(self):
+        # Given
+        async def main():
+            hive = await hiveconf.open_hive_async(self.filename)
+            # When
+            self.assertTrue(await hive.aset_string("/app/name", "y"))
+            self.assertTrue(await hive.aset_integer_list("/app/new/list", [1, 2]))
+            self.assertTrue(await hive.adelete("/app/size"))
+            return hive
+        hive = asyncio.run(main())
+        # Then
+        self.assertEqual(hive.get_string("/app/name"), "y")
+        self.assertIsNone(hive.lookup("/app/size"))
+        hive = hiveconf.open_hive(self.filename)
+        self.assertEqual(hive.get_string("/app/name"), "y")
+        self.assertEqual(hive.get_integer_list("/app/new/list"), [1, 2])
+        self.assertIsNone(hive.lookup("/app/size"))
+
+    def test_writes_to_a_file_keep_their_order(self):
+        # Given
+        async def main():
+            hive = await hiveconf.open_hive_async(self.filename)
+            # When
+            await asyncio.gather(*[hive.aset_integer("/app/size", i)
+                                   for i in range(20)],
+                                 *[hive.aset_integer("/app/p%d" % i, i)
+                                   for i in range(20)])
+        asyncio.run(main())
+        # Then
+        hive = hiveconf.open_hive(self.filename)
+        self.assertEqual(hive.get_integer("/app/size"), 19)
+        self.assertEqual(sorted(hive.get_parameters("/app")),
+                         sorted(["name", "size"] + ["p%d" % i for i in range(20)]))
+
+    @unittest.skipIf(hiveconf.fcntl is None, "no fcntl")
+    def test_getter_not_blocked_by_slow_write(self):
+        # Given
+        hiveconf.set_lock_timeout(1.0)
+        self.addCleanup(hiveconf.set_lock_timeout, 10.0)
+        async def main():
+            hive = await hiveconf.open_hive_async(self.filename)
+            # Another process is holding the file
+            fd = os.open(self.filename, os.O_RDONLY)
+            self.addCleanup(os.close, fd)
+            hiveconf.fcntl.flock(fd, hiveconf.fcntl.LOCK_EX)
+            write = asyncio.ensure_future(hive.aset_string("/app/name", "y"))
+            await asyncio.sleep(0.2)
+            # When
+            start = time.monotonic()
+            value = hive.get_string("/app/name")
+            elapsed = time.monotonic() - start
+            with self.assertRaises(hiveconf.LockTimeout):
+                await write
+            return (hive, value, elapsed)
+        (hive, value, elapsed) = asyncio.run(main())
+        # Then
+        self.assertLess(elapsed, 0.1)
+        self.assertEqual(value, "y")
+        # The change could not be written, and is undone
+        self.assertEqual(hive.get_string("/app/name"), "x")
+
+    def test_aflush(self):
+        # Given
+        async def main():
+            hive = await hiveconf.open_hive_async(self.filename, write_behind=60)
+            await hive.aset_string("/app/name", "y")
+            with open(self.filename, encoding="UTF-8") as f:
+                self.assertNotIn("name=y", f.read())
+            # When
+            await hive.aflush()
+        asyncio.run(main())
+        # Then
+        with open(self.filename, encoding="UTF-8") as f:
+            self.assertIn("name=y", f.read())
+
+
+
+class FolderWalkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "top.hconf")
+        with open(self.filename, "w", encoding="UTF-8") as f:
+            f.write("top = 1\n"
+                    "[/a]\nx = 2\n"
+                    "[/a/b]\ny = 3\n"
+                    "[/a/c]\n"
+                    "[/d]\nz = 4\n")
+        self.hive = hiveconf.open_hive(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _summary(self, walk):
+        return [(path, [name for (name, param) in params],
+                 [name for (name, folder) in subfolders])
+                for (path, folder, params, subfolders) in walk]
+
+    def test_topdown(self):
+        # When
+        result = self._summary(self.hive.walk())
+        # Then
+        self.assertEqual(result, [("/", ["top"], ["a", "d"]),
+                                  ("/a", ["x"], ["b", "c"]),
+                                  ("/a/b", ["y"], []),
+                                  ("/a/c", [], []),
+                                  ("/d", ["z"], [])])
+
+    def test_bottom_up(self):
+        # When
+        result = [path for (path, folder, params, subfolders)
+                  in self.hive.walk(topdown=False)]
+        # Then
+        self.assertEqual(result, ["/a/b", "/a/c", "/a", "/d", "/"])
+
+    def test_objects(self):
+        # When
+        (path, folder, params, subfolders) = next(self.hive.lookup("/a").walk())
+        # Then
+        self.assertEqual(path, "/")
+        self.assertIs(folder, self.hive.lookup("/a"))
+        self.assertEqual(params, [("x", self.hive.lookup("/a/x"))])
+        self.assertEqual(subfolders, [("b", self.hive.lookup("/a/b")),
+                                      ("c", self.hive.lookup("/a/c"))])
+
+    def test_prune(self):
+        # Given
+        pruned = []
+        def prune(path, folder):
+            pruned.append((path, folder))
+            return path == "/a"
+        # When
+        result = [path for (path, folder, params, subfolders)
+                  in self.hive.walk(prune=prune)]
+        # Then
+        self.assertEqual(result, ["/", "/d"])
+        self.assertEqual(pruned, [("/a", self.hive.lookup("/a")),
+                                  ("/d", self.hive.lookup("/d"))])
+
+    def test_depth(self):
+        # When
+        top = self._summary(self.hive.walk(depth=0))
+        levels = [path for (path, folder, params, subfolders)
+                  in self.hive.walk(topdown=False, depth=1)]
+        # Then
+        self.assertEqual(top, [("/", ["top"], ["a", "d"])])
+        self.assertEqual(levels, ["/a", "/d", "/"])
+
+    def test_remove_subfolders(self):
+        # Given
+        result = []
+        # When
+        for (path, folder, params, subfolders) in self.hive.walk():
+            result.append(path)
+            subfolders[:] = [(name, f) for (name, f) in subfolders if name != "b"]
+        # Then
+        self.assertEqual(result, ["/", "/a", "/a/c", "/d"])
+
+    def test_mounted_objects(self):
+        # Given
+        with open(os.path.join(self.tmpdir, "sub.hconf"), "w") as f:
+            f.write("m = 5\n[deep]\nn = 6\n")
+        with open(self.filename, "a") as f:
+            f.write("[/mnt]\n%mount sub.hconf\n")
+        hive = hiveconf.open_hive(self.filename, lazy=1)
+        # When
+        result = self._summary(hive.lookup("/mnt").walk())
+        # Then
+        self.assertEqual(result, [("/", ["m"], ["deep"]),
+                                  ("/deep", ["n"], [])])
+
+
+@unittest.skipUnless(hasattr(hiveconf.socket, "AF_UNIX"), "no Unix sockets")
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "top.hconf")
+        self.socket = os.path.join(self.tmpdir, "hiveconfd.sock")
+        self._write("[/app]\nname = x\nsize = 1\nflags = true false\n"
+                    "[/app/sub]\nkey = value\n")
+        self.server = hiveconf.HiveDaemon(self.socket)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,))
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, contents):
+        with open(self.filename, "w", encoding="UTF-8") as f:
+            f.write(contents)
+
+    def _open(self):
+        return hiveconf.open_daemon_hive(self.filename, self.socket)
+
+    def test_get(self):
+        # When
+        hive = self._open()
+        # Then
+        self.assertEqual(hive.get_string("/app/name"), "x")
+        self.assertEqual(hive.get_integer("/app/size"), 1)
+        self.assertEqual(hive.get_bool_list("/app/flags"), [1, 0])
+        self.assertEqual(hive.get_string("/app/missing", "default"), "default")
+        self.assertRaises(hiveconf.NotAParameterError, hive.get_string, "/app")
+        self.assertRaises(hiveconf.BadIntegerFormat, hive.get_integer, "/app/name")
+
+    def test_syntax_error(self):
+        # Given
+        hive = self._open()
+        self._write("[/app]\nname = y\nbad line\n")
+        # When
+        with self.assertRaises(hiveconf.SyntaxError) as cm:
+            hive.get_string("/app/name")
+        # Then
+        self.assertEqual(cm.exception.linenum, 3)
+        url = "file://" + self.filename
+        self.assertEqual(cm.exception.url, url)
+        self.assertEqual(str(cm.exception), "Bad line 3 in %s" % url)
+
+    def test_error_not_rebuilt(self):
+        # Given
+        response = {"error": "SyntaxError", "message": "Bad line 3 in x"}
+        # When
+        e = hiveconf._make_remote_error(response)
+        # Then
+        self.assertIs(type(e), hiveconf.Error)
+        self.assertEqual(str(e), "Bad line 3 in x")
+
+    def test_list_and_lookup(self):
+        # Given
+        hive = self._open()
+        # When
+        sub = hive.lookup("/app/sub")
+        param = hive.lookup("/app/size")
+        # Then
+        self.assertEqual(hive.get_folders("/app"), ["sub"])
+        self.assertEqual(sorted(hive.get_parameters("/app")),
+                         ["flags", "name", "size"])
+        self.assertEqual(hive.get_parameters("/missing"), [])
+        self.assertIsInstance(sub, hiveconf.RemoteFolder)
+        self.assertEqual(sub.get_string("key"), "value")
+        self.assertEqual(sub.sectionname, "/app/sub")
+        self.assertEqual(param.get_integer(), 1)
+        self.assertIsNone(hive.lookup("/app/missing"))
+
+    def test_set_and_delete(self):
+        # Given
+        hive = self._open()
+        # When
+        self.assertTrue(hive.set_integer("/app/size", 2))
+        self.assertTrue(hive.set_binary_list("/app/new", [b"ab"]))
+        self.assertTrue(hive.delete("/app/name"))
+        # Then
+        self.assertEqual(hive.get_integer("/app/size"), 2)
+        self.assertRaises(hiveconf.FolderNotEmpty, hive.delete, "/app/sub")
+        local = hiveconf.open_hive(self.filename)
+        self.assertEqual(local.get_integer("/app/size"), 2)
+        self.assertEqual(local.get_binary_list("/app/new"), [b"ab"])
+        self.assertIsNone(local.lookup("/app/name"))
+
+    def test_environ_mount_not_used(self):
+        # Given
+        self._write("[/app]\n%mount -t environ HIVEPARAMS_TEST\nname = x\n")
+        self.addCleanup(hiveconf._environ_cache.clear)
+        # When
+        hive = self._open()
+        # Then
+        self.assertIsNone(hive)
+
+    def test_reload_changed_file(self):
+        # Given
+        hive = self._open()
+        self.assertEqual(hive.get_string("/app/name"), "x")
+        # When
+        self._write("[/app]\nname = y\n")
+        # Make sure the change is seen, even if the file system has a
+        # coarse time stamp resolution
+        os.utime(self.filename, (0, 0))
+        # Then
+        self.assertEqual(hive.get_string("/app/name"), "y")
+
+    def test_own_writes_keep_the_hive(self):
+        # Given
+        hive = self._open()
+        root = self.server.get_hive(hive._connection.url).get_root()
+        # When
+        hive.set_string("/app/name", "z")
+        # Then
+        self.assertIs(self.server.get_hive(hive._connection.url).get_root(), root)
+
+    def test_external_change_during_own_write(self):
+        # Given
+        hive = self._open()
+        get_root = hiveconf._DaemonHive.get_root
+        def change_after_check(daemon_hive):
+            root = get_root(daemon_hive)
+            # Another process changes the file after the check
+            self._write("[/app]\nname = x\nextra = 1\n")
+            os.utime(self.filename, (0, 0))
+            return root
+        # When
+        with mock.patch.object(hiveconf._DaemonHive, "get_root", autospec=True,
+                               side_effect=change_after_check):
+            hive.set_string("/app/name", "z")
+        # Then
+        self.assertEqual(hive.get_string("/app/name"), "z")
+        self.assertEqual(hive.get_string("/app/extra"), "1")
+
+    def test_walk(self):
+        # Given
+        hive = self._open()
+        # When
+        result = [(path, folder.sectionname,
+                   [(name, param.get_string()) for (name, param) in params],
+                   [name for (name, subfolder) in subfolders])
+                  for (path, folder, params, subfolders)
+                  in hive.lookup("/app").walk(topdown=False)]
+        # Then
+        self.assertEqual(result,
+                         [("/sub", "/app/sub", [("key", "value")], []),
+                          ("/", "/app", [("name", "x"), ("size", "1"),
+                                         ("flags", "true false")], ["sub"])])
+
+    def test_walk_depth(self):
+        # Given
+        hive = self._open()
+        responses = []
+        request = hiveconf._DaemonConnection.request
+        def record(connection, op, folder, path, **args):
+            response = request(connection, op, folder, path, **args)
+            responses.append((op, folder, args, response))
+            return response
+        # When
+        with mock.patch.object(hiveconf._DaemonConnection, "request",
+                               autospec=True, side_effect=record):
+            result = [(path, folder.sectionname,
+                       [(name, subfolder.sectionname)
+                        for (name, subfolder) in subfolders])
+                      for (path, folder, params, subfolders)
+                      in hive.lookup("/app").walk(depth=0)]
+        # Then
+        self.assertEqual(result, [("/", "/app", [("sub", "/app/sub")])])
+        (op, folder, args, response) = responses[-1]
+        self.assertEqual((op, folder, args), ("walk", "/app", {"depth": 0}))
+        self.assertEqual(len(response["result"]), 1)
+
+    def test_no_daemon(self):
+        # When
+        hive = hiveconf.open_daemon_hive(self.filename,
+                                         os.path.join(self.tmpdir, "none"))
+        # Then
+        self.assertIsNone(hive)
+
+    def test_disabled(self):
+        # Given
+        with mock.patch.dict(os.environ, {"HIVECONFD_SOCKET": ""}):
+            # When
+            hive = hiveconf.open_daemon_hive(self.filename)
+        # Then
+        self.assertIsNone(hive)
+
+    def test_already_running(self):
+        # Then
+        self.assertRaises(hiveconf.Error, hiveconf.HiveDaemon, self.socket)
+
+    def test_concurrent_writes(self):
+        # Given
+        hives = [self._open() for i in range(4)]
+        def write(hive, n):
+            for i in range(5):
+                hive.set_integer("/app/p%d_%d" % (n, i), i)
+        threads = [threading.Thread(target=write, args=(hive, n))
+                   for (n, hive) in enumerate(hives)]
+        # When
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Then
+        local = hiveconf.open_hive(self.filename)
+        for n in range(4):
+            for i in range(5):
+                self.assertEqual(local.get_integer("/app/p%d_%d" % (n, i)), i)
+
+
 if "__main__" == __name__:
     unittest.main()
@@ -3,7 +3,9 @@
 
 import os
 import sys
+import io
 import locale
+import contextlib
 import unittest
 
 from unittest.mock import MagicMock, patch, ANY, call
@@ -15,7 +17,7 @@ def get_origin_dir():
 # Import what is needed from hiveconf before mocking it
 hiveconfdir = os.path.realpath(os.path.join(get_origin_dir(), "../"))
 sys.path.append(hiveconfdir)
-from hiveconf import NotAParameterError
+from hiveconf import NotAParameterError, BadIntegerFormat, Error, RemoteFolder
 
 fakemods = [
     "hiveconf",
@@ -44,7 +46,9 @@ sys.modules["hivetool"] = script
 
 def script_main(*args):
     try:
-        with patch("sys.argv", [ script_path ] + list(args)):
+        # Never use a hiveconfd which happens to be running
+        with patch("sys.argv", [ script_path ] + list(args)), \
+             patch.dict(os.environ, {"HIVECONFD_SOCKET": ""}):
             script.main()
     except SystemExit as e:
         return e.code
@@ -184,6 +188,27 @@ class ParameterTest(unittest.TestCase):
         self.assertEqual(return_code, 0)
         _print.assert_called_once_with("??????")
 
+def walk_tree(tree):
+    """Make a replacement for Folder.walk(), walking the tree of
+    nested dicts tree, where strings are parameter values"""
+    def walk(topdown=True, prune=None, depth=None, path="/", tree=tree):
+        params = [(name, MagicMock(get_string=MagicMock(return_value=value),
+                                   source="file:///test.hconf"))
+                  for (name, value) in tree.items() if isinstance(value, str)]
+        subfolders = [(name, MagicMock())
+                      for (name, value) in tree.items() if isinstance(value, dict)]
+        yield (path, MagicMock(), params, subfolders)
+        for (name, subfolder) in subfolders:
+            subpath = path.rstrip("/") + "/" + name
+            if depth is not None and depth <= 0:
+                continue
+            if prune is None or not prune(subpath, subfolder):
+                yield from walk(topdown, prune,
+                                None if depth is None else depth - 1,
+                                subpath, tree[name])
+    return walk
+
+
 class WalkTest(unittest.TestCase):
     def reset_purge_params(self):
         # Reset purge_params in case other tests modified it
@@ -205,7 +230,7 @@ class WalkTest(unittest.TestCase):
             else:
                 return hive_reduced
 
-        hive_purge.get_parameters.return_value = ["p1", "p2"]
+        hive_purge.walk.side_effect = walk_tree({"p1": "v1", "p2": "v2"})
         hive_reduced.lookup.side_effect = [None, MagicMock()]
         hive.side_effect = _open_hive
 
@@ -214,11 +239,9 @@ class WalkTest(unittest.TestCase):
 
         # Then
         self.assertEqual(return_code, 0)
-        # Hiveconf handles the double slashes with _path2comps()
-        hive_purge.delete.assert_called_once_with("//p2")
-        hive_purge.get_parameters.assert_called_once_with("/")
+        hive_purge.delete.assert_called_once_with("/p2")
         self.assertEqual(hive_reduced.lookup.call_args_list,
-                         [ call("//p1"), call("//p2") ])
+                         [ call("/p1"), call("/p2") ])
 
     @patch("hiveconf.open_hive")
     def test_purge_walk_param_in_folder(self, hive):
@@ -231,8 +254,7 @@ class WalkTest(unittest.TestCase):
             else:
                 return hive
 
-        hive_purge.get_parameters.side_effect = [[], ["p1", "p2"]]
-        hive_purge.get_folders.side_effect = [["f1"], []]
+        hive_purge.walk.side_effect = walk_tree({"f1": {"p1": "v1", "p2": "v2"}})
         hive.lookup.side_effect = [None, MagicMock()]
         hive.side_effect = _open_hive
 
@@ -242,10 +264,6 @@ class WalkTest(unittest.TestCase):
         # Then
         self.assertEqual(return_code, 0)
         hive_purge.delete.assert_called_once_with("/f1/p2")
-        self.assertEqual(hive_purge.get_parameters.call_args_list,
-                         [ call("/"), call("/f1") ])
-        self.assertEqual(hive_purge.get_folders.call_args_list,
-                         [ call("/"), call("/f1") ])
         self.assertEqual(hive.lookup.call_args_list,
                          [ call("/f1/p1"), call("/f1/p2") ])
 
@@ -259,9 +277,7 @@ class WalkTest(unittest.TestCase):
             else:
                 return hive
 
-        hive_import.get_string.return_value = "v1"
-        hive_import.get_parameters.return_value = ["p1"]
-        hive_import.get_folders.return_value = []
+        hive_import.walk.side_effect = walk_tree({"p1": "v1"})
         hive.side_effect = _open_hive
 
         # When
@@ -269,11 +285,8 @@ class WalkTest(unittest.TestCase):
 
         # Then
         self.assertEqual(return_code, 0)
-        # Hiveconf handles the double slashes with _path2comps()
-        hive.set_string.assert_called_once_with("//p1", "v1")
-        hive_import.get_string.assert_called_once_with("//p1")
-        hive_import.get_parameters.assert_called_once_with("/")
-        hive_import.get_folders.assert_called_once_with("/")
+        hive.set_string.assert_called_once_with("/p1", "v1")
+        hive_import.walk.assert_called_once_with()
 
     @patch("hiveconf.open_hive")
     def test_imp_walk_param_in_folder(self, hive):
@@ -285,9 +298,7 @@ class WalkTest(unittest.TestCase):
             else:
                 return hive
 
-        hive_import.get_string.return_value = "v1"
-        hive_import.get_parameters.side_effect = [[], ["p1"]]
-        hive_import.get_folders.side_effect = [["f1"], []]
+        hive_import.walk.side_effect = walk_tree({"f1": {"p1": "v1"}})
         hive.side_effect = _open_hive
 
         # When
@@ -296,11 +307,7 @@ class WalkTest(unittest.TestCase):
         # Then
         self.assertEqual(return_code, 0)
         hive.set_string.assert_called_once_with("/f1/p1", "v1")
-        hive_import.get_string.assert_called_once_with("/f1/p1")
-        self.assertEqual(hive_import.get_parameters.call_args_list,
-                         [ call("/"), call("/f1") ])
-        self.assertEqual(hive_import.get_folders.call_args_list,
-                         [ call("/"), call("/f1") ])
+        hive.get_string.assert_not_called()
 
     @patch("hiveconf.open_hive")
     @patch("sys.stdout.write")
@@ -309,10 +316,8 @@ class WalkTest(unittest.TestCase):
     def test_print_walk(self, write, open_hive):
         # Given
         hive = open_hive.return_value
-        hive.get_string.return_value = "yay"
-        hive.get_parameters.return_value = ["p"]
-        hive.get_folders.return_value = []
-        hive.lookup.side_effect = lambda p: MagicMock(sectionname=p.rstrip("/"))
+        folder = hive.lookup.return_value
+        folder.walk.side_effect = walk_tree({"p": "yay", "f": {"q": "no"}})
 
         # When
         return_code = script_main("-a", "/")
@@ -320,9 +325,9 @@ class WalkTest(unittest.TestCase):
         # Then
         write_args_str = self.get_args_str(write.call_args_list)
         self.assertEqual(write_args_str, "p = yay\n")
-        hive.get_parameters.assert_called_once_with("/")
-        hive.get_folders.assert_called_once_with("/")
-        hive.get_string.assert_called_once_with("//p")
+        hive.lookup.assert_called_once_with("/")
+        folder.walk.assert_called_once_with(depth=0)
+        hive.get_string.assert_not_called()
 
     @patch("hiveconf.open_hive")
     @patch("sys.stdout.write")
@@ -331,33 +336,47 @@ class WalkTest(unittest.TestCase):
     def test_print_walk_recursive(self, write, open_hive):
         # Given
         hive = open_hive.return_value
-        hive.get_string.return_value = "hurray"
-        hive.get_parameters.side_effect = [[], ["p"]]
-        hive.get_folders.side_effect = [["f2"], []]
-        hive.lookup.side_effect = lambda p: MagicMock(sectionname=p.rstrip("/"))
+        folder = hive.lookup.return_value
+        folder.walk.side_effect = walk_tree({"f2": {"p": "hurray",
+                                                    "f3": {"q": "x"}}})
 
         # When
         return_code = script_main("-Ra", "/")
 
         # Then
         write_args_str = self.get_args_str(write.call_args_list)
-        self.assertEqual(write_args_str, "f2/\n    p = hurray\n")
-        hive.get_string.assert_called_once_with("/f2/p")
-        self.assertEqual(hive.get_parameters.call_args_list,
-                         [ call("/"), call("/f2") ])
-        self.assertEqual(hive.get_folders.call_args_list,
-                         [ call("/"), call("/f2") ])
+        self.assertEqual(write_args_str,
+                         "f2/\n    p = hurray\n    f3/\n        q = x\n")
+        hive.lookup.assert_called_once_with("/")
+        folder.walk.assert_called_once_with(depth=None)
+
+    @patch("hiveconf.open_hive")
+    @patch("sys.stdout.write")
+    # Our mocked folder's class need to match hiveconf.Folder
+    @patch("hiveconf.Folder", MagicMock)
+    def test_print_walk_subfolder(self, write, open_hive):
+        # Given
+        hive = open_hive.return_value
+        folder = hive.lookup.return_value
+        folder.walk.side_effect = walk_tree({"p": "1", "f": {"q": "2"}})
+
+        # When
+        return_code = script_main("-Ra", "/a/b")
+
+        # Then
+        write_args_str = self.get_args_str(write.call_args_list)
+        self.assertEqual(write_args_str, "p = 1\nf/\n    q = 2\n")
+        hive.lookup.assert_called_once_with("/a/b")
 
     @patch("hiveconf.open_hive")
     @patch("sys.stdout.write")
     # Our mocked folder's class need to match hiveconf.Folder
     @patch("hiveconf.Folder", MagicMock)
-    def test_print_walk_ignore_slash_subfolders(self, write, open_hive):
+    def test_print_walk_empty(self, write, open_hive):
         # Given
         hive = open_hive.return_value
-        hive.get_parameters.return_value = []
-        hive.get_folders.return_value = ["/"]
-        hive.lookup.side_effect = lambda p: MagicMock(sectionname=p.rstrip("/"))
+        folder = hive.lookup.return_value
+        folder.walk.side_effect = walk_tree({})
 
         # When
         return_code = script_main("-Ra", "/")
@@ -372,10 +391,7 @@ class WalkTest(unittest.TestCase):
     def test_print_walk_unprintable_value(self, stdout, open_hive):
         # Given
         hive = open_hive.return_value
-        hive.get_string.return_value = "привет"
-        hive.get_parameters.return_value = ["p"]
-        hive.get_folders.return_value = []
-        hive.lookup.side_effect = lambda p: MagicMock(sectionname=p.rstrip("/"))
+        hive.lookup.return_value.walk.side_effect = walk_tree({"p": "привет"})
         stdout.encoding = "latin-1"
 
         # When
@@ -384,9 +400,6 @@ class WalkTest(unittest.TestCase):
         # Then
         write_args_str = self.get_args_str(stdout.write.call_args_list)
         self.assertEqual(write_args_str, "p = ??????\n")
-        hive.get_parameters.assert_called_once_with("/")
-        hive.get_folders.assert_called_once_with("/")
-        hive.get_string.assert_called_once_with("//p")
 
     @patch("hiveconf.open_hive")
     @patch("sys.stdout")
@@ -395,10 +408,7 @@ class WalkTest(unittest.TestCase):
     def test_print_walk_unprintable_parameter(self, stdout, open_hive):
         # Given
         hive = open_hive.return_value
-        hive.get_string.return_value = "hurray"
-        hive.get_parameters.return_value = ["привет"]
-        hive.get_folders.return_value = []
-        hive.lookup.side_effect = lambda p: MagicMock(sectionname=p.rstrip("/"))
+        hive.lookup.return_value.walk.side_effect = walk_tree({"привет": "hurray"})
         stdout.encoding = "latin-1"
 
         # When
@@ -407,9 +417,6 @@ class WalkTest(unittest.TestCase):
         # Then
         write_args_str = self.get_args_str(stdout.write.call_args_list)
         self.assertEqual(write_args_str, "?????? = hurray\n")
-        hive.get_parameters.assert_called_once_with("/")
-        hive.get_folders.assert_called_once_with("/")
-        hive.get_string.assert_called_once_with("//привет")
 
     @patch("hiveconf.open_hive")
     @patch("sys.stdout")
@@ -418,10 +425,8 @@ class WalkTest(unittest.TestCase):
     def test_print_walk_unprintable_folder(self, stdout, open_hive):
         # Given
         hive = open_hive.return_value
-        hive.get_string.return_value = "hurray"
-        hive.get_parameters.side_effect = [[], ["p"]]
-        hive.get_folders.side_effect = [["привет"], []]
-        hive.lookup.side_effect = lambda p: MagicMock(sectionname=p.rstrip("/"))
+        hive.lookup.return_value.walk.side_effect = walk_tree(
+            {"привет": {"p": "hurray"}})
         stdout.encoding = "latin-1"
 
         # When
@@ -430,11 +435,207 @@ class WalkTest(unittest.TestCase):
         # Then
         write_args_str = self.get_args_str(stdout.write.call_args_list)
         self.assertEqual(write_args_str, "??????/\n    p = hurray\n")
-        hive.get_string.assert_called_once_with("/привет/p")
-        self.assertEqual(hive.get_parameters.call_args_list,
-                         [ call("/"), call("/привет") ])
-        self.assertEqual(hive.get_folders.call_args_list,
-                         [ call("/"), call("/привет") ])
+
+
+@patch("hiveconf.open_hive")
+class BatchTest(unittest.TestCase):
+    def run_batch(self, stdin, *args):
+        stdout = io.StringIO()
+        with patch("sys.stdin", io.StringIO(stdin)), patch("sys.stdout", stdout):
+            return_code = script_main("-b", *args)
+        return (return_code, stdout.getvalue())
+
+    def test_batch_get_and_set(self, hive):
+        # Given
+        values = {"/a": "1", "/b": None}
+        hive().get_string.side_effect = values.get
+        hive().get_integer.side_effect = lambda p: None
+        hive().set_integer.return_value = 1
+
+        # When
+        (return_code, output) = self.run_batch("/a\n/b\n\ninteger:/c=3\n")
+
+        # Then
+        self.assertEqual(return_code, 1)
+        self.assertEqual(output, "ok\t1\nerror\t/b: No such parameter\n"
+                         "ok\tcreated\n")
+        hive().set_integer.assert_called_once_with("/c", "3")
+        hive().transaction.assert_called_once_with()
+
+    def test_batch_null_delimiter(self, hive):
+        # Given
+        hive().get_string.return_value = "x y"
+        hive().set_string.return_value = 1
+
+        # When
+        (return_code, output) = self.run_batch("/a b\0/c=line\nbreak", "-0")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        self.assertEqual(output, "ok\tx y\0ok\tset\0")
+        hive().set_string.assert_called_once_with("/c", "line\nbreak")
+
+    def test_batch_bad_value(self, hive):
+        # Given
+        hive().get_integer.side_effect = BadIntegerFormat
+
+        # When
+        (return_code, output) = self.run_batch("integer:/a\n")
+
+        # Then
+        self.assertEqual(return_code, 1)
+        self.assertEqual(output, "error\tinteger:/a: BadIntegerFormat\n")
+
+    def test_batch_typed_values(self, hive):
+        # Given
+        hive().get_binary.return_value = None
+        hive().get_bool_list.return_value = None
+        hive().set_binary.return_value = 1
+        hive().set_bool_list.return_value = 1
+
+        # When
+        (return_code, output) = self.run_batch(
+            "binary:/a=zz\nbinary:/a=4142\n"
+            "bool_list:/b=yes maybe\nbool_list:/b=yes no\n")
+
+        # Then
+        self.assertEqual(return_code, 2)
+        self.assertEqual(output, "error\tbinary:/a=zz: BadBinaryFormat\n"
+                         "ok\tcreated\n"
+                         "error\tbool_list:/b=yes maybe: ValueError\n"
+                         "ok\tcreated\n")
+        hive().set_binary.assert_called_once_with("/a", b"AB")
+        hive().set_bool_list.assert_called_once_with("/b", [1, 0])
+
+    def test_batch_value_error(self, hive):
+        # Given
+        hive().get_bool_list.side_effect = ValueError("abc")
+        hive().get_string.return_value = "1"
+
+        # When
+        (return_code, output) = self.run_batch("bool_list:/a\n/b\n")
+
+        # Then
+        self.assertEqual(return_code, 1)
+        self.assertEqual(output, "error\tbool_list:/a: abc\nok\t1\n")
+
+    @patch("hiveconf.open_daemon_hive")
+    def test_batch_writes_not_through_daemon(self, daemon_hive, hive):
+        # Given
+        remote = daemon_hive.return_value = MagicMock(spec=RemoteFolder)
+        hive().get_string.return_value = "1"
+        hive().set_string.return_value = 1
+
+        # When
+        (return_code, output) = self.run_batch("/a\n/a=2\n")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        self.assertEqual(output, "ok\t1\nok\tset\n")
+        hive().set_string.assert_called_once_with("/a", "2")
+        hive().transaction.assert_called_once_with()
+        remote.set_string.assert_not_called()
+
+    @patch("hiveconf.open_daemon_hive")
+    def test_batch_reads_through_daemon(self, daemon_hive, hive):
+        # Given
+        remote = daemon_hive.return_value = MagicMock(spec=RemoteFolder)
+        remote.get_string.return_value = "1"
+
+        # When
+        (return_code, output) = self.run_batch("/a\n")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        self.assertEqual(output, "ok\t1\n")
+        hive.assert_not_called()
+
+    def test_batch_write_failure(self, hive):
+        # Given
+        @contextlib.contextmanager
+        def transaction():
+            yield
+            raise Error("disk full")
+        hive().transaction = transaction
+        hive().get_string.return_value = "1"
+        hive().set_string.return_value = 1
+
+        # When
+        (return_code, output) = self.run_batch("/a\n/a=2\n")
+
+        # Then
+        self.assertEqual(return_code, 1)
+        self.assertEqual(output, "ok\t1\n"
+                         "error\tFailed to write changes: disk full\n")
+
+
+@patch("hiveconf.open_hive")
+class NdjsonTest(unittest.TestCase):
+    # Our mocked folder's class need to match hiveconf.Folder
+    @patch("hiveconf.Folder", MagicMock)
+    @patch("sys.stdout", new_callable=io.StringIO)
+    def test_export_ndjson(self, stdout, hive):
+        # Given
+        hive.return_value.lookup.return_value.walk.side_effect = walk_tree(
+            {"p": "привет", "sub": {"q": "2"}})
+
+        # When
+        return_code = script_main("--export-ndjson", "/a")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        hive.return_value.lookup.assert_called_once_with("/a")
+        self.assertEqual(stdout.getvalue(),
+            '{"path": "/a/p", "value": "\\u043f\\u0440\\u0438\\u0432\\u0435\\u0442", '
+            '"source": "file:///test.hconf"}\n'
+            '{"path": "/a/sub/q", "value": "2", "source": "file:///test.hconf"}\n')
+
+    def test_import_ndjson_stdin(self, hive):
+        # Given
+        hive().set_string.return_value = 1
+        stdin = ('{"path": "/a/p", "value": "1", "source": "file:///x"}\n'
+                 '\n'
+                 '{"path": "/b", "value": "two"}\n')
+
+        # When
+        with patch("sys.stdin", io.StringIO(stdin)):
+            return_code = script_main("--import-ndjson", "-")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        self.assertEqual(hive().set_string.call_args_list,
+                         [call("/a/p", "1"), call("/b", "two")])
+        hive().transaction.assert_called_once_with()
+
+    @patch("hivetool.print")
+    def test_import_ndjson_errors(self, _print, hive):
+        # Given
+        hive().set_string.side_effect = [1, 0]
+        stdin = ('{"path": "/a", "value": "1"}\n'
+                 'not json\n'
+                 '{"path": "/b", "value": 2}\n'
+                 '{"path": "/c", "value": "3"}\n')
+
+        # When
+        with patch("sys.stdin", io.StringIO(stdin)):
+            return_code = script_main("--import-ndjson", "-")
+
+        # Then
+        self.assertEqual(return_code, 3)
+        _print.assert_has_calls([
+            call("<stdin>: line 2: invalid record", file=sys.stderr),
+            call("<stdin>: line 3: invalid record", file=sys.stderr),
+            call("<stdin>: line 4: Failed to set parameter /c", file=sys.stderr)])
+
+    @patch("hivetool.print")
+    def test_import_ndjson_missing_file(self, _print, hive):
+        # When
+        return_code = script_main("--import-ndjson", "/nonexistent/file.ndjson")
+
+        # Then
+        self.assertEqual(return_code, 1)
+        _print.assert_called_once_with(
+            "/nonexistent/file.ndjson: No such file or directory", file=sys.stderr)
 
 
 class MainTest(unittest.TestCase):
@@ -447,6 +648,48 @@ class MainTest(unittest.TestCase):
         self.assertEqual(return_code, 0)
         _print.assert_called_once_with(ANY, file=sys.stderr)
 
+    @patch("hiveconf.open_hive")
+    @patch("hiveconf.compile_hive")
+    def test_main_compile(self, compile_hive, _open_hive):
+        # When
+        return_code = script_main("-r", "root.hconf", "-c", "root.hbin")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        compile_hive.assert_called_once_with("root.hconf", "root.hbin")
+
+    @patch("hivetool.print")
+    @patch("hiveconf.open_hive")
+    @patch("hiveconf.open_daemon_hive")
+    def test_main_uses_daemon(self, open_daemon_hive, _open_hive, _print):
+        # Given
+        open_daemon_hive().get_string.return_value = "value"
+
+        # When
+        return_code = script_main("-r", "root.hconf", "/a")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        open_daemon_hive.assert_called_with("root.hconf")
+        _open_hive.assert_not_called()
+        _print.assert_called_once_with("value")
+
+    @patch("hivetool.print")
+    @patch("hiveconf.open_hive")
+    @patch("hiveconf.open_daemon_hive")
+    def test_main_without_daemon(self, open_daemon_hive, _open_hive, _print):
+        # Given
+        open_daemon_hive.return_value = None
+        _open_hive().get_string.return_value = "value"
+
+        # When
+        return_code = script_main("-r", "root.hconf", "/a")
+
+        # Then
+        self.assertEqual(return_code, 0)
+        _open_hive.assert_called_with("root.hconf")
+        _print.assert_called_once_with("value")
+
     @patch("hivetool.print")
     def test_main_invalid_flag(self, _print):
         # When
@@ -16,7 +16,7 @@ setup (name = "hiveconf",
        url = "http://www.lysator.liu.se/~astrand/projects/hiveconf/",
        package_dir = {'': 'python'},
        py_modules = ["hiveconf"],
-       data_files=[('/usr/bin', ['python/hivetool']),
+       data_files=[('/usr/bin', ['python/hivetool', 'python/hiveconfd']),
                    ('/etc', ['etc/root.hconf']),
                    ('/etc/hiveconf.d', ["etc/hiveconf.d/kde.hconf", "etc/hiveconf.d/samba.hconf"]),
                    ('/usr/lib/hiveconf', ['setup.sh'])